@@ -3,13 +3,96 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-import gdb, subprocess, readinput
+import gdb, subprocess, readinput, adbclient, adbparams, adbstats
+import os, binascii, threading, Queue, time, collections, contextlib
 
 returncode = 0
 
+client = adbclient.Client()
+stats = adbstats.recorder
+
+# read parameter values directly, because gdb.parameter
+# is not safe to call from threads other than gdb's
+def _adbPath():
+    return adbparams.path.value or 'adb'
+
+# per-thread device override set by use_device()
+_local = threading.local()
+
+def _device():
+    return getattr(_local, 'device', None) or adbparams.device.value or ''
+
+@contextlib.contextmanager
+def use_device(serial):
+    '''Sends adb requests made by the current thread to device serial
+       instead of the adb-device parameter; None restores the default'''
+    saved = getattr(_local, 'device', None)
+    _local.device = serial
+    try:
+        yield
+    finally:
+        _local.device = saved
+
+def _nativeService(args):
+    # returns the device service streaming output of the request
+    if len(args) > 1 and args[0] == 'shell':
+        return 'shell:' + ' '.join(args[1:])
+    if args and args[0] == 'logcat':
+        return 'shell:' + ' '.join(args)
+    return None
+
+def _nativeCall(args, kw):
+    # returns output of the request, or None if the request
+    # has to go through the adb binary instead
+    if kw.get('async') or \
+            any(k not in ('stdin', 'stderr', 'async') for k in kw) or \
+            kw.get('stdin', subprocess.PIPE) != subprocess.PIPE:
+        return None
+    dev = _device()
+    if args == ['devices']:
+        return 'List of devices attached\n' + ''.join(
+                '%s\t%s\n' % d for d in client.devices())
+    service = _nativeService(args)
+    if service:
+        conn = client.open(dev, service)
+        try:
+            return conn.recvAll()
+        finally:
+            conn.close()
+    if len(args) == 3 and args[0] == 'forward':
+        client.forward(dev, args[1], args[2])
+        return ''
+    return None
+
 def call(args, **kw):
-    cmd = [str(gdb.parameter('adb-path'))]
-    dev = str(gdb.parameter('adb-device'))
+    start = None if kw.get('async') else stats.begin()
+    if start is None:
+        return _call(args, **kw)
+    _local.returncode = None
+    out = None
+    try:
+        out = _call(args, **kw)
+        return out
+    finally:
+        code = _local.returncode
+        if code is None:
+            # native requests have no exit code, and raise on failure
+            code = 0 if out is not None else 1
+        stats.record(start, 'call', args, code, len(out) if out else 0)
+
+def _call(args, **kw):
+    try:
+        out = _nativeCall(args, kw)
+        if out is not None:
+            return out
+    except adbclient.ServerUnreachable:
+        # let the adb binary start the server
+        pass
+    except adbclient.ADBError as e:
+        raise gdb.GdbError('adb: ' + str(e) +
+                           ' for arguments ' + str(args))
+    cmd = [_adbPath()]
+    dev = _device()
     if dev:
         cmd.extend(['-s', dev])
     cmd.extend(args)
@@ -26,7 +109,8 @@ def call(args, **kw):
         if async:
             return adb
         out = adb.communicate()[0]
-        returncode = adb.returncode
+        # exit code for the statistics recorded by call()
+        _local.returncode = adb.returncode
     except OSError as e:
         raise gdb.GdbError('cannot run adb: ' + str(e))
     if adb.returncode != 0:
@@ -82,18 +166,71 @@ def chooseDevice():
                 dev = matchDev[0]
     if str(gdb.parameter('adb-device')) != dev:
         gdb.execute('set adb-device ' + dev)
+    # the device may have been reflashed since its identity was cached
+    invalidate('device', dev)
     return dev
 
+def pull_many(files, callback=None):
+    '''Pull (src, dest) pairs over one connection; returns a list of
+       adbclient.Transfer, and calls callback with each Transfer as
+       soon as it completes'''
+    def done(transfer):
+        if stats.enabled:
+            stats.add('pull', [transfer.src], transfer.seconds,
+                      1 if transfer.error else 0, transfer.size)
+        if callback:
+            callback(transfer)
+    try:
+        return client.pullMany(_device(), files, done)
+    except adbclient.ServerUnreachable:
+        pass
+    except adbclient.ADBError as e:
+        raise gdb.GdbError('adb: ' + str(e))
+    results = []
+    for src, dest in files:
+        start = time.time()
+        try:
+            # adb writes in place; do not write through a hardlink
+            # shared with the library cache
+            if os.path.lexists(dest):
+                os.remove(dest)
+            _call(['pull', src, dest], stderr=subprocess.PIPE)
+            transfer = adbclient.Transfer(src, dest,
+                    os.path.getsize(dest), time.time() - start, None)
+        except (gdb.GdbError, OSError) as e:
+            transfer = adbclient.Transfer(src, dest, 0,
+                    time.time() - start, str(e))
+        results.append(transfer)
+        done(transfer)
+    return results
+
 def pull(src, dest):
-    params = ['pull']
-    if isinstance(src, list):
-        params.extend(src)
+    srcs = src if isinstance(src, list) else [str(src)]
+    if len(srcs) > 1 or os.path.isdir(dest):
+        files = [(s, os.path.join(dest, s.rstrip('/').split('/')[-1]))
+                 for s in srcs]
     else:
-        params.append(str(src))
-    params.append(dest)
-    call(params, stderr=subprocess.PIPE)
+        files = [(srcs[0], dest)]
+    for transfer in pull_many(files):
+        if transfer.error:
+            raise gdb.GdbError('adb: cannot pull ' + transfer.src + ': ' +
+                               transfer.error)
 
 def push(src, dest):
+    if not isinstance(src, list):
+        try:
+            transfer = client.push(_device(), str(src), dest)
+            if stats.enabled:
+                stats.add('push', [transfer.dst], transfer.seconds,
+                          1 if transfer.error else 0, transfer.size)
+            if transfer.error:
+                raise gdb.GdbError('adb: cannot push ' + str(src) + ': ' +
+                                   transfer.error)
+            return
+        except adbclient.ServerUnreachable:
+            pass
+        except (adbclient.ADBError, IOError, OSError) as e:
+            raise gdb.GdbError('adb: cannot push ' + str(src) + ': ' + str(e))
     params = ['push']
     if isinstance(src, list):
         params.extend(src)
@@ -102,12 +239,559 @@ def push(src, dest):
     params.append(dest)
     call(params, stderr=subprocess.PIPE)
 
+def _markedResult(lines, status):
+    # drop the newline added before the marker
+    output = ''.join(lines)
+    output = output[: -2] if output.endswith('\r\n') else \
+             output[: -1] if output.endswith('\n') else output
+    status = status.strip()
+    return (output, int(status) if status.isdigit() else None)
+
+class ShellSession(object):
+    '''Long-lived adb shell shared by all threads; requests are queued
+       and run one at a time, with output delimited by unique markers'''
+
+    class Request(object):
+        def __init__(self, command):
+            self.command = command
+            self.result = None
+            self.error = None
+            self.done = threading.Event()
+
+    def __init__(self, serial):
+        self.serial = serial
+        self._queue = Queue.Queue()
+        self._write = None
+        self._readline = None
+        self._close = None
+        self._thread = threading.Thread(name='ADBShell', target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _open(self):
+        try:
+            conn = client.open(self.serial, 'shell:')
+            self._write = conn.send
+            self._readline = conn.sock.makefile('rb').readline
+            self._close = conn.close
+        except adbclient.ServerUnreachable:
+            # run this after fork() and before exec(adb)
+            # so 'adb shell' doesn't get gdb's signals
+            def sessionPreExec():
+                os.setpgrp()
+            cmd = [_adbPath()]
+            cmd += ['-s', self.serial] if self.serial else []
+            proc = subprocess.Popen(cmd + ['shell'], stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                    preexec_fn=sessionPreExec)
+            def write(data):
+                proc.stdin.write(data)
+                proc.stdin.flush()
+            def close():
+                try:
+                    proc.stdin.close()
+                    proc.terminate()
+                except (IOError, OSError):
+                    pass
+                proc.wait()
+            self._write = write
+            self._readline = proc.stdout.readline
+            self._close = close
+        # prompts would otherwise end up in front of our markers
+        self._write('PS1=; PS2=\n')
+
+    def _reset(self):
+        if self._close:
+            self._close()
+        self._write = self._readline = self._close = None
+
+    def _execute(self, command):
+        tag = binascii.hexlify(os.urandom(8))
+        begin = 'ADB_BEGIN_' + tag
+        end = 'ADB_END_' + tag
+        # quotes keep the echoed input from matching the markers; stdin is
+        # redirected so the command cannot swallow subsequent requests
+        self._write("echo ADB_''BEGIN_%s; { %s\n} </dev/null; _s=$?; "
+                    "echo; echo ADB_''END_%s $_s\n" % (tag, command, tag))
+        line = self._readline()
+        while begin not in line:
+            if not line:
+                raise adbclient.ADBError('shell session closed')
+            line = self._readline()
+        text = []
+        line = self._readline()
+        while end not in line:
+            if not line:
+                raise adbclient.ADBError('shell session closed')
+            text.append(line)
+            line = self._readline()
+        return _markedResult(text, line[line.find(end) + len(end):])
+
+    def _run(self):
+        while True:
+            request = self._queue.get()
+            if request is None:
+                break
+            # restart the shell once if the device dropped it
+            for attempt in range(2):
+                try:
+                    if not self._readline:
+                        self._open()
+                    request.result = self._execute(request.command)
+                    request.error = None
+                    break
+                except (adbclient.ADBError, IOError, OSError) as e:
+                    self._reset()
+                    request.error = e
+            request.done.set()
+        self._reset()
+
+    def call(self, command):
+        '''Returns (output, exit status) of the command'''
+        request = ShellSession.Request(command)
+        self._queue.put(request)
+        request.done.wait()
+        if request.error:
+            raise gdb.GdbError('adb shell: ' + str(request.error))
+        return request.result
+
+    def close(self):
+        self._queue.put(None)
+
+_sessions = {}
+_sessionsLock = threading.Lock()
+
+def session(serial=None):
+    '''Returns the shared shell session for the device'''
+    serial = _device() if serial is None else serial
+    with _sessionsLock:
+        if serial not in _sessions:
+            _sessions[serial] = ShellSession(serial)
+        return _sessions[serial]
+
+def closeSessions():
+    with _sessionsLock:
+        sessions = _sessions.values()
+        _sessions.clear()
+    for s in sessions:
+        s.close()
+
+def shell(command):
+    '''Returns output of a short command run in the shared shell session'''
+    start = stats.begin()
+    output, status = session().call(command)
+    stats.record(start, 'shell', [command], status, len(output))
+    return output
+
+def shell_batch(commands):
+    '''Run commands in one adb shell round trip; returns a list of
+       (output, exit status) tuples, one for each command'''
+    if not commands:
+        return []
+    # each command is followed by a marker line carrying its exit status
+    marker = 'ADB_BATCH_' + binascii.hexlify(os.urandom(8))
+    script = ''.join('%s\n_s=$?; echo; echo %s $_s\n' % (cmd, marker)
+                     for cmd in commands)
+    out = shell(script)
+    results = []
+    text = []
+    for line in out.splitlines(True):
+        if not line.startswith(marker + ' '):
+            text.append(line)
+            continue
+        results.append(_markedResult(text, line[len(marker) + 1:]))
+        text = []
+    # commands that did not report (e.g. shell exited) have no status
+    results.extend([('', None)] * (len(commands) - len(results)))
+    return results
+
+def exec_out(args):
+    '''Run a command on the device without a PTY and return its raw output;
+       args is a list of command arguments or a command string'''
+    command = ' '.join(args) if isinstance(args, list) else args
+    try:
+        start = stats.begin()
+        out = client.execOut(_device(), command)
+        stats.record(start, 'exec_out', [command], 0, len(out))
+        return out
+    except adbclient.ServerUnreachable:
+        try:
+            return call(['exec-out', command], stderr=subprocess.PIPE)
+        except gdb.GdbError:
+            # adb is too old for exec-out
+            pass
+    except adbclient.ADBError:
+        # device is too old for exec:
+        pass
+    # undo the line ending translation done by the PTY
+    return call(['shell', command]).replace('\r\n', '\n')
+
+def read_file(path):
+    '''Returns the contents of a device file, read without a temp file'''
+    try:
+        start = stats.begin()
+        data = client.readFile(_device(), path)
+        stats.record(start, 'read_file', [path], 0, len(data))
+        return data
+    except adbclient.ServerUnreachable:
+        pass
+    except adbclient.ADBError as e:
+        raise gdb.GdbError('adb: cannot read ' + path + ': ' + str(e))
+    return exec_out(['cat', path])
+
+def build_fingerprint():
+    '''Returns the build fingerprint of the device, or '' if unknown'''
+    def getFingerprint():
+        try:
+            output, status = shell_batch(['getprop ro.build.fingerprint'])[0]
+        except gdb.GdbError:
+            return ''
+        return output.strip() if status == 0 else ''
+    return cached('device', 'fingerprint', getFingerprint)
+
 def pathExists(path):
+    try:
+        return client.stat(_device(), path)[0] != 0
+    except adbclient.ServerUnreachable:
+        pass
+    except adbclient.ADBError as e:
+        raise gdb.GdbError('adb: ' + str(e))
     # adb shell doesn't seem to return error codes
-    out = call(['shell', 'ls "' + path + '"; echo $?'],
-            stderr=subprocess.PIPE)
-    return int(out.splitlines()[-1]) == 0
+    return shell_batch(['ls "' + path + '"'])[0][1] == 0
 
 def forward(from_port, to_port):
     call(['forward', from_port, to_port])
 
+# seconds before cached device query results expire, by query type
+CACHE_TTL = {
+    'packages': 60,     # installed packages
+    'procs': 2,         # running processes
+    'device': 300,      # device/build identity
+}
+
+_cache = {} # (serial, key) -> (kind, expiry, value)
+_cacheLock = threading.Lock()
+cache_stats = {'hits': 0, 'misses': 0}
+
+def _cacheGet(key):
+    # returns (True, value) on a hit, or (False, None) on a miss
+    entry = (_device(), key)
+    with _cacheLock:
+        value = _cache.get(entry)
+        if value and value[1] > time.time():
+            cache_stats['hits'] += 1
+            return (True, value[2])
+        cache_stats['misses'] += 1
+    return (False, None)
+
+def _cachePut(kind, key, value):
+    with _cacheLock:
+        _cache[(_device(), key)] = (kind,
+                time.time() + CACHE_TTL.get(kind, 0), value)
+
+def cached(kind, key, fn):
+    '''Returns cached result for key on the current device, or calls fn
+       and caches its result for the TTL of the query type'''
+    hit, result = _cacheGet(key)
+    if hit:
+        return result
+    result = fn()
+    _cachePut(kind, key, result)
+    return result
+
+def query(kind, command):
+    '''Returns output of a shell command, cached by query type'''
+    return cached(kind, command, lambda: shell(command))
+
+def _streamOutput(args, chunks, size):
+    # only wrap the request when recording statistics
+    if not stats.enabled:
+        return _streamRequest(args, chunks, size)
+    return _recordedStream(args, chunks, size)
+
+def _recordedStream(args, chunks, size):
+    start = stats.begin()
+    counter = [0, 1] # bytes, exit code
+    try:
+        for data in _streamRequest(args, chunks, size):
+            counter[0] += len(data)
+            yield data
+        counter[1] = 0
+    finally:
+        stats.record(start, 'stream', args, counter[1], counter[0])
+
+def _streamRequest(args, chunks, size):
+    service = _nativeService(args)
+    conn = None
+    if service:
+        try:
+            conn = client.open(_device(), service)
+        except adbclient.ServerUnreachable:
+            pass
+        except adbclient.ADBError as e:
+            raise gdb.GdbError('adb: ' + str(e) +
+                               ' for arguments ' + str(args))
+    if conn:
+        try:
+            if chunks:
+                for data in iter(lambda: conn.recv(size), ''):
+                    yield data
+            else:
+                for line in iter(conn.sock.makefile('rb').readline, ''):
+                    yield line
+        except (adbclient.ADBError, IOError) as e:
+            raise gdb.GdbError('adb: ' + str(e) +
+                               ' for arguments ' + str(args))
+        finally:
+            conn.close()
+        return
+
+    # run this after fork() and before exec(adb)
+    # so adb doesn't get gdb's signals
+    def streamPreExec():
+        os.setpgrp()
+    with open(os.devnull, 'wb') as devnull:
+        proc = call(args, async=True, stderr=devnull,
+                    preexec_fn=streamPreExec)
+    try:
+        if chunks:
+            for data in iter(lambda: os.read(proc.stdout.fileno(), size), ''):
+                yield data
+        else:
+            for line in iter(proc.stdout.readline, ''):
+                yield line
+    finally:
+        if proc.poll() is None:
+            # stopped early
+            proc.terminate()
+        proc.wait()
+    if proc.returncode != 0:
+        raise gdb.GdbError('adb returned exit code ' + str(proc.returncode) +
+                           ' for arguments ' + str(args))
+
+def stream(args, chunks=False, size=65536, cache=None):
+    '''Run an adb request and yield its output line by line as it arrives,
+       or in chunks of at most size bytes; closing the generator early
+       stops the request. If cache is a query type, complete outputs are
+       cached and replayed from the cache for the TTL of that type'''
+    if not cache:
+        return _streamOutput(args, chunks, size)
+    return _cachedStream(args, chunks, size, cache)
+
+def _cachedStream(args, chunks, size, cache):
+    key = ('stream', tuple(args), chunks)
+    hit, output = _cacheGet(key)
+    if hit:
+        for data in output:
+            yield data
+        return
+    output = []
+    for data in _streamOutput(args, chunks, size):
+        output.append(data)
+        yield data
+    # only reached if the consumer did not stop early
+    _cachePut(cache, key, output)
+
+def invalidate(kind=None, serial=None):
+    '''Drops cached results of the query type and/or device,
+       or all cached results if neither is specified'''
+    with _cacheLock:
+        for entry in [e for e, v in _cache.iteritems()
+                      if (kind is None or v[0] == kind) and
+                         (serial is None or e[0] == serial)]:
+            del _cache[entry]
+
+
+class Future(object):
+    '''Pending result of work submitted to the worker pool'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._running = False
+        self._cancelled = False
+        self._result = None
+        self._error = None
+        self._callbacks = []
+
+    def _start(self):
+        with self._lock:
+            if self._cancelled:
+                return False
+            self._running = True
+            return True
+
+    def _finish(self, result, error):
+        with self._lock:
+            self._result = result
+            self._error = error
+            self._done.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for callback in callbacks:
+            callback(self)
+
+    def cancel(self):
+        with self._lock:
+            if self._running or self._done.is_set():
+                return self._cancelled
+            self._cancelled = True
+        self._finish(None, None)
+        return True
+
+    def cancelled(self):
+        return self._cancelled
+
+    def running(self):
+        return self._running and not self._done.is_set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def add_done_callback(self, fn):
+        '''Calls fn(future) when done; fn may run on a worker thread'''
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def exception(self, timeout=None):
+        # wait in slices so Ctrl+C still works
+        deadline = time.time() + timeout if timeout is not None else None
+        while not self._done.wait(0.5):
+            if deadline is not None and time.time() >= deadline:
+                raise gdb.GdbError('adb: timed out waiting for result')
+        if self._cancelled:
+            raise gdb.GdbError('adb: request cancelled')
+        return self._error
+
+    def result(self, timeout=None):
+        error = self.exception(timeout)
+        if error:
+            raise error
+        return self._result
+
+class WorkerPool(object):
+    '''Bounded pool of threads running submitted work; the number of
+       threads is set by the adb-jobs parameter'''
+
+    def __init__(self):
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def _run(self, future, fn, args, kw):
+        if not future._start():
+            return
+        try:
+            future._finish(fn(*args, **kw), None)
+        except Exception as e:
+            future._finish(None, e)
+
+    def _work(self):
+        _local.worker = True
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            future, device, fn, args, kw = item
+            with use_device(device):
+                self._run(future, fn, args, kw)
+
+    def submit(self, fn, *args, **kw):
+        future = Future()
+        if getattr(_local, 'worker', False):
+            # a worker waiting on work queued behind it could leave no
+            # thread to run that work, so nested work runs right here
+            self._run(future, fn, args, kw)
+            return future
+        with self._lock:
+            # work goes to the same device as the submitting thread
+            self._queue.put((future, getattr(_local, 'device', None),
+                             fn, args, kw))
+            self._threads = [t for t in self._threads if t.is_alive()]
+            if len(self._threads) < max(1, adbparams.jobs.value or 1):
+                thread = threading.Thread(name='ADBWorker', target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        return future
+
+    def shutdown(self):
+        '''Cancels work not yet started and stops all threads after
+           their current work'''
+        with self._lock:
+            try:
+                while True:
+                    item = self._queue.get_nowait()
+                    if item:
+                        item[0].cancel()
+            except Queue.Empty:
+                pass
+            for thread in self._threads:
+                self._queue.put(None)
+            self._threads = []
+
+pool = WorkerPool()
+
+def submit(args, *fnargs, **kw):
+    '''Run an adb request in the worker pool and return a Future; args is
+       a list of adb arguments as for call(), or a callable that is called
+       with the remaining arguments'''
+    if callable(args):
+        return pool.submit(args, *fnargs, **kw)
+    return pool.submit(call, args, **kw)
+
+def map_requests(requests):
+    '''Run requests concurrently in the worker pool; returns a list of
+       results in the order of the requests'''
+    return [f.result() for f in [submit(r) for r in requests]]
+
+DeviceResult = collections.namedtuple('DeviceResult',
+        ['serial', 'result', 'error', 'seconds'])
+
+def on_all_devices(fn, devices=None):
+    '''Calls fn(serial) concurrently for each attached device, or for each
+       serial in devices, with adb requests made by fn going to that device;
+       returns a list of DeviceResult in the order of the devices'''
+    if devices is None:
+        devices = getDevices()
+    results = {}
+    def run(serial):
+        start = time.time()
+        with use_device(serial):
+            try:
+                result = DeviceResult(serial, fn(serial), None,
+                                      time.time() - start)
+            except Exception as e:
+                result = DeviceResult(serial, None, e, time.time() - start)
+        results[serial] = result
+    # dedicated threads, so slow devices do not hold up the worker pool
+    threads = [threading.Thread(name='ADBDevice-' + serial,
+                                target=run, args=(serial,))
+               for serial in devices]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        # wait in slices so Ctrl+C still works
+        while thread.is_alive():
+            thread.join(0.5)
+    return [results[serial] for serial in devices]
+
+def summarize(results):
+    '''Returns a printable summary of on_all_devices results'''
+    failed = [r for r in results if r.error]
+    lines = ['%d device(s): %d succeeded, %d failed' % (
+             len(results), len(results) - len(failed), len(failed))]
+    for r in results:
+        lines.append('  %s: %s (%.1fs)' % (r.serial,
+                'error: ' + str(r.error) if r.error else 'ok', r.seconds))
+    return '\n'.join(lines)
+
+def exit_handler(event):
+    pool.shutdown()
+    closeSessions()
+
+gdb.events.exited.connect(exit_handler)
@@ -0,0 +1,535 @@
+# vi: set tabstop=4 shiftwidth=4 expandtab:
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Client for the adb host protocol, spoken directly to the local adb server
+# over its socket instead of forking the adb binary for every request.
+# This module does not depend on gdb, so it can be used outside of gdb.
+
+import os, errno, socket, struct, threading, stat, time, collections
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 5037
+
+class ADBError(Exception):
+    '''Request failed; message is the reason given by the server'''
+    pass
+
+class ServerUnreachable(ADBError):
+    '''Cannot connect to the adb server'''
+    pass
+
+class ConnectionLost(ADBError):
+    '''Connection to the adb server was closed or broken'''
+    pass
+
+# result of one file transfer; error is None on success
+Transfer = collections.namedtuple('Transfer',
+        ['src', 'dst', 'size', 'seconds', 'error'])
+
+def _makeDirs(path):
+    # other threads may be creating the same directories
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def _serverPort():
+    port = os.environ.get('ANDROID_ADB_SERVER_PORT', '')
+    return int(port) if port.isdigit() else DEFAULT_PORT
+
+class Connection(object):
+    '''Socket connection to the adb server'''
+
+    def __init__(self, host, port, timeout=None):
+        try:
+            self.sock = socket.create_connection((host, port), timeout)
+        except socket.error as e:
+            raise ServerUnreachable('cannot connect to adb server at %s:%d: %s'
+                                    % (host, port, str(e)))
+        # only connections left in a reusable state go back to the pool
+        self.reusable = False
+        # whether the connection was idle in the pool before its current use
+        self.pooled = False
+
+    def close(self):
+        self.reusable = False
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+    def send(self, data):
+        try:
+            self.sock.sendall(data)
+        except socket.error as e:
+            raise ConnectionLost('connection to adb server lost: ' + str(e))
+
+    def recv(self, size):
+        try:
+            return self.sock.recv(size)
+        except socket.error as e:
+            raise ConnectionLost('connection to adb server lost: ' + str(e))
+
+    def recvExact(self, size):
+        data = []
+        while size > 0:
+            chunk = self.recv(min(size, 65536))
+            if not chunk:
+                raise ConnectionLost('connection closed by adb server')
+            data.append(chunk)
+            size -= len(chunk)
+        return ''.join(data)
+
+    def recvAll(self):
+        data = []
+        chunk = self.recv(65536)
+        while chunk:
+            data.append(chunk)
+            chunk = self.recv(65536)
+        return ''.join(data)
+
+    def recvString(self):
+        size = self.recvExact(4)
+        try:
+            return self.recvExact(int(size, 16))
+        except ValueError:
+            raise ADBError('invalid length from adb server: ' + repr(size))
+
+    def status(self):
+        status = self.recvExact(4)
+        if status == 'OKAY':
+            return
+        if status == 'FAIL':
+            raise ADBError(self.recvString())
+        raise ADBError('unexpected response from adb server: ' + repr(status))
+
+    def request(self, service):
+        # requests are sent as a 4-digit hex length followed by the payload
+        self.send('%04x%s' % (len(service), service))
+        self.status()
+
+class Client(object):
+    '''Host-side client of the adb server'''
+
+    SYNC_STAT = 'STAT'
+    SYNC_RECV = 'RECV'
+    SYNC_SEND = 'SEND'
+    SYNC_DATA = 'DATA'
+    SYNC_DONE = 'DONE'
+    SYNC_OKAY = 'OKAY'
+    SYNC_FAIL = 'FAIL'
+    SYNC_QUIT = 'QUIT'
+    # maximum payload of a DATA packet
+    SYNC_DATA_MAX = 64 * 1024
+    # maximum number of requests in flight on a sync connection
+    SYNC_WINDOW = 16
+
+    def __init__(self, host=DEFAULT_HOST, port=None, timeout=None):
+        self.host = host
+        self.port = port if port else _serverPort()
+        self.timeout = timeout
+        # idle sync connections per device serial
+        self._pool = {}
+        self._poolLock = threading.Lock()
+
+    def connect(self):
+        return Connection(self.host, self.port, self.timeout)
+
+    def _host(self, service):
+        conn = self.connect()
+        try:
+            conn.request(service)
+            return conn.recvString()
+        finally:
+            conn.close()
+
+    def version(self):
+        return int(self._host('host:version'), 16)
+
+    def _parseDevices(self, text):
+        devs = []
+        for line in text.splitlines():
+            dev = line.partition('\t')
+            if dev[1]:
+                devs.append((dev[0].strip(), dev[2].strip()))
+        return devs
+
+    def devices(self):
+        '''Returns list of (serial, state) tuples'''
+        return self._parseDevices(self._host('host:devices'))
+
+    def trackDevices(self):
+        '''Yields the list of (serial, state) tuples now and every time
+           a device is connected, disconnected or changes state; raises
+           ADBError when the adb server goes away'''
+        conn = self.connect()
+        try:
+            conn.request('host:track-devices')
+            while True:
+                yield self._parseDevices(conn.recvString())
+        finally:
+            conn.close()
+
+    def transport(self, serial):
+        '''Returns a connection switched to the transport of the device;
+           the connection can then be used for one device service'''
+        conn = self.connect()
+        try:
+            conn.request('host:transport:' + serial if serial
+                         else 'host:transport-any')
+        except:
+            conn.close()
+            raise
+        return conn
+
+    def open(self, serial, service):
+        '''Returns a connection streaming the output of the device service'''
+        conn = self.transport(serial)
+        try:
+            conn.request(service)
+        except:
+            conn.close()
+            raise
+        return conn
+
+    def shell(self, serial, command):
+        conn = self.open(serial, 'shell:' + command)
+        try:
+            return conn.recvAll()
+        finally:
+            conn.close()
+
+    def execOut(self, serial, command):
+        '''Returns raw output of the command, run without a PTY'''
+        conn = self.open(serial, 'exec:' + command)
+        try:
+            return conn.recvAll()
+        finally:
+            conn.close()
+
+    def forward(self, serial, local, remote):
+        conn = self.connect()
+        try:
+            conn.request(('host-serial:' + serial if serial else 'host') +
+                         ':forward:' + local + ';' + remote)
+            # second status is sent after the port is bound
+            conn.status()
+        finally:
+            conn.close()
+
+    def acquire(self, serial, pooled=True):
+        '''Returns a connection in sync mode for the device, taken from
+           the pool unless pooled is False'''
+        with self._poolLock:
+            idle = self._pool.get(serial) if pooled else None
+            if idle:
+                conn = idle.pop()
+                conn.pooled = True
+                return conn
+        conn = self.open(serial, 'sync:')
+        conn.reusable = True
+        return conn
+
+    def release(self, serial, conn):
+        '''Returns a connection to the pool, or closes it if unusable'''
+        if not conn.reusable:
+            conn.close()
+            return
+        with self._poolLock:
+            self._pool.setdefault(serial, []).append(conn)
+
+    def close(self, serial=None):
+        '''Closes pooled connections for the device, or for all devices'''
+        with self._poolLock:
+            if serial is None:
+                conns = sum(self._pool.values(), [])
+                self._pool.clear()
+            else:
+                conns = self._pool.pop(serial, [])
+        for conn in conns:
+            try:
+                conn.send(self.SYNC_QUIT + struct.pack('<I', 0))
+            except ADBError:
+                pass
+            conn.close()
+
+    def _sync(self, serial, request):
+        # run request(conn) on a sync connection and return its result;
+        # pooled connections go stale when the device or the server
+        # restarts, so a pooled connection failing is retried once on
+        # a new connection
+        conn = self.acquire(serial)
+        try:
+            try:
+                result = request(conn)
+            except ConnectionLost:
+                if not conn.pooled:
+                    raise
+                conn.close()
+                conn = self.acquire(serial, pooled=False)
+                result = request(conn)
+        except:
+            conn.close()
+            raise
+        self.release(serial, conn)
+        return result
+
+    def stat(self, serial, path):
+        '''Returns (mode, size, mtime) of path; mode is 0 if not found'''
+        return self._sync(serial, lambda conn: self._statMany(conn, [path])[0])
+
+    def _syncRequest(self, conn, cmd, path):
+        conn.send(cmd + struct.pack('<I', len(path)) + path)
+
+    def _syncHeader(self, conn):
+        hdr = conn.recvExact(8)
+        return hdr[0: 4], struct.unpack('<I', hdr[4:])[0]
+
+    def _statMany(self, conn, paths):
+        # pipeline STAT requests, keeping at most SYNC_WINDOW in flight
+        stats = []
+        sent = 0
+        while len(stats) < len(paths):
+            while sent < len(paths) and sent - len(stats) < self.SYNC_WINDOW:
+                self._syncRequest(conn, self.SYNC_STAT, paths[sent])
+                sent += 1
+            resp = conn.recvExact(16)
+            if resp[0: 4] != self.SYNC_STAT:
+                raise ADBError('unexpected sync response: ' + repr(resp[0: 4]))
+            stats.append(struct.unpack('<III', resp[4:]))
+        return stats
+
+    def _recvFile(self, conn, dst):
+        # stream DATA packets straight to a temporary file next to dst,
+        # so an interrupted transfer never leaves a truncated dst behind
+        dstdir = os.path.dirname(dst)
+        if dstdir and not os.path.isdir(dstdir):
+            _makeDirs(dstdir)
+        # several workers can be pulling to the same dst
+        tmp = '%s.%d.%d.part' % (dst, os.getpid(),
+                                 threading.current_thread().ident)
+        try:
+            with open(tmp, 'wb') as f:
+                size = self._recvData(conn, f.write)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        os.rename(tmp, dst)
+        return size
+
+    def _recvData(self, conn, write):
+        # pass contents of the requested file to write; returns its size
+        size = 0
+        cmd, length = self._syncHeader(conn)
+        while cmd == self.SYNC_DATA:
+            write(conn.recvExact(length))
+            size += length
+            cmd, length = self._syncHeader(conn)
+        if cmd == self.SYNC_DONE:
+            return size
+        if cmd == self.SYNC_FAIL:
+            raise ADBError(conn.recvExact(length))
+        raise ADBError('unexpected sync response: ' + repr(cmd))
+
+    def pullMany(self, serial, files, callback=None):
+        '''Pulls (src, dst) pairs with pipelined requests over one sync
+           connection; returns a Transfer for each pair, and calls
+           callback with each Transfer as soon as it completes'''
+        results = []
+        def finish(src, dst, size, start, error):
+            transfer = Transfer(src, dst, size, time.time() - start, error)
+            results.append(transfer)
+            if callback:
+                callback(transfer)
+
+        files = list(files)
+        order = {}
+        for i, f in enumerate(files):
+            order.setdefault(f, i)
+        while files:
+            conn = self.acquire(serial)
+            try:
+                start = time.time()
+                srcs = [src for src, dst in files]
+                try:
+                    stats = self._statMany(conn, srcs)
+                except ConnectionLost:
+                    if not conn.pooled:
+                        raise
+                    # stale pooled connection; see _sync
+                    conn.close()
+                    conn = self.acquire(serial, pooled=False)
+                    stats = self._statMany(conn, srcs)
+                pending = []
+                for (src, dst), (mode, size, mtime) in zip(files, stats):
+                    if not mode:
+                        finish(src, dst, 0, start, 'remote object \'' + src +
+                               '\' does not exist')
+                    elif stat.S_ISDIR(mode):
+                        finish(src, dst, 0, start, 'remote object \'' + src +
+                               '\' is a directory')
+                    else:
+                        pending.append((src, dst))
+                files = []
+                # pipeline RECV requests and receive files in order
+                sent = 0
+                done = 0
+                while done < len(pending):
+                    while sent < len(pending) and \
+                            sent - done < self.SYNC_WINDOW:
+                        self._syncRequest(conn, self.SYNC_RECV,
+                                          pending[sent][0])
+                        sent += 1
+                    src, dst = pending[done]
+                    start = time.time()
+                    try:
+                        size = self._recvFile(conn, dst)
+                        finish(src, dst, size, start, None)
+                    except (ADBError, IOError, OSError) as e:
+                        # the rest of the stream cannot be trusted
+                        conn.reusable = False
+                        finish(src, dst, 0, start, str(e))
+                    done += 1
+                    if not conn.reusable:
+                        # retry the remaining files on a new connection
+                        files = pending[done:]
+                        break
+            except:
+                conn.close()
+                raise
+            self.release(serial, conn)
+        # callbacks see completion order; results follow the input order
+        results.sort(key=lambda t: order[(t.src, t.dst)])
+        return results
+
+    def readFile(self, serial, path):
+        '''Returns contents of the device file, read over a sync connection'''
+        def request(conn):
+            # the device closes the connection after a failure,
+            # so _sync does not put it back into the pool
+            data = []
+            self._syncRequest(conn, self.SYNC_RECV, path)
+            self._recvData(conn, data.append)
+            return ''.join(data)
+        return self._sync(serial, request)
+
+    def push(self, serial, src, dst):
+        '''Pushes a local file to dst on the device; returns a Transfer'''
+        return self._sync(serial, lambda conn: self._push(conn, src, dst))
+
+    def _push(self, conn, src, dst):
+        start = time.time()
+        mode, size, mtime = self._statMany(conn, [dst])[0]
+        if stat.S_ISDIR(mode):
+            dst = dst.rstrip('/') + '/' + os.path.basename(src)
+        st = os.stat(src)
+        self._syncRequest(conn, self.SYNC_SEND,
+                          '%s,%d' % (dst, stat.S_IMODE(st.st_mode)))
+        size = 0
+        with open(src, 'rb') as f:
+            data = f.read(self.SYNC_DATA_MAX)
+            while data:
+                conn.send(self.SYNC_DATA + struct.pack('<I', len(data)) + data)
+                size += len(data)
+                data = f.read(self.SYNC_DATA_MAX)
+        conn.send(self.SYNC_DONE + struct.pack('<I', int(st.st_mtime)))
+        cmd, length = self._syncHeader(conn)
+        if cmd == self.SYNC_FAIL:
+            error = conn.recvExact(length)
+            conn.close()
+            return Transfer(src, dst, size, time.time() - start, error)
+        if cmd != self.SYNC_OKAY:
+            raise ADBError('unexpected sync response: ' + repr(cmd))
+        return Transfer(src, dst, size, time.time() - start, None)
+
+if __name__ == '__main__': # not module
+
+    import shutil, tempfile
+    import fastbench
+
+    server = fastbench.FakeServer({'/system/lib/libc.so': 100000},
+                                  commands={'getprop ro.serialno': 'abc\r\n',
+                                            'cat /data/blob': '\0\r\n\xff'})
+    client = Client(port=server.port)
+    serial = fastbench.SERIAL
+    tmpdir = tempfile.mkdtemp(prefix='adbclient')
+
+    def fails(func, *args):
+        try:
+            func(*args)
+        except ADBError as e:
+            return str(e)
+        return None
+
+    def pull():
+        dst = os.path.join(tmpdir, 'lib', 'libc.so')
+        transfer, = client.pullMany(serial, [('/system/lib/libc.so', dst)])
+        return transfer.error, os.path.getsize(dst)
+
+    def reconnected(func, *args):
+        # pooled connections are closed by the server before func runs
+        client.stat(serial, '/')
+        server.disconnect()
+        time.sleep(0.1)
+        return func(*args)
+
+    # (description, function, expected result)
+    TESTS = [
+        ('version', client.version, 31),
+        ('devices', client.devices, [(serial, 'device')]),
+        ('shell', lambda: client.shell(serial, 'getprop ro.serialno'),
+         'abc\r\n'),
+        ('exec', lambda: client.execOut(serial, 'cat /data/blob'),
+         '\0\r\n\xff'),
+        ('stat', lambda: client.stat(serial, '/system/lib/libc.so')[1:2],
+         (100000,)),
+        ('stat missing', lambda: client.stat(serial, '/none')[0], 0),
+        ('forward', lambda: client.forward(serial, 'tcp:5039', 'tcp:5039'),
+         None),
+        ('pull', pull, (None, 100000)),
+        ('read missing', lambda: fails(client.readFile, serial, '/none'),
+         'No such file or directory'),
+        ('unknown service', lambda: fails(client.shell, serial, 'reboot'),
+         'unsupported'),
+        ('unknown device', lambda: fails(client.shell, 'none', 'ls'),
+         "device 'none' not found"),
+        ('unknown forward device',
+         lambda: fails(client.forward, 'none', 'tcp:5039', 'tcp:5039'),
+         "device 'none' not found"),
+        ('stale stat', lambda: reconnected(client.stat, serial,
+                                           '/system/lib/libc.so')[1:2],
+         (100000,)),
+        ('stale pull', lambda: reconnected(pull), (None, 100000)),
+    ]
+
+    failed = 0
+    try:
+        for name, func, expected in TESTS:
+            try:
+                result = func()
+            except ADBError as e:
+                result = e
+            if result != expected:
+                failed += 1
+                print 'FAIL %s: expected %r, got %r' % (name, expected, result)
+        # a port nothing listens on
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        unreachable = Client(port=sock.getsockname()[1])
+        sock.close()
+        try:
+            unreachable.version()
+            failed += 1
+            print 'FAIL unreachable: no error'
+        except ServerUnreachable:
+            pass
+    finally:
+        client.close()
+        server.close()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    print '%d of %d tests passed' % (len(TESTS) + 1 - failed, len(TESTS) + 1)
+    exit(1 if failed else 0)
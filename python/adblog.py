@@ -3,7 +3,7 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-import gdb, adb, feninit, threading, sys, os, cStringIO, collections
+import gdb, adb, feninit, threading, sys, os, collections
 
 ADBLogEntry = collections.namedtuple('ADBLogEntry',
         ['date', 'time', 'pid', 'tid', 'priority', 'tag', 'text']);
@@ -80,19 +80,19 @@ log_redirect = LogRedirect()
 
 class ADBLog(threading.Thread):
 
-    def _parseLog(self, logFile):
+    def _parseLog(self, logLines):
         wholeLog = ''
         while 'gecko' not in wholeLog and 'fennec' not in wholeLog:
             line = ''
             while not line.startswith('['):
-                line = logFile.readline()
+                line = next(logLines, '')
                 if not line:
                     raise StopIteration()
             # line == '[ DAY TIME PID:TID PRIO/TAG ]'
             items = line.strip('[] \t\r\n').split()
             text = []
             while True:
-                line = logFile.readline()
+                line = next(logLines, '')
                 if not line:
                     raise StopIteration()
                 line = line.strip()
@@ -118,7 +118,7 @@ class ADBLog(threading.Thread):
         logcatArgs = ['-v', 'long']
 
         logCount = 0
-        dump = cStringIO.StringIO(adb.call(['logcat', '-d'] + logcatArgs))
+        dump = adb.stream(['logcat', '-d'] + logcatArgs)
         try:
             while True: # parse until the end of log
                 self._parseLog(dump)
@@ -137,8 +137,9 @@ class ADBLog(threading.Thread):
     def run(self):
         try:
             global log_filter
+            logLines = iter(self.logcat.stdout.readline, '')
             while self.logcat.poll() == None:
-                entry = self._parseLog(self.logcat.stdout)
+                entry = self._parseLog(logLines)
                 if self.skipCount:
                     self.skipCount -= 1
                     continue
@@ -44,3 +44,22 @@ class ADBDevice(gdb.Parameter):
 
 device = ADBDevice()
 
+
+class ADBJobs(gdb.Parameter):
+    '''Set the number of threads running background ADB requests'''
+    set_doc = 'Set number of background ADB request threads'
+    show_doc = 'Show number of background ADB request threads'
+
+    def __init__(self):
+        super(ADBJobs, self).__init__('adb-jobs',
+                gdb.COMMAND_SUPPORT, gdb.PARAM_ZINTEGER)
+        self.value = 4
+
+    def get_set_string(self):
+        self.value = max(1, self.value)
+        return 'Using ' + str(self.value) + ' background ADB threads'
+
+    def get_show_string(self, svalue):
+        return 'Using ' + svalue + ' background ADB threads'
+
+jobs = ADBJobs()
@@ -0,0 +1,197 @@
+# vi: set tabstop=4 shiftwidth=4 expandtab:
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import gdb, os, sys, time, threading, json
+
+# bucket i of the latency histogram counts requests taking under 2**i ms
+HISTOGRAM_BUCKETS = 18
+
+# frames in these modules are skipped when looking for the call site
+INTERNAL_MODULES = ('adb', 'adbclient', 'adbstats', 'threading')
+
+class Stats(object):
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.max = 0.0
+        self.bytes = 0
+        self.codes = {}
+        self.histogram = [0] * HISTOGRAM_BUCKETS
+
+    def add(self, seconds, code, nbytes):
+        self.count += 1
+        self.seconds += seconds
+        self.max = max(self.max, seconds)
+        self.bytes += nbytes
+        self.codes[code] = self.codes.get(code, 0) + 1
+        bucket = 0
+        while bucket < HISTOGRAM_BUCKETS - 1 and \
+                seconds * 1000 >= (1 << bucket):
+            bucket += 1
+        self.histogram[bucket] += 1
+
+    def toDict(self):
+        return {'count': self.count, 'seconds': self.seconds,
+                'max': self.max, 'bytes': self.bytes,
+                'codes': dict((str(k), v) for k, v in self.codes.iteritems()),
+                'histogram': self.histogram}
+
+def _callSite():
+    frame = sys._getframe(2)
+    while frame and os.path.splitext(os.path.basename(
+            frame.f_code.co_filename))[0] in INTERNAL_MODULES:
+        frame = frame.f_back
+    if not frame:
+        return '<background>'
+    return '%s:%d (%s)' % (os.path.basename(frame.f_code.co_filename),
+                           frame.f_lineno, frame.f_code.co_name)
+
+def _argClass(kind, args):
+    # request kind, plus the command name for shell commands
+    words = [str(a) for a in args] if isinstance(args, (list, tuple)) \
+            else str(args).split()
+    prefix = ''
+    if kind in ('call', 'stream') and words:
+        prefix = '' if kind == 'call' else kind + ' '
+        kind, words = words[0], words[1:]
+    if kind in ('shell', 'exec-out', 'exec_out') and words:
+        kind += ' ' + (words[0].split() or [''])[0]
+    return prefix + kind
+
+class Recorder(object):
+    '''Aggregates timing of adb requests by call site and request class'''
+
+    def __init__(self):
+        self.enabled = True
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.sites = {}
+            self.total = Stats()
+            self.since = time.time()
+
+    def begin(self):
+        '''Returns start time to pass to record(), or None if disabled'''
+        return time.time() if self.enabled else None
+
+    def record(self, start, kind, args, code=0, nbytes=0):
+        if start is None:
+            return
+        self.add(kind, args, time.time() - start, code, nbytes)
+
+    def add(self, kind, args, seconds, code=0, nbytes=0):
+        key = (_callSite(), _argClass(kind, args))
+        with self._lock:
+            if key not in self.sites:
+                self.sites[key] = Stats()
+            self.sites[key].add(seconds, code, nbytes)
+            self.total.add(seconds, code, nbytes)
+
+    def toDict(self):
+        with self._lock:
+            return {'since': self.since, 'total': self.total.toDict(),
+                    'sites': [dict(site=k[0], request=k[1], **v.toDict())
+                              for k, v in self.sites.iteritems()]}
+
+recorder = Recorder()
+
+class RecordStats(gdb.Parameter):
+    '''Set whether to record timing of adb requests for "adb-stats"'''
+    set_doc = 'Enable or disable recording adb request statistics'
+    show_doc = 'Show whether adb request statistics are recorded'
+
+    def __init__(self):
+        super(RecordStats, self).__init__('adb-record-stats',
+                gdb.COMMAND_SUPPORT, gdb.PARAM_BOOLEAN)
+        self.value = True
+        self.get_set_string()
+
+    def get_set_string(self):
+        recorder.enabled = bool(self.value)
+        return ('Recording' if self.value else 'Not recording') + \
+                ' adb request statistics'
+
+    def get_show_string(self, svalue):
+        return 'Currently ' + ('' if self.value else 'not ') + \
+                'recording adb request statistics'
+
+record_stats = RecordStats()
+
+class ADBStats(gdb.Command):
+    '''Show adb request statistics
+
+adb-stats [COUNT]      show the COUNT call sites with most total latency
+adb-stats json [FILE]  dump all statistics as JSON to FILE or the terminal
+adb-stats reset        clear statistics'''
+
+    def __init__(self):
+        super(ADBStats, self).__init__('adb-stats', gdb.COMMAND_SUPPORT)
+
+    def complete(self, text, word):
+        return gdb.COMPLETE_NONE
+
+    def _printHistogram(self, histogram):
+        print 'Latency histogram:'
+        peak = max(histogram) or 1
+        for i in range(len(histogram)):
+            if not histogram[i]:
+                continue
+            print '  %8s %6d %s' % ('<%dms' % (1 << i)
+                    if i < len(histogram) - 1 else '>=%dms' % (1 << (i - 1)),
+                    histogram[i], '#' * (histogram[i] * 40 / peak))
+
+    def invoke(self, argument, from_tty):
+        self.dont_repeat()
+        args = gdb.string_to_argv(argument)
+        if args and args[0] == 'reset':
+            recorder.reset()
+            print 'Cleared adb request statistics.'
+            return
+        import adb
+        data = recorder.toDict()
+        data['cache'] = dict(adb.cache_stats)
+        if args and args[0] == 'json':
+            if len(args) < 2:
+                print json.dumps(data, indent=2, sort_keys=True)
+                return
+            path = os.path.abspath(os.path.expanduser(args[1]))
+            try:
+                with open(path, 'w') as f:
+                    json.dump(data, f, indent=2, sort_keys=True)
+            except IOError as e:
+                raise gdb.GdbError('cannot write statistics: ' + str(e))
+            print 'Wrote adb request statistics to %s.' % path
+            return
+        try:
+            count = int(args[0]) if args else 10
+        except ValueError:
+            raise gdb.GdbError('invalid argument: ' + args[0])
+
+        total = data['total']
+        print '%d adb requests taking %.3fs over the last %ds' % (
+                total['count'], total['seconds'], time.time() - data['since'])
+        if not record_stats.value:
+            print '(recording is off; use "set adb-record-stats on")'
+        if not total['count']:
+            return
+        print 'Cache: %d hits, %d misses' % (data['cache']['hits'],
+                                             data['cache']['misses'])
+        print '%9s %6s %9s %9s %10s %6s  %s' % ('total(s)', 'count',
+                'mean(ms)', 'max(ms)', 'bytes', 'errors', 'request @ site')
+        sites = sorted(data['sites'], key=lambda s: -s['seconds'])
+        for site in sites[0: count]:
+            errors = sum(v for k, v in site['codes'].iteritems() if k != '0')
+            print '%9.3f %6d %9.1f %9.1f %10d %6d  %s @ %s' % (
+                    site['seconds'], site['count'],
+                    site['seconds'] * 1000 / site['count'],
+                    site['max'] * 1000, site['bytes'], errors,
+                    site['request'], site['site'])
+        if len(sites) > count:
+            print '(%d more)' % (len(sites) - count)
+        self._printHistogram(total['histogram'])
+
+default = ADBStats()
@@ -0,0 +1,483 @@
+# vi: set tabstop=4 shiftwidth=4 expandtab:
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Decoder for the ARM and Thumb instructions tracebt interprets when
+# unwinding: branches, push/pop, ldm/stm and vpush/vpop on sp, and
+# add/sub/mov/adr. Instructions are given in the form of gdb's lowercased
+# disassembly without width qualifiers, so tracebt can use them in place
+# of disassembled text. Instructions that do not change pc, sp or the
+# registers tracebt tracks have an empty mnemonic, and instructions the
+# decoder does not understand are left for gdb to disassemble.
+# This module does not depend on gdb, so it can be used outside of gdb.
+
+import re, struct
+
+REGS = ['r0', 'r1', 'r2', 'r3', 'r4', 'r5', 'r6', 'r7',
+        'r8', 'r9', 'sl', 'fp', 'ip', 'sp', 'lr', 'pc']
+CONDS = ['eq', 'ne', 'cs', 'cc', 'mi', 'pl', 'vs', 'vc',
+         'hi', 'ls', 'ge', 'lt', 'gt', 'le', '', '']
+SHIFTS = ['lsl', 'lsr', 'asr', 'ror']
+
+SP = 13
+PC = 15
+
+# instruction that does not matter for unwinding
+IGNORED = ('', '')
+
+# addresses in arguments, as opposed to '#' immediates; addresses made
+# relative to a library's code are negative below it, e.g. in .plt
+RE_ADDRESS = re.compile(r'(?<![#\w-])-?0x[\da-f]+')
+
+def _signExtend(value, bits):
+    return value - (1 << bits) if value & (1 << (bits - 1)) else value
+
+def _ror(value, amount):
+    amount %= 32
+    return ((value >> amount) | (value << (32 - amount))) & 0xffffffff
+
+def _regList(mask):
+    return '{' + ', '.join(REGS[i] for i in range(16) if mask & (1 << i)) + '}'
+
+def _vregList(first, count, double):
+    prefix = 'd' if double else 's'
+    if count == 1:
+        return '{%s%d}' % (prefix, first)
+    return '{%s%d-%s%d}' % (prefix, first, prefix, first + count - 1)
+
+def _shift(kind, amount):
+    # shift of a register operand by an immediate, as ', lsl #2'
+    if kind == 0 and amount == 0:
+        return ''
+    if kind == 3 and amount == 0:
+        return ', rrx'
+    return ', %s #%d' % (SHIFTS[kind], amount or 32)
+
+def _vfpStack(hw1, hw2):
+    # vpush/vpop, from the two halves of the vstmdb/vldmia encoding;
+    # returns None for other coprocessor instructions
+    double = (hw2 & 0x0f00) == 0x0b00
+    if (hw2 & 0x0e00) != 0x0a00 or (double and hw2 & 1):
+        return None
+    d = (hw1 >> 6) & 1
+    vd = (hw2 >> 12) & 0xf
+    first = (d << 4 | vd) if double else (vd << 1 | d)
+    count = (hw2 & 0xff) / 2 if double else hw2 & 0xff
+    if (hw1 & 0x0fbf) == 0x0d2d:
+        return 'vpush', _vregList(first, count, double)
+    if (hw1 & 0x0fbf) == 0x0cbd:
+        return 'vpop', _vregList(first, count, double)
+    return None
+
+def _thumbExpandImm(imm12):
+    if not imm12 & 0xc00:
+        byte = imm12 & 0xff
+        return [byte, byte << 16 | byte, byte << 24 | byte << 8,
+                byte * 0x01010101][(imm12 >> 8) & 3]
+    return _ror(0x80 | (imm12 & 0x7f), imm12 >> 7)
+
+def decodeThumb16(hw, pc):
+    '''Decodes the 16-bit Thumb instruction hw at pc;
+       returns (mnemonic, args), or None if not understood'''
+    if hw & 0xf800 == 0xe000:
+        return 'b', hex(pc + 4 + _signExtend((hw & 0x7ff) << 1, 12))
+    if hw & 0xf000 == 0xd000:
+        cond = (hw >> 8) & 0xf
+        if cond >= 14:
+            # udf and svc
+            return IGNORED
+        return 'b' + CONDS[cond], \
+               hex(pc + 4 + _signExtend((hw & 0xff) << 1, 9))
+    if hw & 0xf500 == 0xb100:
+        offset = ((hw >> 9) & 1) << 6 | ((hw >> 3) & 0x1f) << 1
+        return 'cbnz' if hw & 0x800 else 'cbz', \
+               '%s, %s' % (REGS[hw & 7], hex(pc + 4 + offset))
+    if hw & 0xfe00 == 0xb400:
+        return 'push', _regList((hw & 0xff) | (hw & 0x100) << 6)
+    if hw & 0xfe00 == 0xbc00:
+        return 'pop', _regList((hw & 0xff) | (hw & 0x100) << 7)
+    if hw & 0xff80 == 0xb000:
+        return 'add', 'sp, #%d' % ((hw & 0x7f) << 2)
+    if hw & 0xff80 == 0xb080:
+        return 'sub', 'sp, #%d' % ((hw & 0x7f) << 2)
+    if hw & 0xf800 == 0xa000:
+        # adr is relative to the word-aligned pc
+        return 'adr', '%s, %s' % (REGS[(hw >> 8) & 7],
+                                  hex(((pc + 4) & ~3) + ((hw & 0xff) << 2)))
+    if hw & 0xf800 == 0xa800:
+        return 'add', '%s, sp, #%d' % (REGS[(hw >> 8) & 7], (hw & 0xff) << 2)
+    if hw & 0xff00 == 0x4700:
+        return 'blx' if hw & 0x80 else 'bx', REGS[(hw >> 3) & 0xf]
+    if hw & 0xfd00 == 0x4400:
+        rd = (hw & 7) | (hw >> 4) & 8
+        return 'mov' if hw & 0x200 else 'add', \
+               '%s, %s' % (REGS[rd], REGS[(hw >> 3) & 0xf])
+    # everything else only writes low registers, flags or memory
+    return IGNORED
+
+def decodeThumb32(hw1, hw2, pc):
+    '''Decodes the 32-bit Thumb instruction hw1:hw2 at pc;
+       returns (mnemonic, args), or None if not understood'''
+    if hw1 & 0xf800 == 0xf000 and hw2 & 0x8000:
+        # branches and miscellaneous control
+        s = (hw1 >> 10) & 1
+        j1 = (hw2 >> 13) & 1
+        j2 = (hw2 >> 11) & 1
+        if hw2 & 0x5000:
+            offset = _signExtend(s << 24 | (1 ^ j1 ^ s) << 23 |
+                    (1 ^ j2 ^ s) << 22 | (hw1 & 0x3ff) << 12 |
+                    (hw2 & 0x7ff) << 1, 25)
+            if hw2 & 0x5000 == 0x1000:
+                return 'b', hex(pc + 4 + offset)
+            if hw2 & 0x5000 == 0x5000:
+                return 'bl', hex(pc + 4 + offset)
+            return 'blx', hex(((pc + 4) & ~3) + offset)
+        cond = (hw1 >> 6) & 0xf
+        if cond < 14:
+            offset = _signExtend(s << 20 | j2 << 19 | j1 << 18 |
+                    (hw1 & 0x3f) << 12 | (hw2 & 0x7ff) << 1, 21)
+            return 'b' + CONDS[cond], hex(pc + 4 + offset)
+        # subs pc, lr returns from exceptions
+        return None if hw1 == 0xf3de else IGNORED
+
+    rd = (hw2 >> 8) & 0xf
+    rn = hw1 & 0xf
+    flags = 's' if hw1 & 0x10 else ''
+    if hw1 & 0xfe40 == 0xe800:
+        # load and store multiple
+        mode = (hw1 >> 7) & 3
+        writeback = hw1 & 0x20
+        load = hw1 & 0x10
+        if rn == SP and writeback and mode == 1 and load:
+            return 'pop', _regList(hw2)
+        if rn == SP and writeback and mode == 2 and not load:
+            return 'push', _regList(hw2)
+        if mode in (0, 3) and load or rn == SP and writeback or \
+                load and hw2 & (1 << PC | 1 << SP):
+            return None
+        return IGNORED
+    if hw1 & 0xfe40 == 0xe840:
+        # load and store dual or exclusive, and table branches
+        return IGNORED
+    if hw1 & 0xfe00 == 0xea00 or hw1 & 0xfa00 == 0xf000 and \
+            not hw2 & 0x8000:
+        # data processing with shifted register or modified immediate
+        op = (hw1 >> 5) & 0xf
+        if hw1 & 0x1000:
+            operand = '#%d' % _thumbExpandImm((hw1 >> 10 & 1) << 11 |
+                                              (hw2 >> 12 & 7) << 8 |
+                                              hw2 & 0xff)
+            shifted = False
+        else:
+            amount = (hw2 >> 12 & 7) << 2 | (hw2 >> 6) & 3
+            operand = REGS[hw2 & 0xf] + _shift((hw2 >> 4) & 3, amount)
+            shifted = bool(amount or hw2 & 0x30)
+        if rd == PC and flags and op in (0, 4, 8, 13):
+            # tst, teq, cmn and cmp
+            return IGNORED
+        if op == 8:
+            return 'add' + flags, '%s, %s, %s' % (REGS[rd], REGS[rn], operand)
+        if op == 13:
+            return 'sub' + flags, '%s, %s, %s' % (REGS[rd], REGS[rn], operand)
+        if op == 2 and rn == PC and not shifted:
+            return 'mov' + flags, '%s, %s' % (REGS[rd], operand)
+        return None if rd in (SP, PC) else IGNORED
+    if hw1 & 0xfa00 == 0xf200 and not hw2 & 0x8000:
+        # data processing with plain binary immediate
+        op = (hw1 >> 4) & 0x1f
+        imm12 = (hw1 >> 10 & 1) << 11 | (hw2 >> 12 & 7) << 8 | hw2 & 0xff
+        if op in (0x00, 0x0a) and rn == PC:
+            return 'adr', '%s, %s' % (REGS[rd], hex(((pc + 4) & ~3) +
+                                      (imm12 if op == 0 else -imm12)))
+        if op in (0x00, 0x0a):
+            return 'addw' if op == 0 else 'subw', \
+                   '%s, %s, #%d' % (REGS[rd], REGS[rn], imm12)
+        if op == 0x04:
+            return 'movw', '%s, #%d' % (REGS[rd], (hw1 & 0xf) << 12 | imm12)
+        return None if rd in (SP, PC) else IGNORED
+    if hw1 & 0xff00 == 0xf900:
+        # advanced SIMD element and structure loads and stores
+        return IGNORED
+    if hw1 & 0xfe00 == 0xf800:
+        # single loads and stores
+        rt = hw2 >> 12
+        load = hw1 & 0x10
+        size = (hw1 >> 5) & 3
+        if load and rt in (SP, PC) and (size == 2 or rt == SP):
+            return None
+        # single register push and pop
+        if rn == SP and not hw1 & 0x80 and hw2 & 0x0900 == 0x0900:
+            return None
+        return IGNORED
+    if hw1 & 0xff00 in (0xfa00, 0xfb00):
+        # data processing with registers, and multiplies
+        return None if hw1 & 0xff00 == 0xfa00 and rd in (SP, PC) \
+               else IGNORED
+    if hw1 & 0xec00 == 0xec00:
+        # coprocessor and floating point
+        vfp = _vfpStack(hw1, hw2)
+        if vfp:
+            return vfp
+        if hw1 & 0xee00 == 0xec00 and rn == SP and hw1 & 0x20:
+            return None
+        if hw1 & 0xef10 == 0xee10 and hw2 & 0x10 and hw2 >> 12 == SP:
+            return None
+        return IGNORED
+    return IGNORED
+
+def decodeArm(word, pc):
+    '''Decodes the ARM instruction word at pc;
+       returns (mnemonic, args), or None if not understood'''
+    cond = word >> 28
+    if cond == 15:
+        if word & 0x0e000000 == 0x0a000000:
+            offset = _signExtend((word & 0xffffff) << 2 |
+                                 (word >> 23) & 2, 26)
+            return 'blx', hex(pc + 8 + offset)
+        # rfe returns from exceptions
+        return None if word & 0x0e500000 == 0x08100000 else IGNORED
+    suffix = CONDS[cond]
+    if word & 0x0ffffff0 == 0x012fff10:
+        return 'bx' + suffix, REGS[word & 0xf]
+    if word & 0x0ffffff0 == 0x012fff30:
+        return 'blx' + suffix, REGS[word & 0xf]
+    if word & 0x0e000000 == 0x0a000000:
+        offset = _signExtend((word & 0xffffff) << 2, 26)
+        return ('bl' if word & 0x01000000 else 'b') + suffix, \
+               hex(pc + 8 + offset)
+
+    rn = (word >> 16) & 0xf
+    rd = (word >> 12) & 0xf
+    load = word & 0x00100000
+    writeback = word & 0x00200000
+    if word & 0x0e000000 == 0x08000000:
+        # load and store multiple
+        mask = word & 0xffff
+        if rn == SP and writeback and not word & 0x00400000:
+            if load and word & 0x01800000 == 0x00800000:
+                return 'pop' + suffix, _regList(mask)
+            if not load and word & 0x01800000 == 0x01000000:
+                return 'push' + suffix, _regList(mask)
+        if rn == SP and writeback or load and mask & (1 << PC | 1 << SP):
+            return None
+        return IGNORED
+    if word & 0x0c000000 == 0x04000000:
+        if word & 0x02000010 == 0x02000010:
+            # media instructions
+            return None if rd in (SP, PC) else IGNORED
+        # single loads and stores; push and pop of one register
+        if load and rd in (SP, PC) or \
+                rn == SP and (writeback or not word & 0x01000000):
+            return None
+        return IGNORED
+    if word & 0x0c000000 == 0x0c000000:
+        # coprocessor, floating point and svc
+        vfp = _vfpStack(word >> 16, word & 0xffff)
+        if vfp:
+            return vfp[0] + suffix, vfp[1]
+        if word & 0x0e000000 == 0x0c000000 and rn == SP and writeback:
+            return None
+        if word & 0x0f100010 == 0x0e100010 and rd == SP:
+            return None
+        return IGNORED
+
+    # data processing and miscellaneous
+    immediate = word & 0x02000000
+    if not immediate and word & 0x90 == 0x90:
+        # multiplies and extra loads and stores
+        return None if load and rd in (SP, PC) else IGNORED
+    op = (word >> 21) & 0xf
+    flags = 's' if word & 0x00100000 else ''
+    if op in (8, 9, 10, 11) and not flags:
+        # movw, movt, msr and miscellaneous
+        return None if rd in (SP, PC) and word & 0x0fb00000 in \
+                (0x03000000, 0x03400000) else IGNORED
+    if op in (8, 9, 10, 11):
+        # tst, teq, cmp and cmn
+        return IGNORED
+    if immediate:
+        operand = '#%d' % _ror(word & 0xff, (word >> 8 & 0xf) * 2)
+        shifted = False
+    elif word & 0x10:
+        operand = '%s, %s %s' % (REGS[word & 0xf],
+                SHIFTS[(word >> 5) & 3], REGS[(word >> 8) & 0xf])
+        shifted = True
+    else:
+        amount = (word >> 7) & 0x1f
+        operand = REGS[word & 0xf] + _shift((word >> 5) & 3, amount)
+        shifted = bool(amount or word & 0x60)
+    if rd == PC and flags:
+        # returns from exceptions
+        return None
+    if op == 4:
+        return 'add' + flags + suffix, '%s, %s, %s' % (REGS[rd], REGS[rn],
+                                                       operand)
+    if op == 2:
+        return 'sub' + flags + suffix, '%s, %s, %s' % (REGS[rd], REGS[rn],
+                                                       operand)
+    if op == 13 and not shifted:
+        return 'mov' + flags + suffix, '%s, %s' % (REGS[rd], operand)
+    return None if rd in (SP, PC) else IGNORED
+
+def _itConditions(hw):
+    # conditions of the instructions in the IT block started by hw
+    first = (hw >> 4) & 0xf
+    mask = hw & 0xf
+    count = 4 - [mask & -mask == 1 << i for i in range(4)].index(True)
+    return [first] + [first if (mask >> (4 - i)) & 1 == first & 1
+                      else first ^ 1 for i in range(1, count)]
+
+def decode(data, addr, is_thumb, end=None):
+    '''Decodes code bytes data read from addr, up to address end;
+       returns (insts, next) where insts is a list of (pc, mnemonic,
+       args) and next is the address after the last decoded instruction.
+       Decoding stops at the first instruction that is not understood'''
+    end = addr + len(data) if end is None else min(end, addr + len(data))
+    insts = []
+    pc = addr
+    it = []
+    while pc + (2 if is_thumb else 4) <= end:
+        offset = pc - addr
+        if not is_thumb:
+            result = decodeArm(struct.unpack_from('<I', data, offset)[0], pc)
+            size = 4
+        else:
+            hw = struct.unpack_from('<H', data, offset)[0]
+            if hw & 0xf800 in (0xe800, 0xf000, 0xf800):
+                if pc + 4 > end:
+                    break
+                result = decodeThumb32(hw, struct.unpack_from(
+                        '<H', data, offset + 2)[0], pc)
+                size = 4
+            else:
+                result = decodeThumb16(hw, pc)
+                size = 2
+        if result is None:
+            break
+        mnemonic, args = result
+        if it:
+            # conditional instruction in an IT block
+            cond = it.pop(0)
+            if mnemonic:
+                mnemonic += CONDS[cond]
+        if is_thumb and hw & 0xff00 == 0xbf00 and hw & 0xf:
+            it = _itConditions(hw)
+        insts.append((pc, mnemonic, args))
+        pc += size
+    return insts, pc
+
+def relocate(insts, delta):
+    '''Returns instructions (pc, mnemonic, args) moved by delta bytes,
+       including addresses in their arguments'''
+    return [(pc + delta, mnemonic, RE_ADDRESS.sub(
+            lambda m: hex(int(m.group(0), 16) + delta), args))
+            for pc, mnemonic, args in insts]
+
+if __name__ == '__main__': # not module
+
+    # (thumb, address, code, expected instructions)
+    TESTS = [
+        (True, 0x1000, 'b5f0', [('push', '{r4, r5, r6, r7, lr}')]),
+        (True, 0x1000, 'bdf0', [('pop', '{r4, r5, r6, r7, pc}')]),
+        (True, 0x1000, 'b082', [('sub', 'sp, #8')]),
+        (True, 0x1000, 'b002', [('add', 'sp, #8')]),
+        (True, 0x1000, 'af03', [('add', 'r7, sp, #12')]),
+        (True, 0x1000, 'a001', [('adr', 'r0, 0x1008')]),
+        (True, 0x1002, 'a001', [('adr', 'r0, 0x1008')]),
+        (True, 0x1002, 'f20f 0304', [('adr', 'r3, 0x1008')]),
+        (True, 0x1002, 'f2af 0304', [('adr', 'r3, 0x1000')]),
+        (True, 0x1000, '466f', [('mov', 'r7, sp')]),
+        (True, 0x1000, '46bd', [('mov', 'sp, r7')]),
+        (True, 0x1000, '4770', [('bx', 'lr')]),
+        (True, 0x1000, '4798', [('blx', 'r3')]),
+        (True, 0x1000, 'e7fe', [('b', '0x1000')]),
+        (True, 0x1000, 'd0fe', [('beq', '0x1000')]),
+        (True, 0x1000, 'b10b', [('cbz', 'r3, 0x1006')]),
+        (True, 0x1000, 'b93b', [('cbnz', 'r3, 0x1012')]),
+        (True, 0x1000, '2001', [('', '')]),
+        (True, 0x1000, 'bf08 bd10', [('', ''), ('popeq', '{r4, pc}')]),
+        (True, 0x1000, 'bf0c 4770 2001',
+         [('', ''), ('bxeq', 'lr'), ('', '')]),
+        (True, 0x1000, 'e92d 4ff0',
+         [('push', '{r4, r5, r6, r7, r8, r9, sl, fp, lr}')]),
+        (True, 0x1000, 'e8bd 8ff0',
+         [('pop', '{r4, r5, r6, r7, r8, r9, sl, fp, pc}')]),
+        (True, 0x1000, 'ed2d 8b10', [('vpush', '{d8-d15}')]),
+        (True, 0x1000, 'ecbd 8b10', [('vpop', '{d8-d15}')]),
+        (True, 0x1000, 'ed2d 8a01', [('vpush', '{s16}')]),
+        (True, 0x1000, 'f000 f800', [('bl', '0x1004')]),
+        (True, 0x1000, 'f7ff bffe', [('b', '0x1000')]),
+        (True, 0x1000, 'f000 8000', [('beq', '0x1004')]),
+        (True, 0x1000, 'f1ad 0d08', [('sub', 'sp, sp, #8')]),
+        (True, 0x1000, 'f10d 0708', [('add', 'r7, sp, #8')]),
+        (True, 0x1000, 'eb0d 0701', [('add', 'r7, sp, r1')]),
+        (True, 0x1000, 'f5ad 7d00', [('sub', 'sp, sp, #512')]),
+        (True, 0x1000, 'f2ad 4d04', [('subw', 'sp, sp, #1028')]),
+        (True, 0x1000, 'ea4f 0d07', [('mov', 'sp, r7')]),
+        (True, 0x1000, 'f8d4 e000', [('', '')]),
+        (True, 0x1000, 'f85d fb04', []),
+        (True, 0x1000, 'b500 f85d fb04', [('push', '{lr}')]),
+        (True, 0x1000, 'f000', []),
+        (True, 0x1000, 'b5f0 00', [('push', '{r4, r5, r6, r7, lr}')]),
+        (False, 0x1000, 'e92d4800 10 bd', [('push', '{fp, lr}')]),
+        (False, 0x1000, 'e92d4800', [('push', '{fp, lr}')]),
+        (False, 0x1000, 'e8bd8800', [('pop', '{fp, pc}')]),
+        (False, 0x1000, 'e12fff1e', [('bx', 'lr')]),
+        (False, 0x1000, '012fff1e', [('bxeq', 'lr')]),
+        (False, 0x1000, 'e12fff33', [('blx', 'r3')]),
+        (False, 0x1000, 'e24dd008', [('sub', 'sp, sp, #8')]),
+        (False, 0x1000, 'e28db004', [('add', 'fp, sp, #4')]),
+        (False, 0x1000, 'e24ddb01', [('sub', 'sp, sp, #1024')]),
+        (False, 0x1000, 'e1a0d00b', [('mov', 'sp, fp')]),
+        (False, 0x1000, 'e3a00001', [('mov', 'r0, #1')]),
+        (False, 0x1000, 'e0811002', [('add', 'r1, r1, r2')]),
+        (False, 0x1000, 'e0811102', [('add', 'r1, r1, r2, lsl #2')]),
+        (False, 0x1000, 'eafffffe', [('b', '0x1000')]),
+        (False, 0x1000, 'ebfffffe', [('bl', '0x1000')]),
+        (False, 0x1000, '0a000000', [('beq', '0x1008')]),
+        (False, 0x1000, 'fa000000', [('blx', '0x1008')]),
+        (False, 0x1000, 'ed2d8b10', [('vpush', '{d8-d15}')]),
+        (False, 0x1000, 'ecbd8b10', [('vpop', '{d8-d15}')]),
+        (False, 0x1000, 'e59f0004', [('', '')]),
+        (False, 0x1000, 'e1500001', [('', '')]),
+        (False, 0x1000, 'e49df004', []),
+        (False, 0x1000, 'e52de004', []),
+        (False, 0x1000, 'e1b0f00e', []),
+    ]
+
+    failed = 0
+    for is_thumb, addr, code, expected in TESTS:
+        # code is written as halfwords for Thumb and words for ARM,
+        # or as single bytes to test truncated code
+        data = ''.join(struct.pack('<B' if len(x) == 2 else
+                                   '<H' if is_thumb else '<I', int(x, 16))
+                       for x in code.split())
+        insts, next = decode(data, addr, is_thumb)
+        result = [(mnemonic, args) for pc, mnemonic, args in insts]
+        if result != expected:
+            failed += 1
+            print 'FAIL %s %s: expected %s, got %s' % (
+                    'thumb' if is_thumb else 'arm', code, expected, result)
+
+    # (instructions, delta, expected instructions) relocated to and
+    # from offsets in a library, whose targets can be below its code
+    RELOCATIONS = [
+        ([(0x1000, 'b', '0xf80')], -0x1000, [(0, 'b', '-0x80')]),
+        ([(0, 'b', '-0x80')], 0x1000, [(0x1000, 'b', '0xf80')]),
+        ([(0x1000, 'cbz', 'r3, 0x1006')], -0x1000,
+         [(0, 'cbz', 'r3, 0x6')]),
+        ([(0x1000, 'ldr', 'r0, [pc, #-0x10]')], 0x1000,
+         [(0x2000, 'ldr', 'r0, [pc, #-0x10]')]),
+        ([(0x1000, 'add', 'r7, sp, #0x8')], 0x1000,
+         [(0x2000, 'add', 'r7, sp, #0x8')]),
+    ]
+    for insts, delta, expected in RELOCATIONS:
+        result = relocate(insts, delta)
+        if result != expected:
+            failed += 1
+            print 'FAIL relocate %s by %d: expected %s, got %s' % (
+                    insts, delta, expected, result)
+    count = len(TESTS) + len(RELOCATIONS)
+    print '%d of %d tests passed' % (count - failed, count)
+    exit(1 if failed else 0)
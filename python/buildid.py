@@ -0,0 +1,246 @@
+# vi: set tabstop=4 shiftwidth=4 expandtab:
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Index of GNU build-ids of local ELF files, read from the note headers
+# only and refreshed by mtime, plus a .build-id tree for gdb's
+# debug-file-directory. This module does not depend on gdb, so it can be
+# used outside of gdb.
+
+import os, mmap, struct, json, threading, time
+
+PT_NOTE = 4
+NT_GNU_BUILD_ID = 3
+# bytes read from the start of remote files to find their build-id
+HEAD_SIZE = 4096
+# longest device command used to read remote file heads
+MAX_COMMAND = 3000
+
+def _findNote(data, offset, size, endian):
+    end = min(offset + size, len(data))
+    while offset + 12 <= end:
+        namesz, descsz, notetype = struct.unpack(endian + 'III',
+                                                 data[offset: offset + 12])
+        name = offset + 12
+        desc = name + ((namesz + 3) & ~3)
+        if notetype == NT_GNU_BUILD_ID and \
+                data[name: name + namesz] == 'GNU\0' and desc + descsz <= end:
+            return data[desc: desc + descsz].encode('hex')
+        offset = desc + ((descsz + 3) & ~3)
+    return None
+
+def parseBuildId(data):
+    '''Returns the build-id of ELF contents in data as a hex string, or
+       None; data is a string or mmap, and can be just the file's start'''
+    if len(data) < 52 or data[0: 4] != '\x7fELF':
+        return None
+    is64 = data[4] == '\x02'
+    endian = '<' if data[5] == '\x01' else '>'
+    try:
+        if is64:
+            phoff, = struct.unpack(endian + 'Q', data[32: 40])
+            phentsize, phnum = struct.unpack(endian + 'HH', data[54: 58])
+        else:
+            phoff, = struct.unpack(endian + 'I', data[28: 32])
+            phentsize, phnum = struct.unpack(endian + 'HH', data[42: 46])
+        for i in range(phnum):
+            ph = phoff + i * phentsize
+            if ph + phentsize > len(data):
+                break
+            if is64:
+                ptype, flags, offset, vaddr, paddr, size = struct.unpack(
+                        endian + 'IIQQQQ', data[ph: ph + 40])
+            else:
+                ptype, offset, vaddr, paddr, size = struct.unpack(
+                        endian + 'IIIII', data[ph: ph + 20])
+            if ptype == PT_NOTE:
+                buildId = _findNote(data, offset, size, endian)
+                if buildId:
+                    return buildId
+    except struct.error:
+        pass
+    return None
+
+def readBuildId(path):
+    '''Returns the build-id of the ELF file at path, or None'''
+    try:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < 52:
+                return None
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return parseBuildId(data)
+            finally:
+                data.close()
+    except (IOError, OSError, ValueError, mmap.error):
+        return None
+
+def remoteBuildIds(device, paths, sizes):
+    '''Reads build-ids of device files through device.exec_out, reading
+       the start of many files per command; sizes maps each path to its
+       size, and paths without a size are skipped. Returns a dict of
+       path to build-id'''
+    paths = [p for p in paths if sizes.get(p)]
+    ids = {}
+    while paths:
+        batch = []
+        length = 0
+        while paths and (not batch or length < MAX_COMMAND):
+            batch.append(paths.pop(0))
+            length += len(batch[-1]) + 40
+        data = device.exec_out('; '.join(
+                'dd if=%s bs=%d count=1 2>/dev/null' % (p, HEAD_SIZE)
+                for p in batch))
+        # a file that could not be read shifts every file after it
+        if len(data) != sum(min(HEAD_SIZE, sizes[p]) for p in batch):
+            continue
+        offset = 0
+        for p in batch:
+            head = data[offset: offset + min(HEAD_SIZE, sizes[p])]
+            offset += len(head)
+            buildId = parseBuildId(head)
+            if buildId:
+                ids[p] = buildId
+    return ids
+
+class BuildIdIndex(object):
+    '''Build-ids of ELF files under dirs, saved under root along with a
+       .build-id tree of links to the files; disabled if root is None'''
+
+    def __init__(self, root=None):
+        self.root = root
+        # directories to index, in order of preference for files with
+        # the same build-id
+        self.dirs = []
+        # path to [mtime, size, build-id]
+        self.files = {}
+        # build-id to path
+        self.ids = {}
+        # time the last walk of dirs started
+        self.updated = 0
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _treeDir(self):
+        return os.path.join(self.root, '.build-id')
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            with open(os.path.join(self._treeDir(), 'index.json'), 'r') as f:
+                self.files = json.load(f)
+        except (IOError, ValueError):
+            self.files = {}
+
+    def _save(self):
+        path = os.path.join(self._treeDir(), 'index.json')
+        try:
+            if not os.path.isdir(self._treeDir()):
+                os.makedirs(self._treeDir())
+            with open(path + '.tmp', 'w') as f:
+                json.dump(self.files, f)
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError):
+            pass
+
+    def _scan(self, d):
+        # yields paths of files under d, skipping hidden directories
+        # such as the library cache and the .build-id tree
+        for dirpath, dirnames, filenames in os.walk(d):
+            dirnames[:] = [n for n in dirnames if not n.startswith('.')]
+            for name in filenames:
+                if not name.startswith('.') and not name.endswith('.part'):
+                    yield os.path.join(dirpath, name)
+
+    def _updateTree(self):
+        # links at .build-id/xx/yyyy.debug, as gdb looks them up
+        tree = self._treeDir()
+        for buildId, path in self.ids.iteritems():
+            link = os.path.join(tree, buildId[0: 2], buildId[2:] + '.debug')
+            try:
+                if os.path.islink(link) and os.readlink(link) == path:
+                    continue
+                if not os.path.isdir(os.path.dirname(link)):
+                    os.makedirs(os.path.dirname(link))
+                if os.path.lexists(link):
+                    os.remove(link)
+                os.symlink(path, link)
+            except OSError:
+                pass
+        for dirpath, dirnames, filenames in os.walk(tree):
+            for name in filenames:
+                buildId = os.path.basename(dirpath) + name[: -len('.debug')]
+                if name.endswith('.debug') and buildId not in self.ids:
+                    try:
+                        os.remove(os.path.join(dirpath, name))
+                    except OSError:
+                        pass
+
+    def _index(self, path, files, ids):
+        # adds path to files and ids, reading it only if changed since
+        # it was last indexed
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        entry = self.files.get(path)
+        if not entry or entry[0] != st.st_mtime or entry[1] != st.st_size:
+            entry = [st.st_mtime, st.st_size, readBuildId(path)]
+        files[path] = entry
+        if entry[2] and entry[2] not in ids:
+            ids[entry[2]] = path
+
+    def update(self, dirs=None, since=None):
+        '''Indexes files under dirs, or under self.dirs if not given,
+           reading only files changed since they were last indexed;
+           self.dirs are not walked again if already walked at or after
+           the time since'''
+        if not self.root:
+            return
+        with self._lock:
+            if dirs is None and since is not None and self.updated >= since:
+                return
+            if dirs is None:
+                self.updated = time.time()
+            self._load()
+            files = {}
+            ids = {}
+            for d in self.dirs if dirs is None else dirs:
+                for path in self._scan(d):
+                    self._index(path, files, ids)
+            self.files = files
+            self.ids = ids
+            self._updateTree()
+            self._save()
+
+    def add(self, paths):
+        '''Indexes files at paths, e.g. files just pulled, without
+           walking any directory'''
+        if not self.root or not paths:
+            return
+        with self._lock:
+            self._load()
+            files = {}
+            ids = {}
+            for path in paths:
+                self._index(path, files, ids)
+            self.files.update(files)
+            for buildId, path in ids.iteritems():
+                # files in earlier dirs, such as objdirs, stay preferred
+                if buildId not in self.ids:
+                    self.ids[buildId] = path
+            self._updateTree()
+            self._save()
+
+    def lookup(self, buildId):
+        '''Returns the path of a local file with buildId, or None'''
+        with self._lock:
+            path = self.ids.get(buildId)
+        if path and readBuildId(path) == buildId:
+            return path
+        return None
+
+default = BuildIdIndex()
@@ -0,0 +1,254 @@
+# vi: set tabstop=4 shiftwidth=4 expandtab:
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Benchmark of fastload's pulls without a device: replays the library
+# list of a "fastload report" against a local fake adb server that serves
+# files of the recorded sizes, optionally limited to a bandwidth and
+# delayed by a latency per request to model a USB link.
+# This module does not depend on gdb, so it can be used outside of gdb.
+
+import os, socket, struct, threading, time, json
+
+import adbclient, libsync, loadstats
+
+SERIAL = 'fastbench'
+
+class Throttle(object):
+    '''Limits the bytes per second sent by all connections together'''
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self, size):
+        if not self.rate:
+            return
+        with self._lock:
+            start = max(time.time(), self._next)
+            self._next = start + size / self.rate
+            end = self._next
+        delay = end - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+class FakeServer(object):
+    '''adb server on a local port with one device, whose files are
+       given by a dict of path to size; besides pulls, shell and exec
+       commands given by a dict of command to output are supported'''
+
+    def __init__(self, sizes, bandwidth=0, latency=0.0, commands=None):
+        self.sizes = sizes
+        self.latency = latency
+        self.commands = commands or {}
+        self.throttle = Throttle(bandwidth)
+        # open connections, closed by disconnect()
+        self._conns = set()
+        self._connsLock = threading.Lock()
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(64)
+        self.port = self.sock.getsockname()[1]
+        thread = threading.Thread(name='FakeADB', target=self._serve)
+        thread.daemon = True
+        thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.error:
+                return
+            with self._connsLock:
+                self._conns.add(conn)
+            thread = threading.Thread(target=self._handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _recv(self, conn, size):
+        data = ''
+        while len(data) < size:
+            chunk = conn.recv(size - len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+
+    def _handle(self, conn):
+        try:
+            while True:
+                service = self._recv(conn, int(self._recv(conn, 4), 16))
+                if service == 'host:version':
+                    conn.sendall('OKAY0004%04x' % 31)
+                    return
+                if service == 'host:devices':
+                    conn.sendall('OKAY%04x%s\tdevice\n' % (
+                                 len(SERIAL) + 8, SERIAL))
+                    return
+                if service in ('host:transport:' + SERIAL,
+                               'host:transport-any'):
+                    conn.sendall('OKAY')
+                    continue
+                if service == 'sync:':
+                    conn.sendall('OKAY')
+                    self._sync(conn)
+                    return
+                if service.startswith('host-serial:' + SERIAL + ':forward:'):
+                    conn.sendall('OKAYOKAY')
+                    return
+                if service.startswith(('host:transport:', 'host-serial:')):
+                    # other devices are not attached, as adb reports it
+                    fields = service.split(':')
+                    error = "device '%s' not found" % (
+                            fields[2] if fields[0] == 'host' else fields[1])
+                    conn.sendall('FAIL%04x%s' % (len(error), error))
+                    return
+                command = service.partition(':')[2]
+                if service.split(':')[0] in ('shell', 'exec') and \
+                        command in self.commands:
+                    conn.sendall('OKAY' + self.commands[command])
+                    return
+                conn.sendall('FAIL%04xunsupported' % len('unsupported'))
+                return
+        except (EOFError, socket.error):
+            pass
+        finally:
+            with self._connsLock:
+                self._conns.discard(conn)
+            conn.close()
+
+    def _sync(self, conn):
+        block = '\0' * adbclient.Client.SYNC_DATA_MAX
+        while True:
+            header = self._recv(conn, 8)
+            cmd, length = header[0: 4], struct.unpack('<I', header[4:])[0]
+            if cmd == 'QUIT':
+                return
+            path = self._recv(conn, length)
+            if self.latency:
+                time.sleep(self.latency)
+            size = self.sizes.get(path)
+            if cmd == 'STAT':
+                conn.sendall('STAT' + struct.pack('<III',
+                             0100644 if size is not None else 0,
+                             size or 0, int(time.time())))
+            elif cmd == 'RECV' and size is None:
+                error = 'No such file or directory'
+                conn.sendall('FAIL' + struct.pack('<I', len(error)) + error)
+                return
+            elif cmd == 'RECV':
+                while size > 0:
+                    data = block[0: min(size, len(block))]
+                    self.throttle.wait(len(data))
+                    conn.sendall('DATA' + struct.pack('<I', len(data)) + data)
+                    size -= len(data)
+                conn.sendall('DONE' + struct.pack('<I', 0))
+            else:
+                return
+
+    def disconnect(self):
+        '''Closes every open connection, as when the device reconnects'''
+        with self._connsLock:
+            conns = list(self._conns)
+        for conn in conns:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def close(self):
+        self.sock.close()
+
+class Device(object):
+    '''libsync device adapter for the fake server'''
+
+    def __init__(self, port):
+        self.client = adbclient.Client(port=port)
+
+    def shell(self, command):
+        return ''
+
+    def pull(self, files):
+        return self.client.pullMany(SERIAL, files)
+
+def readLibraries(path):
+    '''Returns a dict of path to size of libraries recorded in a
+       "fastload report" JSON file, or listed as "SIZE PATH" lines'''
+    with open(path, 'r') as f:
+        text = f.read()
+    sizes = {}
+    try:
+        for run in json.loads(text)['runs']:
+            for transfer in run['transfers']:
+                if not transfer['error']:
+                    sizes[str(transfer['src'])] = transfer['size']
+    except ValueError:
+        for line in text.splitlines():
+            size, sep, src = line.strip().partition(' ')
+            if sep and size.isdigit():
+                sizes[src.strip()] = int(size)
+    return sizes
+
+def benchmark(sizes, destdir, jobs=5, bandwidth=0, latency=0.0):
+    '''Pulls every file in sizes from a fake server into destdir;
+       returns the loadstats.Telemetry of the run'''
+    server = FakeServer(sizes, bandwidth, latency)
+    device = Device(server.port)
+    telemetry = loadstats.Telemetry(SERIAL)
+    telemetry.info.update(jobs=jobs, bandwidth=bandwidth, latency=latency)
+    files = [(src, os.path.join(destdir, *src.lstrip('/').split('/')))
+             for src in sorted(sizes)]
+    try:
+        with telemetry.phase('pull'):
+            libsync.sync(device, files, jobs, sizes=sizes,
+                         telemetry=telemetry)
+    finally:
+        device.client.close()
+        server.close()
+    return telemetry
+
+if __name__ == '__main__': # not module
+
+    import shutil, tempfile
+    from optparse import OptionParser
+
+    parser = OptionParser(usage='%prog [options] REPORT')
+    parser.add_option('-j', dest='jobs', type='int', default=5,
+                      help='files pulled at the same time (default 5)')
+    parser.add_option('-b', dest='bandwidth', type='float', default=0,
+                      help='link bandwidth in MB/s (default unlimited)')
+    parser.add_option('-l', dest='latency', type='float', default=0,
+                      help='latency of each request in ms (default 0)')
+    parser.add_option('-n', dest='runs', type='int', default=1,
+                      help='number of runs (default 1)')
+    parser.add_option('-o', dest='output',
+                      help='write the results as JSON to OUTPUT')
+    (args, extras) = parser.parse_args()
+
+    if len(extras) != 1:
+        parser.error('missing REPORT, a "fastload report" JSON file '
+                     'or a list of "SIZE PATH" lines')
+    sizes = readLibraries(extras[0])
+    if not sizes:
+        print 'no libraries found in %s' % extras[0]
+        exit(1)
+
+    runs = []
+    for i in range(args.runs):
+        destdir = tempfile.mkdtemp(prefix='fastbench')
+        try:
+            telemetry = benchmark(sizes, destdir, max(1, args.jobs),
+                                  args.bandwidth * 1024 * 1024,
+                                  args.latency / 1000)
+        finally:
+            shutil.rmtree(destdir, ignore_errors=True)
+        runs.append(telemetry.toDict())
+        print '\n'.join(loadstats.formatReport(runs[-1]))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'runs': runs}, f, indent=2, sort_keys=True)
+        print 'Wrote results to %s' % args.output
@@ -3,50 +3,189 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-import gdb, threading, os, sys, subprocess, feninit, adb
+import gdb, threading, os, sys, re, Queue, time, json, feninit, adb, libcache
+import libsync, procmaps, buildid, loadstats, tracebt
 
 class FastLoad(gdb.Command):
-    '''Pull libraries in background'''
+    '''Pull libraries in background
+
+fastload          pull libraries of the debugged program in background
+fastload quick    same, unless libraries were already pulled for the device
+fastload all      pull libraries for every attached device in parallel
+fastload lazy     same as quick, but only load symbols of libraries in
+                  backtraces and tracebt frames, or given to fastload load
+fastload load LIB...  load symbols of libraries LIB in lazy mode
+fastload report [FILE]  show timing of the last run, and save it as
+                        JSON to FILE'''
 
     def __init__(self):
         super(FastLoad, self).__init__('fastload', gdb.COMMAND_SUPPORT)
         self._loader = None
+        self._connected = False
+        # procmaps.MapsTable of the program when libraries were last found
+        self.maps = None
+        # for lazy mode, names of libraries to load and already loaded
+        self._lazy = False
+        self._wanted = set()
+        self._loadedLibs = set()
+        # names of libraries the last loader could not pull
+        self._unpulled = set()
+        # loadstats.Telemetry of the last run, one for each device
+        self.reports = []
 
     def complete(self, text, word):
         return gdb.COMPLETE_NONE
 
+    def _deviceId(self, serial=None):
+        return adb.cached('device', 'devid', lambda:
+                libsync.deviceId(FastLoad.Device(serial)))
+
+    def _procMaps(self):
+        # files mapped into the program, from one read of its maps file
+        try:
+            pid = feninit.default.pid if hasattr(feninit.default, 'pid') \
+                    else gdb.selected_inferior().pid
+            if not pid:
+                return None
+            table = procmaps.MapsTable(procmaps.parseMaps(
+                    adb.read_file('/proc/%d/maps' % int(pid))))
+        except (gdb.GdbError, gdb.error, ValueError):
+            return None
+        return table if table.libraries() else None
+
+    def _solibs(self):
+        # device paths of the program's libraries, or the names gdb knows
+        # if the maps file cannot be read, e.g. without root access
+        self.maps = self._procMaps()
+        if self.maps:
+            return [path for path, start, end in self.maps.libraries()]
+        return [x.split()[-1] for x in gdb.execute(
+                'info sharedlibrary', False, True).splitlines()
+                if ('.so' in x or '/' in x) and len(x.split()) >= 2]
+
+    def _loadAll(self):
+        # libraries gdb knows about, or the default set if none is loaded
+        sysroot = feninit.default.libdir \
+                if hasattr(feninit.default, 'libdir') else None
+        solibs = self._solibs() if sysroot else []
+        if not solibs:
+            solibs = ['/' + lib for lib in feninit.DEFAULT_LIBS]
+        objdir = feninit.default.objdir \
+                if hasattr(feninit.default, 'objdir') else None
+        datadir = str(gdb.parameter('data-directory'))
+        feninit.setLibCacheRoot(datadir)
+        feninit.setBuildIdDirs(datadir, [objdir] +
+                               getattr(feninit.default, 'objdirs', []))
+
+        started = time.time()
+
+        def load(serial):
+            libdir = os.path.abspath(
+                    os.path.join(datadir, os.pardir, 'lib', serial))
+            telemetry = loadstats.Telemetry(serial)
+            self.reports.append(telemetry)
+            with telemetry.phase('device-id'):
+                devid = self._deviceId(serial)
+                force = not libsync.isSynced(libdir, devid)
+            loader = FastLoad.Loader(solibs, libdir, objdir, force, serial)
+            loader.started = started
+            loader.telemetry = telemetry
+            loader.sysroot = sysroot
+            loader.devid = devid
+            loader.fingerprint = adb.build_fingerprint()
+            loader.run()
+            if loader.failed:
+                raise gdb.GdbError('cannot pull %d file(s); %s: %s' % (
+                        len(loader.failed), loader.failed[0].src,
+                        loader.failed[0].error))
+            return loader.hasLibs
+
+        devices = adb.getDevices()
+        self.reports = []
+        sys.__stdout__.write('Pulling libraries for %d device(s)... ' %
+                             len(devices))
+        sys.__stdout__.flush()
+        results = adb.on_all_devices(load, devices)
+        print 'Done'
+        print adb.summarize(results)
+
+    def _connect(self):
+        if self._connected:
+            return
+        gdb.events.cont.connect(self.cont_handler)
+        gdb.events.stop.connect(self.stop_handler)
+        gdb.events.exited.connect(self.exit_handler)
+        self._connected = True
+
+    def _disconnect(self):
+        if not self._connected:
+            return
+        gdb.events.cont.disconnect(self.cont_handler)
+        gdb.events.stop.disconnect(self.stop_handler)
+        gdb.events.exited.disconnect(self.exit_handler)
+        self._connected = False
+
+    def _startLazy(self):
+        # symbols are only loaded for libraries that are needed
+        gdb.execute('set auto-solib-add off', False, True)
+        self._lazy = True
+        self._connect()
+        print 'Loading symbols on demand.'
+
+    def _loadNames(self, argv):
+        if not self._lazy:
+            raise gdb.GdbError('not in lazy mode; use "fastload lazy" first')
+        if not argv:
+            raise gdb.GdbError('no library given')
+        self._wanted.update(os.path.basename(lib) for lib in argv)
+        self._loadPending()
+        for lib in argv:
+            if os.path.basename(lib) not in self._loadedLibs:
+                print 'Symbols for %s will be loaded when available.' % lib
+
     def invoke(self, argument, from_tty):
+        argv = gdb.string_to_argv(argument)
+        if argv and argv[0] == 'load':
+            self.dont_repeat()
+            self._loadNames(argv[1:])
+            return
+        if argv and argv[0] == 'report':
+            self.dont_repeat()
+            self._report(argv[1:])
+            return
         if self._loader:
             print 'Already running.'
             return
+        if argument == 'all':
+            self.dont_repeat()
+            self._loadAll()
+            return
+        if argument == 'lazy':
+            self._startLazy()
         libdir = feninit.default.libdir \
                 if hasattr(feninit.default, 'libdir') else None
         if not libdir:
             return
-        force = True
-        idfile = os.path.join(libdir, '.id')
-        devid = adb.call(['shell', 'cat', '/proc/version',
-                          '/system/build.prop'])[0:2048].strip()
-        try:
-            with open(idfile, 'r') as libid:
-                if libid.read(2048) == devid:
-                    force = False
-                    if argument == 'quick':
-                        return
-        except IOError:
-            pass
-        self._loader = FastLoad.Loader()
-        self._loader.solibs = gdb.execute('info sharedlibrary', False, True)
-        self._loader.force = force
-        self._loader.idfile = idfile
+        telemetry = loadstats.Telemetry()
+        with telemetry.phase('device-id'):
+            devid = self._deviceId()
+            force = not libsync.isSynced(libdir, devid)
+        if not force and argument in ('quick', 'lazy'):
+            return
+        objdir = feninit.default.objdir \
+                if hasattr(feninit.default, 'objdir') else None
+        self._loader = FastLoad.Loader(self._solibs(), libdir, objdir, force)
+        self._loader.telemetry = telemetry
+        self.reports = [telemetry]
         self._loader.devid = devid
-        gdb.events.cont.connect(self.cont_handler)
-        gdb.events.stop.connect(self.stop_handler)
-        gdb.events.exited.connect(self.exit_handler)
+        self._loader.fingerprint = adb.build_fingerprint()
+        self._loader.prioritize(self._stackLibs())
+        if hasattr(gdb, 'post_event'):
+            # load symbols of each library as soon as it is pulled
+            self._loader.notify = lambda: gdb.post_event(self._loadPending)
+        self._connect()
         # load modules
         self._loader.continuing = False
-        self._loader.adbcmd = str(gdb.parameter('adb-path'))
-        self._loader.adbdev = str(gdb.parameter('adb-device'))
         self._loader.start()
 
     def cont_handler(self, event):
@@ -56,43 +195,356 @@ class FastLoad(gdb.Command):
             return
         self._loader.continuing = True
 
+    def _stackLibs(self):
+        # names of libraries with code in the current backtrace
+        libs = []
+        try:
+            frame = gdb.newest_frame()
+            while frame and len(libs) < 16:
+                lib = gdb.solib_name(frame.pc())
+                if lib and os.path.basename(lib) not in libs:
+                    libs.append(os.path.basename(lib))
+                frame = frame.older()
+        except (gdb.error, RuntimeError, AttributeError):
+            pass
+        return libs
+
+    def _isStopped(self):
+        try:
+            thread = gdb.selected_thread()
+            return bool(thread) and thread.is_valid() and thread.is_stopped()
+        except (gdb.error, RuntimeError, AttributeError):
+            return False
+
+    def _sharedLibrary(self, regex=None):
+        # load symbols, timed as part of the last run
+        start = time.time()
+        try:
+            gdb.execute('sharedlibrary' + (' ' + regex if regex else ''),
+                        False, True)
+        finally:
+            if self.reports:
+                self.reports[0].addPhase('symbols', time.time() - start)
+
+    def _loadLibs(self, libs):
+        # load symbols of libraries by file name, in one request because
+        # each request re-reads the program's library list
+        if not libs:
+            return
+        regex = '\\|'.join(re.sub(r'([.*^$\\\[\]])', r'\\\1', lib)
+                            for lib in sorted(libs))
+        self._sharedLibrary('\\(' + regex + '\\)$')
+
+    def loadAddress(self, pc):
+        '''In lazy mode, loads symbols of the library containing pc'''
+        if not self._lazy:
+            return
+        lib = gdb.solib_name(pc) or (self.maps and self.maps.library(pc))
+        if lib and os.path.basename(lib) not in self._loadedLibs:
+            self._wanted.add(os.path.basename(lib))
+            self._loadPending()
+
+    def _loadPending(self):
+        # load symbols of pulled libraries; symbols can only be loaded
+        # while the program is stopped, otherwise wait for the next stop
+        loader = self._loader
+        if not self._isStopped():
+            return
+        # libraries land before the loader is done
+        done = loader.done if loader else False
+        libs = set()
+        try:
+            while loader:
+                libs.add(os.path.basename(loader.landed.get_nowait()))
+        except Queue.Empty:
+            pass
+        if self._lazy:
+            # only libraries asked for, once they are not being pulled
+            libs = self._wanted - self._loadedLibs - \
+                    (loader.pending() if loader and not done else set())
+            self._loadLibs(libs)
+            # libraries that could not be pulled are loaded by a later run
+            self._loadedLibs.update(libs - (loader.unpulled() if loader
+                                            else self._unpulled))
+            if done:
+                self._finishLoader()
+            return
+        self._loadLibs(libs)
+        if done:
+            self._disconnect()
+            self._finishLoader()
+            if loader.hasLibs:
+                # catch anything not loaded by name
+                self._sharedLibrary()
+                print 'Loaded symbols for all libraries.'
+
     def stop_handler(self, event):
         loader = self._loader
+        stack = self._stackLibs() \
+                if self._lazy or loader and not loader.done else []
+        if loader and not loader.done:
+            # libraries in the backtrace of this stop are pulled next
+            loader.prioritize(stack)
+        if self._lazy:
+            self._wanted.update(stack)
+            self._loadPending()
+            return
+        if loader.notify:
+            if not loader.done:
+                print 'Loading symbols as libraries arrive from device...'
+            self._loadPending()
+            return
         self.exit_handler(event)
         # set paths and load all symbols
         if not loader.hasLibs:
             return
         sys.__stdout__.write('Loading symbols... ')
         sys.__stdout__.flush()
-        gdb.execute('sharedlibrary', False, True)
+        self._sharedLibrary()
         print 'Done'
 
-    def exit_handler(self, event):
-        gdb.events.cont.disconnect(self.cont_handler)
-        gdb.events.stop.disconnect(self.stop_handler)
-        gdb.events.exited.disconnect(self.exit_handler)
-        if self._loader.isAlive():
+    def _finishLoader(self):
+        if not self._loader:
+            return
+        if self._loader.isAlive() and not self._loader.done:
             self._loader.continuing = False
             sys.__stdout__.write('Waiting for libraries from device... ')
             sys.__stdout__.flush()
             self._loader.join()
             print 'Done'
+        self._loader.join()
+        for transfer in self._loader.failed:
+            print 'Cannot pull %s: %s' % (transfer.src, transfer.error)
+        self._unpulled = self._loader.unpulled()
         self._loader = None
 
+    def _report(self, argv):
+        if not self.reports:
+            raise gdb.GdbError('fastload has not run yet')
+        if self._loader and not self._loader.done:
+            print '(still running)'
+        runs = [telemetry.toDict() for telemetry in self.reports]
+        for run in runs:
+            print '\n'.join(loadstats.formatReport(run))
+        if not argv:
+            return
+        path = os.path.abspath(os.path.expanduser(argv[0]))
+        try:
+            with open(path, 'w') as f:
+                json.dump({'runs': runs}, f, indent=2, sort_keys=True)
+        except IOError as e:
+            raise gdb.GdbError('cannot write report: ' + str(e))
+        print 'Wrote fastload report to %s.' % path
+
+    def exit_handler(self, event):
+        if not self._lazy:
+            self._disconnect()
+        self._finishLoader()
+        # symbols are discarded with the program
+        self._wanted = set()
+        self._loadedLibs = set()
+
+    class Device(object):
+        '''libsync device adapter for device serial,
+           or for the default device if serial is None'''
+
+        def __init__(self, serial):
+            self.serial = serial
+
+        def shell(self, command):
+            with adb.use_device(self.serial):
+                return adb.shell(command)
+
+        def pull(self, files):
+            with adb.use_device(self.serial):
+                return adb.pull_many(files)
+
+        def exec_out(self, command):
+            with adb.use_device(self.serial):
+                return adb.exec_out(command)
+
+        def read_file(self, path):
+            with adb.use_device(self.serial):
+                return adb.read_file(path)
+
     class Loader(threading.Thread):
+        '''Pulls solibs into libdir from device serial,
+           or from the default device if serial is None'''
+
+        def __init__(self, solibs, libdir, objdir, force, serial=None):
+            super(FastLoad.Loader, self).__init__()
+            self.solibs = solibs
+            self.libdir = libdir
+            self.objdir = objdir
+            self.force = force
+            self.serial = serial
+            # start of the run, shared by loaders of all devices
+            self.started = time.time()
+            # directory gdb resolved solibs against, if not libdir
+            self.sysroot = None
+            self.devid = None
+            # build fingerprint for the shared library cache
+            self.fingerprint = None
+            self.hasLibs = False
+            self.continuing = False
+            # number of files to pull at the same time
+            self.jobs = jobs.value
+            # Transfer of each library that could not be pulled
+            self.failed = []
+            # names of libraries to pull before others, and their
+            # sources among files being pulled
+            self.priority = set()
+            self.first = set()
+            self._files = []
+            self._lock = threading.Lock()
+            # local paths of libraries pulled or linked from the cache
+            self.landed = Queue.Queue()
+            # names of libraries still to be pulled, to the number of
+            # their files still queued, and names of libraries landed
+            # and failed to pull; guarded by _lock
+            self.queued = {}
+            self._landedNames = set()
+            self._failedNames = set()
+            # called from loader threads whenever a library lands
+            # and when all libraries are done
+            self.notify = None
+            self.done = False
+            self.telemetry = loadstats.Telemetry(serial)
+
+        def _land(self, dst):
+            with self._lock:
+                self.queued.pop(os.path.basename(dst), None)
+                self._landedNames.add(os.path.basename(dst))
+            self.landed.put(dst)
+            if self.notify:
+                self.notify()
+
+        def _fail(self, dst):
+            # a library searched for in several directories is only
+            # missing once none of them has it
+            name = os.path.basename(dst)
+            with self._lock:
+                count = self.queued.pop(name, 0) - 1
+                if count > 0:
+                    self.queued[name] = count
+                else:
+                    self._failedNames.add(name)
+
+        def pending(self):
+            '''Returns names of libraries still to be pulled'''
+            with self._lock:
+                return set(self.queued)
+
+        def unpulled(self):
+            '''Returns names of libraries that could not be pulled'''
+            with self._lock:
+                return self._failedNames - self._landedNames
+
+        def _finish(self):
+            self.done = True
+            if self.notify:
+                self.notify()
+
+        def prioritize(self, names):
+            '''Pulls libraries with file names names before others,
+               including while pulling'''
+            with self._lock:
+                self.priority.update(names)
+                self.first.update(src for src, dst in self._files
+                                  if os.path.basename(dst) in names)
+
+        def _libIndex(self, device):
+            # files in the library directories, shared by devices on
+            # the same build; None if the device cannot be listed
+            def build():
+                index = libsync.loadIndex(
+                        libcache.default.getIndex(self.fingerprint))
+                if index:
+                    return index
+                index = libsync.buildIndex(device)
+                if not index:
+                    # raising keeps the failure out of the cache, so the
+                    # next load lists the device again
+                    raise gdb.GdbError('cannot list device libraries')
+                libcache.default.putIndex(self.fingerprint, index.toDict())
+                return index
+            try:
+                with adb.use_device(self.serial):
+                    return adb.cached('device', 'libindex', build)
+            except gdb.GdbError:
+                return None
+
+        def _skipLocal(self, device, files, sizes):
+            # skip pulling libraries with the same build-id as a local
+            # file, which is linked into libdir for gdb to find there;
+            # objdir files are symlinked so rebuilds are picked up
+            if not buildid.default.root or not files:
+                return files
+            # walk the indexed directories once per run, even when
+            # loading for several devices
+            buildid.default.update(since=self.started)
+            try:
+                ids = buildid.remoteBuildIds(device,
+                        [src for src, dst in files], sizes)
+            except gdb.GdbError:
+                return files
+            pulled = buildid.default.root + os.sep
+            remaining = []
+            for src, dst in files:
+                local = buildid.default.lookup(ids[src]) \
+                        if src in ids else None
+                if not local or local == dst:
+                    remaining.append((src, dst))
+                    continue
+                try:
+                    libcache.linkFile(local, dst,
+                                      not local.startswith(pulled))
+                except (IOError, OSError):
+                    remaining.append((src, dst))
+                    continue
+                self._land(dst)
+            return remaining
+
         def run(self):
-            PARALLEL_LIMIT = 5
+            try:
+                self._run()
+            finally:
+                self._finish()
 
-            libdir = feninit.default.libdir
-            objdir = feninit.default.objdir \
-                    if hasattr(feninit.default, 'objdir') else None
-            buckets = [[] for x in range(PARALLEL_LIMIT)]
+        def _run(self):
+            libdir = self.libdir
+            objdir = self.objdir
+            files = []
+            self.telemetry.info.update(fingerprint=self.fingerprint,
+                                       jobs=self.jobs, force=self.force)
+            scanStart = time.time()
+            # libraries from the cache are already up to date
+            linked = libcache.default.checkout(self.fingerprint, libdir)
+            device = FastLoad.Device(self.serial)
+            index = self._libIndex(device)
+            manifest = libsync.Manifest(libdir)
+            names = set(os.path.basename(lib) for lib in self.solibs)
+            for dst in linked:
+                if os.path.basename(dst) in names:
+                    self._land(dst)
 
-            for lib in (x.split()[-1] for x in self.solibs.splitlines()
-                    if ('.so' in x or '/' in x) and len(x.split()) >= 2):
-                if os.path.exists(lib): # symbol already loaded
-                    if not self.force or not lib.startswith(libdir):
-                        continue
+            def isCurrent(dst):
+                # when forced, files are checked against the device below
+                return os.path.exists(dst) and \
+                       not manifest.isTruncated(dst) and \
+                       (not self.force or dst in linked)
+
+            for lib in self.solibs:
+                if self.sysroot and lib.startswith(self.sysroot):
+                    # same library under this device's directory, which
+                    # may not have been pulled for this device yet
+                    lib = os.path.join(libdir,
+                            lib[len(self.sysroot):].lstrip(os.path.sep))
+                local = lib.startswith(libdir + os.path.sep)
+                if os.path.exists(lib) and (not local or isCurrent(lib)):
+                    # symbol already loaded
+                    continue
+                if local:
                     if os.path.join('system', 'lib') in lib or \
                        os.path.join('system', 'vendor', 'lib') in lib:
                         # turn to a relative path
@@ -102,65 +554,143 @@ class FastLoad(gdb.Command):
                         lib = '/' + '/'.join(lib[len(libdir):]
                                        .lstrip(os.path.sep)
                                        .split(os.path.sep))
-                if objdir and os.path.exists(
-                        os.path.join(objdir, 'dist', 'bin', lib)):
+                if objdir and os.path.exists(os.path.join(
+                        objdir, 'dist', 'bin', os.path.basename(lib))):
+                    # gdb finds the library with symbols in objdir
                     continue
                 if '/' in lib:
                     src = lib
                     dst = os.path.join(libdir, os.path.sep.join(
                                        lib.lstrip('/').split('/')))
-                    if not self.force and os.path.exists(dst):
+                    if isCurrent(dst):
                         continue
-                    bucket = min(buckets, key=lambda x: len(x))
-                    bucket.append((src, dst))
-                    continue
-                for srclibdir in ['', 'drm/', 'hw/', 'egl/']:
-                    src = '/system/lib/' + srclibdir + lib
-                    dst = os.path.join(libdir, 'system', 'lib', lib)
-                    if not self.force and os.path.exists(dst):
+                    if index and index.covers(src) and src not in index:
                         continue
-                    bucket = min(buckets, key=lambda x: len(x))
-                    bucket.append((src, dst))
-                for srclibdir in ['', 'drm/', 'egl/', 'hw/']:
-                    src = '/system/vendor/lib/' + srclibdir + lib
-                    dst = os.path.join(libdir, 'system', 'vendor', 'lib', lib)
-                    if not self.force and os.path.exists(dst):
+                    files.append((src, dst))
+                    continue
+                for root, subdirs in (
+                        ('/system/lib/', ['', 'drm/', 'hw/', 'egl/']),
+                        ('/system/vendor/lib/', ['', 'drm/', 'egl/', 'hw/'])):
+                    dst = os.path.join(libdir,
+                            os.path.sep.join(root.strip('/').split('/')), lib)
+                    if isCurrent(dst):
                         continue
-                    bucket = min(buckets, key=lambda x: len(x))
-                    bucket.append((src, dst))
+                    srcs = [root + srclibdir + lib for srclibdir in subdirs]
+                    if index:
+                        # only paths that exist, looking in other
+                        # subdirectories if none of the usual ones has it
+                        srcs = [path for path in srcs if path in index] or \
+                               [path for path in index.locate(lib)
+                                if path.startswith(root)]
+                    files.extend((src, dst) for src in srcs)
 
-            self.hasLibs = any(buckets)
-            if not self.hasLibs:
+            self.hasLibs = bool(files) or bool(linked)
+            if not files:
+                self.telemetry.addPhase('list', time.time() - scanStart)
                 return
 
+            # sizes for pulling largest first come from the index, or
+            # from one listing of directories outside of it
+            sizes = index.sizes() if index else {}
+            try:
+                sizes.update(libsync.remoteSizes(device,
+                        [path.rpartition('/')[0] for path, target in files
+                         if not index or not index.covers(path)]))
+            except gdb.GdbError:
+                pass
+            # of the directories searched for a library, pull from the
+            # first one known to have it, or the first one searched;
+            # pulling several sources to one dst would race
+            chosen = {}
+            for src, dst in files:
+                if src in sizes and dst not in chosen:
+                    chosen[dst] = src
+            for src, dst in files:
+                chosen.setdefault(dst, src)
+            unique = []
+            for src, dst in files:
+                if chosen.get(dst) == src:
+                    unique.append((src, dst))
+                    del chosen[dst]
+            files = unique
+            # pull only files that changed since they were last pulled
+            algorithm, sums = 'md5', {}
+            if self.force:
+                files, checked, sums = libsync.changedFiles(
+                        device, files, manifest)
+                algorithm = checked or algorithm
+            files = self._skipLocal(device, files, sizes)
+            self.telemetry.addPhase('list', time.time() - scanStart)
+            # libraries in the backtrace go first
+            with self._lock:
+                self._files = files
+                self.first.update(src for src, dst in files
+                        if os.path.basename(dst) in self.priority)
+                for src, dst in files:
+                    name = os.path.basename(dst)
+                    self.queued[name] = self.queued.get(name, 0) + 1
+
             # let it loose!
-            def makePullLibs(bucket, fnull):
-                def doPullLibs():
-                    for fromto in bucket:
-                        cmd = [self.adbcmd]
-                        cmd += ['-s', self.adbdev] if self.adbdev else []
-                        cmd += ['pull', fromto[0], fromto[1]]
-                        subprocess.Popen(cmd, stdout=fnull,
-                                stderr=fnull).wait()
-                return doPullLibs
-            fnull = open(os.devnull, 'wb')
-            threads = [threading.Thread(
-                    target=makePullLibs(x, fnull)) for x in buckets]
-            for thread in threads:
-                thread.start()
-            for thread in threads:
-                thread.join()
-            fnull.close()
-            if hasattr(self, 'idfile'):
+            with self.telemetry.phase('pull'):
+                transfers = libsync.sync(device, files, self.jobs,
+                        sizes=sizes, first=self.first,
+                        telemetry=self.telemetry,
+                        callback=lambda t: self._fail(t.dst) if t.error
+                                           else self._land(t.dst))
+            pulled = set(t.dst for t in transfers if not t.error)
+            # checksums for the library cache come from the same read
+            # as checksums for the manifest
+            extra = [libcache.default.ALGORITHM] \
+                    if libcache.default.isEnabled(self.fingerprint) else []
+            digests = {}
+            for t in transfers:
+                if t.error:
+                    continue
                 try:
-                    with open(self.idfile, 'w') as libid:
-                        libid.write(self.devid)
-                except IOError:
+                    digests[t.dst] = manifest.update(t.dst, t.src,
+                            index.mtime(t.src) if index else None,
+                            sums.get(t.src), algorithm, extra)
+                except (IOError, OSError):
                     pass
+            manifest.save()
+            libcache.default.checkin(self.fingerprint, libdir, pulled,
+                    dict((dst, local[libcache.default.ALGORITHM])
+                         for dst, local in digests.iteritems() if local))
+            buildid.default.add(pulled)
+            # report libraries that failed to pull from every directory,
+            # other than for not being there
+            for t in transfers:
+                if t.error and not libsync.isPermanent(t.error) and \
+                        t.dst not in pulled:
+                    pulled.add(t.dst)
+                    self.failed.append(t)
+            if self.devid and not self.failed:
+                # otherwise pull again even with quick
+                libsync.markSynced(libdir, self.devid)
             if self.continuing:
                 sys.__stderr__.write(
                         'All libraries pulled from device. Continuing.\n')
 
+class FastLoadJobs(gdb.Parameter):
+    '''Set the number of files fastload pulls at the same time'''
+    set_doc = 'Set number of files fastload pulls at the same time'
+    show_doc = 'Show number of files fastload pulls at the same time'
+
+    def __init__(self):
+        super(FastLoadJobs, self).__init__('fastload-jobs',
+                gdb.COMMAND_SUPPORT, gdb.PARAM_ZINTEGER)
+        self.value = 5
+
+    def get_set_string(self):
+        self.value = max(1, self.value)
+        return 'fastload pulls ' + str(self.value) + ' files at a time'
+
+    def get_show_string(self, svalue):
+        return 'fastload pulls ' + svalue + ' files at a time'
+
+jobs = FastLoadJobs()
 default = FastLoad()
+# load symbols of frames walked by tracebt in lazy mode
+tracebt.frameHooks.append(default.loadAddress)
 feninit.default.skipPull = True
 
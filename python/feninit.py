@@ -3,9 +3,35 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-import gdb, adb, readinput, adblog, getxre
+import gdb, adb, readinput, adblog, getxre, libcache, buildid
 import os, sys, subprocess, threading, time, shlex, tempfile, pipes, shutil, re
 
+# libraries/binaries to pull from device
+DEFAULT_LIBS = ['system/lib/libdl.so', 'system/lib/libc.so',
+        'system/lib/libm.so', 'system/lib/libstdc++.so',
+        'system/lib/liblog.so', 'system/lib/libz.so',
+        'system/lib/libGLESv2.so', 'system/bin/linker']
+
+def setLibCacheRoot(datadir):
+    # libraries shared between devices are stored next to the
+    # per-device directories, unless gdbinit chose another location
+    root = libcache.default.root or \
+            os.path.join(datadir, os.pardir, 'lib', '.store')
+    libcache.default.root = os.path.abspath(os.path.expanduser(root))
+
+def setBuildIdDirs(datadir, objdirs):
+    # index libraries of every objdir before the ones pulled from
+    # devices, so files with symbols are preferred
+    libroot = os.path.abspath(os.path.join(datadir, os.pardir, 'lib'))
+    buildid.default.root = libroot
+    dirs = [os.path.join(objdir, 'dist', d)
+            for objdir in objdirs if objdir for d in ('bin', 'lib')]
+    if os.path.isdir(libroot):
+        dirs.extend(os.path.join(libroot, d)
+                    for d in sorted(os.listdir(libroot))
+                    if not d.startswith('.'))
+    buildid.default.dirs = dirs
+
 class FenInit(gdb.Command):
     '''Initialize gdb for debugging Fennec on Android'''
 
@@ -150,14 +176,10 @@ class FenInit(gdb.Command):
                 objdir = matchObjdir[0]
         print 'Using object directory: %s' % str(objdir)
         self.objdir = objdir
+        self.objdirs = objdirs
 
     def _pullLibsAndSetPaths(self):
         DEFAULT_FILE = 'system/bin/app_process'
-        # libraries/binaries to pull from device
-        DEFAULT_LIBS = ['system/lib/libdl.so', 'system/lib/libc.so',
-                'system/lib/libm.so', 'system/lib/libstdc++.so',
-                'system/lib/liblog.so', 'system/lib/libz.so',
-                'system/lib/libGLESv2.so', 'system/bin/linker']
         # search path for above libraries/binaries
         DEFAULT_SEARCH_PATHS = [['system', 'lib'],
                                 ['system', 'vendor', 'lib'],
@@ -171,25 +193,28 @@ class FenInit(gdb.Command):
         self.bindir = os.path.abspath(
                 os.path.join(datadir, os.pardir, 'bin'))
 
+        # link libraries already pulled from another device on this build
+        setLibCacheRoot(datadir)
+        fingerprint = adb.build_fingerprint()
+        libcache.default.checkout(fingerprint, libdir)
+
         # always pull the executable file
         dstpath = os.path.join(libdir, DEFAULT_FILE.replace('/', os.sep))
-        if not os.path.exists(dstpath):
-            adb.pull('/' + DEFAULT_FILE, dstpath)
+        def doPullExe():
+            if not os.path.exists(dstpath):
+                adb.pull('/' + DEFAULT_FILE, dstpath)
+                libcache.default.checkin(fingerprint, libdir, [dstpath])
+        pullExe = adb.submit(doPullExe)
 
         # only pull libs and set paths if automatically loading symbols
+        pullLibs = None
         if hasattr(self, 'skipPull') and not self.skipPull:
-            sys.stdout.write('Pulling libraries to %s... ' % libdir)
-            sys.stdout.flush()
-            for lib in DEFAULT_LIBS:
-                try:
-                    dstpath = os.path.join(libdir, lib.replace('/', os.sep))
-                    if not os.path.exists(dstpath):
-                        adb.pull('/' + lib, dstpath)
-                except gdb.GdbError:
-                    sys.stdout.write('\n cannot pull %s... ' % lib)
-                    sys.stdout.flush()
-            print 'Done'
+            libs = [('/' + lib, os.path.join(libdir, lib.replace('/', os.sep)))
+                    for lib in DEFAULT_LIBS]
+            pullLibs = adb.submit(adb.pull_many,
+                    [l for l in libs if not os.path.exists(l[1])])
 
+        # set up paths while the pulls are running
         gdb.execute('set sysroot ' + libdir, False, True)
         print 'Set sysroot to "%s".' % libdir
 
@@ -202,10 +227,34 @@ class FenInit(gdb.Command):
                 os.pathsep.join(searchPaths), False, True)
         print 'Updated solib-search-path.'
 
+        # let gdb find libraries by build-id through the index's tree
+        setBuildIdDirs(datadir, [self.objdir] + getattr(self, 'objdirs', []))
+        debugdirs = str(gdb.parameter('debug-file-directory')).split(os.pathsep)
+        if buildid.default.root not in debugdirs:
+            gdb.execute('set debug-file-directory ' + os.pathsep.join(
+                    [d for d in debugdirs if d] + [buildid.default.root]),
+                    False, True)
+
         # Pass background hang monitor signal (assuming SIG36)
         gdb.execute('handle SIG36 nostop noprint pass', False, True)
         print 'Ignoring BHM signal.'
 
+        pullExe.result()
+        if pullLibs:
+            sys.stdout.write('Pulling libraries to %s... ' % libdir)
+            sys.stdout.flush()
+            transfers = pullLibs.result()
+            for transfer in transfers:
+                if transfer.error:
+                    sys.stdout.write('\n cannot pull %s... ' %
+                                     transfer.src.lstrip('/'))
+                    sys.stdout.flush()
+            libcache.default.checkin(fingerprint, libdir,
+                    [t.dst for t in transfers if not t.error])
+            print 'Done'
+        # index new files in background
+        adb.submit(buildid.default.update)
+
     def _extractApk(self, pkg, bindir, libdir):
         sys.stdout.write('Pulling apk for symbols... ')
         sys.stdout.flush()
@@ -214,6 +263,14 @@ class FenInit(gdb.Command):
             print 'Could not find apk.'
             return
 
+        import zipfile
+        appdir = os.path.join(libdir, 'app', pkg)
+        if os.path.isdir(appdir):
+            shutil.rmtree(appdir, ignore_errors=True)
+        apppath = os.path.join(appdir, 'app.apk')
+        # look for szip while the apk is being pulled
+        pullApk = adb.submit(adb.pull, apk, apppath)
+
         def findSzip(path):
             try:
                 with open(os.devnull, 'w') as devnull:
@@ -225,15 +282,14 @@ class FenInit(gdb.Command):
         szip = findSzip(os.path.join(bindir, 'szip')) or \
                findSzip('szip')
         if not szip:
+            if not pullApk.cancel():
+                # too late to cancel; do not leave the apk behind
+                pullApk.exception()
+                shutil.rmtree(appdir, ignore_errors=True)
             print '*** Could not find szip tool ***'
             return
 
-        import zipfile
-        appdir = os.path.join(libdir, 'app', pkg)
-        if os.path.isdir(appdir):
-            shutil.rmtree(appdir, ignore_errors=True)
-        apppath = os.path.join(appdir, 'app.apk')
-        adb.pull(apk, apppath)
+        pullApk.result()
         print 'Done'
 
         sys.stdout.write('Extracting apk... ')
@@ -266,18 +322,23 @@ class FenInit(gdb.Command):
         print 'Updated solib-search-path'
 
     def _getPackageApk(self, pkg):
-        devpkgs = adb.call(['shell', 'pm', 'list', 'packages', '-f'])
-        if not devpkgs.strip():
-            return None
-        for devpkg in (l.strip() for l in devpkgs.splitlines()):
-            if not devpkg:
-                continue
-            # devpkg has the format 'package:/data/app/pkg.apk=pkg'
-            devpkg = devpkg.partition('=')
-            if pkg != devpkg[2]:
-                continue
-            return devpkg[0].partition(':')[2]
-        return ''
+        devpkgs = adb.stream(['shell', 'pm', 'list', 'packages', '-f'],
+                             cache='packages')
+        empty = True
+        try:
+            for devpkg in (l.strip() for l in devpkgs):
+                if not devpkg:
+                    continue
+                empty = False
+                # devpkg has the format 'package:/data/app/pkg.apk=pkg'
+                devpkg = devpkg.partition('=')
+                if pkg != devpkg[2]:
+                    continue
+                return devpkg[0].partition(':')[2]
+        finally:
+            # stop listing packages once we have found ours
+            devpkgs.close()
+        return None if empty else ''
 
     def _verifyPackage(self, objdir, pkg):
         if not objdir or not pkg:
@@ -298,22 +359,15 @@ class FenInit(gdb.Command):
         apks.sort(key=lambda f: os.path.getmtime(f))
         apk = apks[-1]
 
-        while True:
-            devapk = self._getPackageApk(pkg)
+        if hasattr(self, 'verify_all_devices') and self.verify_all_devices:
+            return self._verifyPackageOnAllDevices(pkg, apk)
 
-            if devapk is None:
+        while True:
+            state = self._getPackageState(pkg, apk)
+            if not state:
                 return True
 
-            if devapk:
-                devapkls = adb.call(['shell', 'ls', '-l', devapk])
-                devapksize = [int(f, 0) for f in devapkls.split()
-                        if f.isdigit() and int(f, 0) > 1024 * 1024]
-                if not devapksize:
-                    return True
-                if devapksize[0] == os.path.getsize(apk):
-                    return True
-
-            if devapk:
+            if state == 'mismatch':
                 print 'Package %s does not seem to match file %s.' % \
                         (pkg, os.path.basename(apk))
             else:
@@ -330,6 +384,7 @@ class FenInit(gdb.Command):
             sys.stdout.flush()
             adbout = adb.call(['install', '-r', apk],
                     stderr=subprocess.PIPE).splitlines()
+            adb.invalidate('packages')
             adbout = [f for f in adbout if f.strip()]
             if not adbout:
                 adbout = ['No output?!']
@@ -353,11 +408,70 @@ class FenInit(gdb.Command):
             sys.stdout.flush()
             adbout = adb.call(['install', '-r', apk],
                     stderr=subprocess.PIPE).splitlines()
+            adb.invalidate('packages')
             adbout = [f for f in adbout if f.strip()]
             if not adbout:
                 adbout = ['No output?!']
             print adbout[-1]
 
+    def _getPackageState(self, pkg, apk):
+        # returns 'missing' or 'mismatch' if pkg needs to be reinstalled
+        # from apk, or None if pkg matches or cannot be checked
+        devapk = self._getPackageApk(pkg)
+        if devapk is None:
+            return None
+        if not devapk:
+            return 'missing'
+        devapkls = adb.shell('ls -l ' + devapk)
+        devapksize = [int(f, 0) for f in devapkls.split()
+                if f.isdigit() and int(f, 0) > 1024 * 1024]
+        if not devapksize or devapksize[0] == os.path.getsize(apk):
+            return None
+        return 'mismatch'
+
+    def _verifyPackageOnAllDevices(self, pkg, apk):
+        sys.stdout.write('Checking %s on all devices... ' % pkg)
+        sys.stdout.flush()
+        results = adb.on_all_devices(
+                lambda serial: self._getPackageState(pkg, apk))
+        print 'Done'
+        reinstall = []
+        for r in results:
+            if r.error:
+                print '  %s: error: %s' % (r.serial, str(r.error))
+            elif r.result:
+                print '  %s: package %s' % (r.serial, r.result)
+                reinstall.append(r.serial)
+            else:
+                print '  %s: ok' % r.serial
+        if not reinstall:
+            return True
+
+        ans = None
+        while not ans or (ans[0] != 'y' and ans[0] != 'Y' and
+                          ans[0] != 'n' and ans[0] != 'N'):
+            ans = readinput.call('Reinstall %s on %d device(s)? [yes/no]: ' %
+                    (os.path.basename(apk), len(reinstall)),
+                    '-l', str(['yes', 'no']))
+        print
+        if ans[0] == 'n' or ans[0] == 'N':
+            return False
+
+        def install(serial):
+            adbout = adb.call(['install', '-r', apk],
+                    stderr=subprocess.PIPE).splitlines()
+            adb.invalidate('packages', serial)
+            adbout = [f for f in adbout if f.strip()] or ['No output?!']
+            if 'success' not in adbout[-1].lower():
+                raise gdb.GdbError(adbout[-1])
+            return adbout[-1]
+        sys.stdout.write('adb install -r on %d device(s)... ' % len(reinstall))
+        sys.stdout.flush()
+        results = adb.on_all_devices(install, reinstall)
+        print 'Done'
+        print adb.summarize(results)
+        return not any(r.error for r in results)
+
     def _getAppName(self, objdir):
         try:
             with open(os.path.join(objdir, 'config', 'autoconf.mk')) as acfile:
@@ -399,8 +513,9 @@ class FenInit(gdb.Command):
             except IOError:
                 pass
         if not pkgs:
-            pkgs = [x.partition(':')[-1] for x in \
-                adb.call(['shell', 'pm', 'list', 'packages']).splitlines() \
+            pkgs = [x.strip().partition(':')[-1] for x in \
+                adb.stream(['shell', 'pm', 'list', 'packages'],
+                           cache='packages') \
                 if ':org.mozilla.' in x]
         if pkgs:
             print 'Found package names:'
@@ -416,8 +531,11 @@ class FenInit(gdb.Command):
         print ''
         return pkg
 
-    def _getRunningProcs(self, pkg, waiting=False):
-        ps = adb.call(['shell', 'ps']).splitlines()
+    def _getRunningProcs(self, pkg, waiting=False, cached=True):
+        if not cached:
+            adb.invalidate('procs')
+        ps = (l.rstrip('\r\n')
+              for l in adb.stream(['shell', 'ps'], cache='procs'))
         return [x for x in ps if
                 (not pkg or pkg in re.split(r'[ \t/]', x)) and
                 (not waiting or 'S' in x.split() or 'T' in x.split())]
@@ -427,7 +545,8 @@ class FenInit(gdb.Command):
         if not pkgProcs:
             return
 
-        adb.call(['shell', 'am', 'force-stop', pkg])
+        adb.shell('am force-stop ' + pkg)
+        adb.invalidate('procs')
         time.sleep(3)
         pkgProcs = self._getRunningProcs(pkg)
         if not pkgProcs:
@@ -437,8 +556,9 @@ class FenInit(gdb.Command):
             # try twice
             for i in range(2):
                 for p in pkgProcs:
-                    adb.call(['shell', 'run-as', pkg, 'kill', '-9',
-                              next(c for c in p.split() if c.isdigit())])
+                    adb.shell('run-as %s kill -9 %s' % (pkg,
+                              next(c for c in p.split() if c.isdigit())))
+                adb.invalidate('procs')
                 time.sleep(2)
                 pkgProcs = self._getRunningProcs(pkg)
                 if not pkgProcs:
@@ -446,7 +566,7 @@ class FenInit(gdb.Command):
         except:
             pass
 
-        pkgProcs = self._getRunningProcs(pkg)
+        pkgProcs = self._getRunningProcs(pkg, cached=False)
         if not pkgProcs:
             return
         for p in pkgProcs:
@@ -563,11 +683,11 @@ class FenInit(gdb.Command):
             CHILD_FILE_PATH = None
 
         # get parent/child processes that are waiting ('S' state)
-        pkgProcs = self._getRunningProcs(pkg, waiting=True)
+        pkgProcs = self._getRunningProcs(pkg, waiting=True, cached=False)
 
         # wait for parent launch to complete
         while all([CHILD_EXECUTABLE in x for x in pkgProcs]):
-            pkgProcs = self._getRunningProcs(pkg, waiting=True)
+            pkgProcs = self._getRunningProcs(pkg, waiting=True, cached=False)
         print 'Done'
 
         # get parent/child(ren) pid's
@@ -579,12 +699,16 @@ class FenInit(gdb.Command):
 
         # see if any gdbserver instance is running, and discard
         # the debuggee from our list because it's already taken
-        ps = adb.call(['shell', 'ps']).splitlines()
-        for proc in [x.split() for x in ps if 'gdbserver' in x]:
-            # get the program being debugged by examining gdbserver cmdline
-            cmdline = adb.call(['shell', 'cat',
-                    '/proc/' + next((col for col in proc if col.isdigit())) +
-                    '/cmdline']).split('\0')
+        gdbserverPids = [next((col for col in x.split() if col.isdigit()))
+                         for x in adb.stream(['shell', 'ps'], cache='procs')
+                         if 'gdbserver' in x]
+        # get the programs being debugged by examining gdbserver cmdlines
+        for p in gdbserverPids:
+            try:
+                cmdline = adb.read_file('/proc/' + p + '/cmdline').split('\0')
+            except gdb.GdbError:
+                # gdbserver exited since the cached ps
+                continue
             if '--attach' not in cmdline:
                 continue
             # this should be the pid
@@ -635,7 +759,8 @@ class FenInit(gdb.Command):
             print 'Waiting for child process...'
             while not any(pidChildParent in x and
                           CHILD_EXECUTABLE in x for x in pkgProcs):
-                pkgProcs = self._getRunningProcs(pkg, waiting=True)
+                pkgProcs = self._getRunningProcs(pkg, waiting=True,
+                                                 cached=False)
                 time.sleep(1)
             pidChild = [next((col for col in x.split() if col.isdigit()))
                         for x in pkgProcs]
@@ -755,8 +880,9 @@ class FenInit(gdb.Command):
             sys.stdout.write('in pkg dir... ')
             sys.stdout.flush()
             pkgGdbserverPath = '/data/data/' + pkg + '/files/gdbserver'
-            adb.call(['shell', 'run-as', pkg, 'cp', gdbserverPath, pkgGdbserverPath])
-            adb.call(['shell', 'run-as', pkg, 'chmod', '755', pkgGdbserverPath])
+            adb.shell_batch([
+                'run-as %s cp %s %s' % (pkg, gdbserverPath, pkgGdbserverPath),
+                'run-as %s chmod 755 %s' % (pkg, pkgGdbserverPath)])
             gdbserverArgs = ['shell', 'run-as', pkg, pkgGdbserverPath] + args
             (gdbserverProc, port, gdbserverPkgRunAsOut) = \
                     runGDBServer(gdbserverArgs)
@@ -765,9 +891,10 @@ class FenInit(gdb.Command):
             sys.stdout.write('as root... ')
             sys.stdout.flush()
             gdbserverArgs = [gdbserverPath] + args
-            adb.call(['shell', 'echo "#!/system/bin/sh\\n' +
-                    ' '.join(gdbserverArgs) + '" > ' + gdbserverPath + '.run'])
-            adb.call(['shell', 'chmod', '755', gdbserverPath + '.run'])
+            adb.shell_batch([
+                'echo "#!/system/bin/sh\\n' + ' '.join(gdbserverArgs) +
+                    '" > ' + gdbserverPath + '.run',
+                'chmod 755 ' + gdbserverPath + '.run'])
             (gdbserverProc, port, gdbserverSuOut) = runGDBServer(
                     ['shell', 'su', '-c', gdbserverPath + '.run'])
 
@@ -935,7 +1062,8 @@ class FenInit(gdb.Command):
         else:
             pkgProcs = None
             while not pkgProcs:
-                pkgProcs = self._getRunningProcs(pkg, waiting=True)
+                pkgProcs = self._getRunningProcs(pkg, waiting=True,
+                                                 cached=False)
             # sleep for 2s to allow time to launch
             time.sleep(2)
             print 'Done'
@@ -961,11 +1089,12 @@ class FenInit(gdb.Command):
             f.write('\n'.join(lines))
             tmpname = f.name
         adb.push(tmpname, wrapperPath)
-        adb.call(['shell', 'chmod', '755', wrapperPath])
         os.remove(tmpname)
+        chmod, profile = adb.shell_batch(['chmod 755 ' + wrapperPath,
+                                          'ls ' + profilePath])
 
         skipShell = False
-        if 'mozilla' not in adb.call(['shell', 'ls', profilePath]):
+        if 'mozilla' not in profile[0]:
             skipShell = True
 
         gdbserver_port = ':' + str(self.gdbserver_port
@@ -1229,8 +1358,16 @@ class FenInit(gdb.Command):
                 delattr(self, '_mochitest')
             self._task = self._chooseTask()
             self._chooseDevice()
+            # query installed packages while scanning for objdirs
+            prefetch = [adb.submit(lambda args=args: list(
+                                adb.stream(args, cache='packages')))
+                        for args in (['shell', 'pm', 'list', 'packages'],
+                                     ['shell', 'pm', 'list', 'packages', '-f'])]
             self._chooseObjdir()
             self._pullLibsAndSetPaths()
+            for f in prefetch:
+                # errors are reported again when the queries are used
+                f.exception()
 
             datadir = str(gdb.parameter('data-directory'))
             objdir = self.objdir
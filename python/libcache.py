@@ -0,0 +1,299 @@
+# vi: set tabstop=4 shiftwidth=4 expandtab:
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Content-addressed store of libraries pulled from devices. Files are
+# stored once under objects/ by SHA-1 of their contents, and each build
+# fingerprint has a manifest in builds/ mapping paths to objects.
+# Per-device sysroots are trees of hardlinks into the store, so a device
+# on a known build gets its libraries without pulling anything.
+# Files in a sysroot must be replaced by renaming a new file over them,
+# never written in place, because the store shares their contents.
+# This module does not depend on gdb, so it can be used outside of gdb.
+
+import os, errno, hashlib, json, shutil, threading, time
+
+def _makeDirs(path):
+    # other threads and sessions may be creating the same directories
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def linkFile(src, dst, symbolic=False):
+    '''Hardlinks src to dst, replacing dst; falls back to a symlink
+       or a copy if hardlinks are not supported, or if symbolic is
+       True, symlinks src to dst without falling back'''
+    dstdir = os.path.dirname(dst)
+    if dstdir and not os.path.isdir(dstdir):
+        _makeDirs(dstdir)
+    # other threads and sessions may be linking the same file
+    tmp = '%s.%d.%d.link' % (dst, os.getpid(),
+                             threading.current_thread().ident)
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    if symbolic:
+        os.symlink(src, tmp)
+        os.rename(tmp, dst)
+        return
+    try:
+        os.link(src, tmp)
+    except OSError:
+        try:
+            os.symlink(src, tmp)
+        except OSError:
+            shutil.copy2(src, tmp)
+    os.rename(tmp, dst)
+
+class LibCache(object):
+    '''Library store rooted at root; disabled if root is None'''
+
+    # hashlib algorithm naming objects
+    ALGORITHM = 'sha1'
+
+    # seconds during which objects stored or reused by checkin are not
+    # evicted, so other sessions can add them to a manifest in time
+    RECENT = 600
+
+    def __init__(self, root=None, max_size=2048 * 1024 * 1024):
+        self.root = root
+        # total size of stored objects before evicting builds least
+        # recently used; 0 disables eviction
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # root to estimated size of stored objects, from the last
+        # eviction plus objects stored since
+        self._sizes = {}
+
+    def isEnabled(self, fingerprint):
+        '''Returns True if files of the build fingerprint can be stored'''
+        return bool(self.root and fingerprint)
+
+    def _objectPath(self, digest):
+        return os.path.join(self.root, 'objects', digest[0: 2], digest)
+
+    def _manifestPath(self, fingerprint):
+        return os.path.join(self.root, 'builds',
+                hashlib.sha1(fingerprint).hexdigest() + '.json')
+
+    def _readManifest(self, path):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _writeManifest(self, path, manifest):
+        # write to a temporary file first, so readers never see a
+        # partial manifest
+        if not os.path.isdir(os.path.dirname(path)):
+            _makeDirs(os.path.dirname(path))
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f)
+        os.rename(tmp, path)
+
+    def _hash(self, path):
+        digest = hashlib.new(self.ALGORITHM)
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), ''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _sameFile(self, a, b):
+        try:
+            return os.path.samefile(a, b)
+        except OSError:
+            return False
+
+    def checkout(self, fingerprint, libdir):
+        '''Links all files stored for fingerprint into libdir;
+           returns the set of linked paths under libdir'''
+        if not self.isEnabled(fingerprint):
+            return set()
+        path = self._manifestPath(fingerprint)
+        manifest = self._readManifest(path)
+        if not manifest:
+            return set()
+        linked = set()
+        for relpath, digest in manifest['files'].iteritems():
+            obj = self._objectPath(digest)
+            dst = os.path.join(libdir, *relpath.split('/'))
+            if not os.path.isfile(obj):
+                continue
+            try:
+                if not self._sameFile(obj, dst):
+                    linkFile(obj, dst)
+                linked.add(dst)
+            except (IOError, OSError):
+                pass
+        with self._lock:
+            manifest = self._readManifest(path) or manifest
+            manifest['used'] = time.time()
+            try:
+                self._writeManifest(path, manifest)
+            except (IOError, OSError):
+                pass
+        return linked
+
+    def getIndex(self, fingerprint):
+        '''Returns the device file index saved for fingerprint, or None'''
+        if not self.isEnabled(fingerprint):
+            return None
+        manifest = self._readManifest(self._manifestPath(fingerprint))
+        return manifest.get('index') if manifest else None
+
+    def putIndex(self, fingerprint, index):
+        '''Saves a device file index for fingerprint; index is any
+           JSON-serializable object'''
+        if not self.isEnabled(fingerprint):
+            return
+        path = self._manifestPath(fingerprint)
+        with self._lock:
+            manifest = self._readManifest(path) or \
+                    {'fingerprint': fingerprint, 'files': {}}
+            manifest['index'] = index
+            manifest['used'] = time.time()
+            try:
+                self._writeManifest(path, manifest)
+            except (IOError, OSError):
+                pass
+
+    def _store(self, path, digest):
+        # adds the file at path to the store as object digest; returns
+        # the size of the object if it is new, or 0 if already stored
+        obj = self._objectPath(digest)
+        if os.path.isfile(obj):
+            try:
+                # changing the mode updates the ctime checked by evict
+                os.chmod(obj, 0444)
+            except OSError:
+                pass
+            return 0
+        if not os.path.isdir(os.path.dirname(obj)):
+            _makeDirs(os.path.dirname(obj))
+        # objects are never modified after being stored
+        tmp = '%s.%d.tmp' % (obj, os.getpid())
+        try:
+            os.link(path, tmp)
+        except OSError:
+            shutil.copy2(path, tmp)
+        os.chmod(tmp, 0444)
+        os.rename(tmp, obj)
+        return os.path.getsize(obj)
+
+    def checkin(self, fingerprint, libdir, paths, digests=None):
+        '''Adds files at paths under libdir to the store for fingerprint,
+           replacing them with links into the store; digests is a dict
+           of path to its ALGORITHM checksum, if already known'''
+        if not self.isEnabled(fingerprint):
+            return
+        hashed = []
+        for path in paths:
+            relpath = os.path.relpath(path, libdir)
+            if relpath.startswith(os.pardir) or not os.path.isfile(path):
+                continue
+            try:
+                digest = digests.get(path) if digests else None
+                hashed.append((path, relpath, digest or self._hash(path)))
+            except (IOError, OSError):
+                pass
+        if not hashed:
+            return
+        mpath = self._manifestPath(fingerprint)
+        added = 0
+        # objects are only referenced once the manifest is written,
+        # so evict() must not run in between
+        with self._lock:
+            files = {}
+            for path, relpath, digest in hashed:
+                try:
+                    added += self._store(path, digest)
+                    obj = self._objectPath(digest)
+                    if not self._sameFile(obj, path):
+                        linkFile(obj, path)
+                except (IOError, OSError):
+                    continue
+                files['/'.join(relpath.split(os.sep))] = digest
+            if not files:
+                return
+            # merge with entries added by other sessions
+            manifest = self._readManifest(mpath) or \
+                    {'fingerprint': fingerprint, 'files': {}}
+            manifest['files'].update(files)
+            manifest['used'] = time.time()
+            try:
+                self._writeManifest(mpath, manifest)
+            except (IOError, OSError):
+                return
+            size = self._sizes.get(self.root)
+            if size is not None:
+                size = self._sizes[self.root] = size + added
+        # walking the store is only worth it when the limit may be crossed
+        if self.max_size and (size is None or size > self.max_size):
+            self.evict()
+
+    def evict(self, max_size=None):
+        '''Removes builds least recently used until stored objects
+           take up at most max_size bytes, then removes objects no
+           longer used by any build'''
+        max_size = self.max_size if max_size is None else max_size
+        if not self.root:
+            return
+        with self._lock:
+            buildsdir = os.path.join(self.root, 'builds')
+            builds = []
+            for name in os.listdir(buildsdir) \
+                    if os.path.isdir(buildsdir) else []:
+                path = os.path.join(buildsdir, name)
+                manifest = self._readManifest(path)
+                if manifest:
+                    builds.append((manifest.get('used', 0), path, manifest))
+            builds.sort()
+
+            objects = {}
+            recent = set()
+            objdir = os.path.join(self.root, 'objects')
+            for dirpath, dirnames, filenames in os.walk(objdir):
+                for name in filenames:
+                    try:
+                        st = os.stat(os.path.join(dirpath, name))
+                    except OSError:
+                        continue
+                    objects[name] = st.st_size
+                    if time.time() - st.st_ctime < self.RECENT:
+                        recent.add(name)
+
+            def referenced():
+                return set(digest for used, path, manifest in builds
+                           for digest in manifest['files'].itervalues())
+            keep = referenced()
+            total = sum(size for digest, size in objects.iteritems()
+                        if digest in keep)
+            while max_size and builds and total > max_size:
+                used, path, manifest = builds.pop(0)
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                keep = referenced()
+                total = sum(size for digest, size in objects.iteritems()
+                            if digest in keep)
+
+            for digest in objects:
+                # skip objects being written, or about to be added to a
+                # manifest, by checkin in other sessions
+                if digest in keep or digest in recent or \
+                        digest.endswith('.tmp'):
+                    continue
+                try:
+                    os.remove(self._objectPath(digest))
+                except OSError:
+                    pass
+            self._sizes[self.root] = sum(size for digest, size
+                    in objects.iteritems() if digest in keep or
+                    digest in recent)
+
+default = LibCache()
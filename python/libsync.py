@@ -0,0 +1,408 @@
+# vi: set tabstop=4 shiftwidth=4 expandtab:
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Scheduling of file pulls from a device. Workers take files from one
+# shared queue, largest first, so a single large library does not hold
+# up a batch of files while other workers sit idle. Device access goes
+# through an adapter object with the methods
+#   shell(command)  returns output of the shell command
+#   pull(files)     pulls (src, dst) pairs; returns adbclient.Transfer list
+#   read_file(path) returns contents of a device file
+#   exec_out(command)  returns raw output of the command, without a PTY
+# This module does not depend on gdb, so it can be used outside of gdb.
+
+import os, re, threading, time, calendar, hashlib, json, adbclient
+
+# date field in "ls -l" output; ISO dates from toolbox and toybox,
+# or the month name from busybox
+_DATE_RE = re.compile(r'^(\d{4}-\d\d-\d\d|[A-Z][a-z][a-z])$')
+
+# directories searched for libraries gdb only knows by name
+LIB_ROOTS = ['/system/lib', '/system/vendor/lib']
+
+# a worker takes files from the queue until it has this many bytes or
+# as many files as a sync connection pipelines, so small files share
+# round-trips while large files are still spread over the workers
+BATCH_BYTES = 1024 * 1024
+BATCH_FILES = adbclient.Client.SYNC_WINDOW
+
+def _isListError(fields):
+    # anything but an entry or the total of a listing is an error
+    # message, possibly from stderr interleaved with the listing
+    return bool(fields) and fields[0] != 'total' and \
+           not (len(fields[0]) >= 10 and fields[0][0] in '-dlcbps')
+
+def parseEntries(text, dirs=(), listed=None):
+    '''Parses output of "ls -l DIR..." or "ls -lR DIR..." from toolbox,
+       toybox or busybox; yields (path, size, mtime) for each file, with
+       None for the size of symlinks and for mtimes that cannot be parsed.
+       dirs are the listed directories, needed when only one is listed.
+       If listed is a dict, each directory listed without errors is added
+       to it with a list of the paths of its subdirectories'''
+    current = dirs[0].rstrip('/') if len(dirs) == 1 else None
+    failed = set()
+    missing = set()
+    if listed is not None and current:
+        listed[current] = []
+    for line in text.splitlines():
+        line = line.rstrip('\r')
+        if line.endswith(':') and line.startswith('/'):
+            # header before each directory when listing several
+            current = line[: -1].rstrip('/')
+            if listed is not None:
+                listed.setdefault(current, [])
+            continue
+        fields = line.split()
+        if listed is not None and _isListError(fields):
+            # errors name the directory, except for toolbox's
+            paths = [p.rstrip('/') for p in re.findall(r"/[^\s:'\"]*", line)]
+            if 'No such file' in line:
+                missing.update(paths)
+            else:
+                failed.update(paths or [current])
+            continue
+        if current is None or len(fields) < 6 or \
+                len(fields[0]) < 10 or fields[0][0] not in '-ld':
+            continue
+        for i in range(3, len(fields) - 2):
+            # toolbox leaves out the size of symlinks and directories
+            if _DATE_RE.match(fields[i]) and \
+                    (fields[i - 1].isdigit() or fields[0][0] in 'ld'):
+                break
+        else:
+            continue
+        mtime = None
+        if fields[i][0].isdigit():
+            try:
+                mtime = calendar.timegm(time.strptime(
+                        fields[i] + ' ' + fields[i + 1], '%Y-%m-%d %H:%M'))
+            except ValueError:
+                pass
+        # busybox dates take three fields, others two
+        name = ' '.join(fields[i + (3 if fields[i][0].isalpha() else 2):])
+        if fields[0][0] == 'd':
+            if listed is not None and current in listed:
+                listed[current].append(current + '/' + name)
+        elif fields[0][0] == 'l':
+            yield current + '/' + name.partition(' -> ')[0], None, mtime
+        else:
+            yield current + '/' + name, int(fields[i - 1]), mtime
+    if listed is not None:
+        # directories that could not be listed; missing ones are
+        # known to have no files
+        for path in failed:
+            listed.pop(path, None)
+        for path in missing:
+            listed[path] = []
+
+def parseListing(text, dirs=()):
+    '''Parses "ls -l" output as for parseEntries;
+       returns a dict of remote file path to size'''
+    return dict((path, size) for path, size, mtime
+                in parseEntries(text, dirs))
+
+def remoteSizes(device, dirs):
+    '''Lists dirs on the device with one shell command; returns
+       a dict of remote file path to size as for parseListing'''
+    dirs = sorted(set(d.rstrip('/') or '/' for d in dirs))
+    if not dirs:
+        return {}
+    return parseListing(device.shell('ls -l ' + ' '.join(dirs)), dirs)
+
+class LibIndex(object):
+    '''Files under the library directories of a device'''
+
+    def __init__(self, entries, roots=LIB_ROOTS, dirs=None):
+        # remote path to [size, mtime]
+        self.entries = entries
+        self.roots = roots
+        # directories listed completely, to paths of their subdirectories
+        self.dirs = dirs or {}
+        self._names = None
+
+    def __contains__(self, path):
+        return path in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def covers(self, path):
+        '''Returns True if path is known to exist or not to exist'''
+        child = path
+        parent = path.rpartition('/')[0]
+        while parent:
+            if parent in self.dirs:
+                # the listing has path, or shows that a directory
+                # leading to path does not exist
+                return child == path or child not in self.dirs[parent]
+            child, parent = parent, parent.rpartition('/')[0]
+        return False
+
+    def size(self, path):
+        entry = self.entries.get(path)
+        return entry[0] if entry else None
+
+    def mtime(self, path):
+        entry = self.entries.get(path)
+        return entry[1] if entry else None
+
+    def sizes(self):
+        return dict((path, entry[0])
+                    for path, entry in self.entries.iteritems())
+
+    def toDict(self):
+        return {'entries': self.entries, 'roots': self.roots,
+                'dirs': self.dirs}
+
+    def locate(self, name):
+        '''Returns paths of files with the file name name'''
+        if self._names is None:
+            self._names = {}
+            for path in sorted(self.entries):
+                self._names.setdefault(
+                        path.rpartition('/')[2], []).append(path)
+        return self._names.get(name, [])
+
+def buildIndex(device, roots=LIB_ROOTS):
+    '''Lists roots recursively on the device with one shell command;
+       returns a LibIndex'''
+    text = device.shell('ls -lR ' + ' '.join(roots))
+    dirs = {}
+    return LibIndex(dict((path, [size, mtime]) for path, size, mtime
+                         in parseEntries(text, roots, dirs)), roots, dirs)
+
+def loadIndex(saved):
+    '''Returns the LibIndex saved by LibIndex.toDict, or None if saved
+       is not such an index'''
+    if not isinstance(saved, dict) or 'dirs' not in saved:
+        return None
+    return LibIndex(saved['entries'], saved['roots'], saved['dirs'])
+
+def deviceId(device):
+    '''Returns a string identifying the kernel and build of the device;
+       libraries pulled for a device stay current while its id is the same'''
+    return (device.read_file('/proc/version') +
+            device.read_file('/system/build.prop'))[0: 2048].strip()
+
+def isSynced(libdir, devid):
+    '''Returns True if libraries in libdir were pulled for device id devid'''
+    try:
+        with open(os.path.join(libdir, '.id'), 'r') as libid:
+            return libid.read(2048) == devid
+    except IOError:
+        return False
+
+def markSynced(libdir, devid):
+    try:
+        with open(os.path.join(libdir, '.id'), 'w') as libid:
+            libid.write(devid)
+    except IOError:
+        pass
+
+def parseChecksums(text):
+    '''Parses output of md5sum or sha1sum; returns a dict of path to digest'''
+    sums = {}
+    for line in text.splitlines():
+        digest, sep, path = line.rstrip('\r').partition(' ')
+        if sep and re.match(r'^[0-9a-f]{32,40}$', digest):
+            sums[path.lstrip(' *')] = digest
+    return sums
+
+def remoteChecksums(device, paths):
+    '''Checksums paths on the device with one md5sum run, or one sha1sum
+       run if md5sum is missing; returns (algorithm, dict of path to digest),
+       or (None, {}) if neither is available'''
+    paths = sorted(set(paths))
+    if not paths:
+        return None, {}
+    for algorithm in ('md5', 'sha1'):
+        # a missing path makes the tool fail but still sum the others
+        sums = parseChecksums(device.shell(algorithm + 'sum ' +
+                                           ' '.join(paths) + ' 2>/dev/null'))
+        if sums:
+            return algorithm, sums
+    return None, {}
+
+def localChecksums(path, algorithms):
+    '''Returns a dict of each algorithm to the checksum of the local file
+       path, computed in one read'''
+    digests = dict((algorithm, hashlib.new(algorithm))
+                   for algorithm in algorithms)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), ''):
+            for digest in digests.itervalues():
+                digest.update(block)
+    return dict((algorithm, digest.hexdigest())
+                for algorithm, digest in digests.iteritems())
+
+def localChecksum(path, algorithm):
+    return localChecksums(path, [algorithm])[algorithm]
+
+class Manifest(object):
+    '''Record of the files pulled into a local directory: the remote path,
+       size, remote mtime and checksum of each file, so changed files can
+       be pulled again and truncated local copies detected'''
+
+    FILE_NAME = '.manifest'
+
+    def __init__(self, libdir):
+        self.libdir = libdir
+        self._lock = threading.Lock()
+        try:
+            with open(os.path.join(libdir, self.FILE_NAME), 'r') as f:
+                self.files = json.load(f)
+        except (IOError, ValueError):
+            self.files = {}
+
+    def _key(self, dst):
+        return '/'.join(os.path.relpath(dst, self.libdir).split(os.sep))
+
+    def get(self, dst):
+        '''Returns the entry for the local file dst, or None'''
+        return self.files.get(self._key(dst))
+
+    def isTruncated(self, dst):
+        '''Returns True if dst differs in size from when it was pulled'''
+        entry = self.get(dst)
+        try:
+            return bool(entry) and os.path.getsize(dst) != entry['size']
+        except OSError:
+            return False
+
+    def localChecksum(self, dst, algorithm):
+        '''Returns the checksum of dst, from the manifest if possible'''
+        entry = self.get(dst)
+        if entry and entry.get('algorithm') == algorithm and \
+                not self.isTruncated(dst):
+            return entry['checksum']
+        return localChecksum(dst, algorithm)
+
+    def update(self, dst, src, mtime=None, checksum=None, algorithm='md5',
+               extra=()):
+        '''Records the local file dst as pulled from src; the checksum
+           is computed from dst if not given. Returns a dict of each
+           algorithm in extra to the checksum of dst, computed in the
+           same read'''
+        size = os.path.getsize(dst)
+        sums = {}
+        if extra or checksum is None:
+            sums = localChecksums(dst, set(extra) |
+                    (set([algorithm]) if checksum is None else set()))
+        if checksum is None:
+            checksum = sums[algorithm]
+        with self._lock:
+            self.files[self._key(dst)] = {'src': src, 'size': size,
+                    'mtime': mtime, 'checksum': checksum,
+                    'algorithm': algorithm}
+        return dict((name, sums[name]) for name in extra)
+
+    def save(self):
+        path = os.path.join(self.libdir, self.FILE_NAME)
+        with self._lock:
+            try:
+                tmp = path + '.tmp'
+                with open(tmp, 'w') as f:
+                    json.dump(self.files, f)
+                os.rename(tmp, path)
+            except (IOError, OSError):
+                pass
+
+def changedFiles(device, files, manifest):
+    '''Filters (src, dst) pairs to the ones whose local dst is missing or
+       differs from src on the device, using one remote checksum run;
+       returns (files, algorithm, dict of src to remote checksum)'''
+    existing = [(src, dst) for src, dst in files if os.path.isfile(dst)]
+    algorithm, sums = remoteChecksums(device,
+                                      [src for src, dst in existing])
+    if not algorithm:
+        return files, None, {}
+    current = set()
+    for src, dst in existing:
+        try:
+            if src in sums and \
+                    manifest.localChecksum(dst, algorithm) == sums[src]:
+                current.add(dst)
+        except (IOError, OSError):
+            pass
+    # skip every source searched for an up-to-date file
+    return [(src, dst) for src, dst in files if dst not in current], \
+           algorithm, sums
+
+def isPermanent(error):
+    '''Returns True if retrying a pull that failed with error is futile'''
+    return 'does not exist' in error or 'is a directory' in error
+
+def sync(device, files, jobs=5, retries=2, sizes=None, callback=None,
+         first=(), telemetry=None):
+    '''Pulls (src, dst) pairs through device.pull with jobs workers sharing
+       one queue, sources in first before others, and largest file first
+       according to sizes; first may gain sources while pulling. Each
+       worker pulls a batch of files at a time, and transient failures
+       are retried up to retries times. Calls
+       callback with the final Transfer of each file, records it in the
+       loadstats.Telemetry telemetry if given, and returns them in the
+       order of files'''
+    sizes = sizes or {}
+    order = {}
+    for i, f in enumerate(files):
+        order.setdefault(f, i)
+    # the end of the list is the front of the queue
+    queue = sorted(order, key=lambda f: (f[0] in first,
+                                         (sizes.get(f[0]) or 0), -order[f]))
+    lock = threading.Lock()
+    attempts = {}
+    results = {}
+    # number of sources in first when the queue was last sorted
+    prioritized = [len(first)]
+
+    def take():
+        # next batch of files from the front of the queue
+        batch = []
+        size = 0
+        with lock:
+            if len(first) != prioritized[0]:
+                # move sources added to first to the front, keeping the
+                # order of the others
+                prioritized[0] = len(first)
+                queue.sort(key=lambda f: f[0] in first)
+            while queue and len(batch) < BATCH_FILES and size < BATCH_BYTES:
+                batch.append(queue.pop())
+                size += sizes.get(batch[-1][0]) or 0
+        return batch
+
+    def work():
+        while True:
+            batch = take()
+            if not batch:
+                return
+            try:
+                transfers = device.pull(batch)
+            except Exception as e:
+                transfers = [adbclient.Transfer(f[0], f[1], 0, 0.0, str(e))
+                             for f in batch]
+            for f, transfer in zip(batch, transfers):
+                with lock:
+                    attempts[f] = attempts.get(f, 0) + 1
+                    if transfer.error and \
+                            not isPermanent(transfer.error) and \
+                            attempts[f] <= retries:
+                        # retry after the other files
+                        queue.insert(0, f)
+                        continue
+                    results[f] = transfer
+                if telemetry:
+                    telemetry.addTransfer(transfer,
+                            threading.current_thread().name, attempts[f] - 1)
+                if callback:
+                    callback(transfer)
+
+    threads = [threading.Thread(name='LibSync-%d' % i, target=work)
+               for i in range(max(1, min(jobs, len(queue))))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return [results[f] for f in files]
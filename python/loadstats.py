@@ -0,0 +1,90 @@
+# vi: set tabstop=4 shiftwidth=4 expandtab:
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Telemetry of library loading runs: time spent in each phase, and the
+# size, duration, worker, retry count and outcome of every transfer.
+# This module does not depend on gdb, so it can be used outside of gdb.
+
+import time, threading, contextlib, collections
+
+class Telemetry(object):
+    '''Timing of one run loading libraries from device serial'''
+
+    def __init__(self, serial=None):
+        self.serial = serial
+        self.started = time.time()
+        # other details worth comparing between runs, e.g. build
+        self.info = {}
+        # phase name to seconds, in the order phases first ran
+        self.phases = collections.OrderedDict()
+        self.transfers = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        '''Adds time spent in the with block to phase name'''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.addPhase(name, time.time() - start)
+
+    def addPhase(self, name, seconds):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def addTransfer(self, transfer, worker=None, retries=0):
+        '''Records the final adbclient.Transfer of a file'''
+        with self._lock:
+            self.transfers.append({'src': transfer.src, 'dst': transfer.dst,
+                    'size': transfer.size, 'seconds': transfer.seconds,
+                    'worker': worker, 'retries': retries,
+                    'error': transfer.error})
+
+    def summary(self):
+        with self._lock:
+            transfers = list(self.transfers)
+            pull = self.phases.get('pull', 0.0)
+        done = [t for t in transfers if not t['error']]
+        size = sum(t['size'] for t in done)
+        return {'files': len(done), 'failed': len(transfers) - len(done),
+                'bytes': size,
+                'retries': sum(t['retries'] for t in transfers),
+                'throughput': size / pull if pull else 0.0}
+
+    def toDict(self):
+        summary = self.summary()
+        with self._lock:
+            return {'serial': self.serial, 'started': self.started,
+                    'info': dict(self.info), 'phases': dict(self.phases),
+                    'summary': summary, 'transfers': list(self.transfers)}
+
+def formatReport(data, slowest=5):
+    '''Returns lines describing a run, given Telemetry.toDict() output'''
+    summary = data['summary']
+    lines = ['Device %s, started %s' % (data['serial'] or '(default)',
+             time.strftime('%Y-%m-%d %H:%M:%S',
+                           time.localtime(data['started'])))]
+    for key, value in sorted(data['info'].iteritems()):
+        lines.append('  %s: %s' % (key, value))
+    for name, seconds in sorted(data['phases'].iteritems(),
+                                key=lambda p: -p[1]):
+        lines.append('  %-10s %8.3fs' % (name, seconds))
+    lines.append('  %d file(s), %d bytes at %.1f KB/s; %d failed, '
+                  '%d retries' % (summary['files'], summary['bytes'],
+                  summary['throughput'] / 1024, summary['failed'],
+                  summary['retries']))
+    workers = {}
+    for t in data['transfers']:
+        count, size = workers.get(t['worker'], (0, 0))
+        workers[t['worker']] = (count + 1, size + t['size'])
+    for worker, (count, size) in sorted(workers.iteritems()):
+        lines.append('  worker %s: %d file(s), %d bytes' % (
+                     worker, count, size))
+    transfers = sorted(data['transfers'], key=lambda t: -t['seconds'])
+    for t in transfers[0: slowest]:
+        lines.append('  %8.3fs %10d %s%s' % (t['seconds'], t['size'],
+                     t['src'], ' (%s)' % t['error'] if t['error'] else ''))
+    return lines
@@ -0,0 +1,76 @@
+# vi: set tabstop=4 shiftwidth=4 expandtab:
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Parser for /proc/<pid>/maps of a device process, giving the mapped
+# libraries and a fast lookup of the library containing an address.
+# This module does not depend on gdb, so it can be used outside of gdb.
+
+import bisect, collections
+
+Mapping = collections.namedtuple('Mapping',
+        ['start', 'end', 'perms', 'offset', 'path'])
+
+# mapped files under these directories or with these extensions
+# are never libraries, even if mapped executable
+IGNORED_PREFIXES = ('/dev/', '/proc/', '/sys/')
+IGNORED_SUFFIXES = ('.apk', '.jar', '.dex', '.odex', '.oat', '.art')
+
+def parseMaps(text):
+    '''Parses contents of /proc/<pid>/maps; returns a list of Mapping
+       sorted by start address, with '' as path of anonymous mappings'''
+    mappings = []
+    for line in text.splitlines():
+        # address perms offset dev inode [path]
+        fields = line.split(None, 5)
+        if len(fields) < 5 or '-' not in fields[0]:
+            continue
+        try:
+            start, sep, end = fields[0].partition('-')
+            mappings.append(Mapping(int(start, 16), int(end, 16), fields[1],
+                    int(fields[2], 16),
+                    fields[5].strip() if len(fields) > 5 else ''))
+        except ValueError:
+            continue
+    mappings.sort()
+    return mappings
+
+class MapsTable(object):
+    '''Address ranges of the files mapped into a process'''
+
+    def __init__(self, mappings):
+        self.mappings = [m for m in mappings if m.path]
+        self._starts = [m.start for m in self.mappings]
+
+    def find(self, addr):
+        '''Returns the Mapping containing addr, or None'''
+        i = bisect.bisect_right(self._starts, addr) - 1
+        if i >= 0 and addr < self.mappings[i].end:
+            return self.mappings[i]
+        return None
+
+    def library(self, addr):
+        '''Returns the path of the library containing addr, or None'''
+        m = self.find(addr)
+        return m.path if m and self.isLibrary(m.path) else None
+
+    def isLibrary(self, path):
+        return path.startswith('/') and not path.endswith(' (deleted)') and \
+               not path.startswith(IGNORED_PREFIXES) and \
+               not path.endswith(IGNORED_SUFFIXES)
+
+    def libraries(self):
+        '''Returns a list of (path, start, end) of every file with code
+           mapped into the process, ordered by load address'''
+        ranges = collections.OrderedDict()
+        executable = set()
+        for m in self.mappings:
+            if not self.isLibrary(m.path):
+                continue
+            if 'x' in m.perms:
+                executable.add(m.path)
+            start, end = ranges.get(m.path, (m.start, m.end))
+            ranges[m.path] = (min(start, m.start), max(end, m.end))
+        return [(path, low, high) for path, (low, high)
+                in ranges.iteritems() if path in executable]
@@ -0,0 +1,198 @@
+# vi: set tabstop=4 shiftwidth=4 expandtab:
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Daemon keeping per-device library directories up to date outside of
+# gdb. It watches for devices with "adb track-devices", and pulls the
+# libraries of each connected device into lib/<serial> in the background,
+# so the next gdb session finds them already pulled and "fastload quick"
+# has nothing left to do.
+# This module does not depend on gdb, so it can be used outside of gdb.
+
+import os, sys, threading, time, adbclient, libsync, libcache
+
+# files pulled besides the libraries under libsync.LIB_ROOTS
+EXTRA_FILES = ['/system/bin/app_process', '/system/bin/linker']
+
+# seconds to wait before reconnecting to the adb server
+RETRY_INTERVAL = 5
+
+def log(message):
+    sys.stdout.write('%s %s\n' % (time.strftime('%H:%M:%S'), message))
+    sys.stdout.flush()
+
+class Device(object):
+    '''libsync device adapter talking to the adb server directly'''
+
+    def __init__(self, client, serial):
+        self.client = client
+        self.serial = serial
+
+    def shell(self, command):
+        return self.client.shell(self.serial, command)
+
+    def pull(self, files):
+        return self.client.pullMany(self.serial, files)
+
+    def read_file(self, path):
+        return self.client.readFile(self.serial, path)
+
+    def exec_out(self, command):
+        return self.client.execOut(self.serial, command)
+
+def syncDevice(device, libdir, jobs=5):
+    '''Pulls libraries of device into libdir, unless they were already
+       pulled for its device id; returns the number of files pulled and
+       the Transfers of files that could not be pulled'''
+    devid = libsync.deviceId(device)
+    if libsync.isSynced(libdir, devid):
+        return 0, []
+    fingerprint = device.shell(
+            'getprop ro.build.fingerprint 2>/dev/null').strip()
+    # libraries of devices on the same build are already in the cache
+    linked = libcache.default.checkout(fingerprint, libdir)
+    index = libsync.loadIndex(libcache.default.getIndex(fingerprint))
+    if not index:
+        index = libsync.buildIndex(device)
+        libcache.default.putIndex(fingerprint, index.toDict())
+    sizes = index.sizes()
+    sizes.update(libsync.remoteSizes(device,
+            [src.rpartition('/')[0] for src in EXTRA_FILES]))
+
+    manifest = libsync.Manifest(libdir)
+    files = []
+    for src in sorted(sizes):
+        if sizes[src] is None or \
+                not (src.endswith('.so') and src in index or
+                     src in EXTRA_FILES):
+            continue
+        dst = os.path.join(libdir, *src.lstrip('/').split('/'))
+        if dst not in linked or manifest.isTruncated(dst):
+            files.append((src, dst))
+    files, algorithm, sums = libsync.changedFiles(device, files, manifest)
+
+    transfers = libsync.sync(device, files, jobs, sizes=sizes)
+    pulled = [t.dst for t in transfers if not t.error]
+    # checksums for the library cache come from the same read
+    # as checksums for the manifest
+    extra = [libcache.default.ALGORITHM] \
+            if libcache.default.isEnabled(fingerprint) else []
+    digests = {}
+    for t in transfers:
+        if t.error:
+            continue
+        try:
+            digests[t.dst] = manifest.update(t.dst, t.src,
+                    index.mtime(t.src), sums.get(t.src),
+                    algorithm or 'md5', extra)
+        except (IOError, OSError):
+            pass
+    manifest.save()
+    libcache.default.checkin(fingerprint, libdir, pulled,
+            dict((dst, local[libcache.default.ALGORITHM])
+                 for dst, local in digests.iteritems() if local))
+    failed = [t for t in transfers
+              if t.error and not libsync.isPermanent(t.error)]
+    if not failed:
+        libsync.markSynced(libdir, devid)
+    return len(pulled), failed
+
+class SyncDaemon(object):
+    '''Syncs lib/<serial> under libroot for every device that connects'''
+
+    def __init__(self, libroot, jobs=5, client=None):
+        self.libroot = libroot
+        self.jobs = jobs
+        self.client = client or adbclient.Client()
+        # serials of devices being synced
+        self.active = set()
+        self._lock = threading.Lock()
+
+    def _sync(self, serial):
+        start = time.time()
+        try:
+            count, failed = syncDevice(Device(self.client, serial),
+                    os.path.join(self.libroot, serial), self.jobs)
+            for t in failed:
+                log('%s: cannot pull %s: %s' % (serial, t.src, t.error))
+            if count or failed:
+                log('%s: pulled %d file(s) in %.1fs%s' % (serial, count,
+                    time.time() - start,
+                    ', retrying on reconnect' if failed else ''))
+            else:
+                log('%s: libraries up to date' % serial)
+        except (adbclient.ADBError, IOError, OSError) as e:
+            log('%s: sync failed: %s' % (serial, str(e)))
+        finally:
+            self.client.close(serial)
+            with self._lock:
+                self.active.discard(serial)
+
+    def start(self, serial):
+        '''Syncs the device in background, unless already syncing it;
+           returns the syncing thread, or None'''
+        with self._lock:
+            if serial in self.active:
+                return None
+            self.active.add(serial)
+        log('%s: syncing libraries' % serial)
+        thread = threading.Thread(name='SyncDevice-' + serial,
+                                  target=self._sync, args=(serial,))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def syncAttached(self):
+        '''Syncs every attached device and waits for them to finish'''
+        try:
+            devices = self.client.devices()
+        except adbclient.ADBError as e:
+            log('lost adb server: %s' % str(e))
+            return
+        threads = [self.start(serial) for serial, state
+                   in devices if state == 'device']
+        for thread in threads:
+            while thread and thread.is_alive():
+                thread.join(0.5)
+
+    def run(self):
+        '''Syncs devices as they connect, until interrupted'''
+        while True:
+            try:
+                for devices in self.client.trackDevices():
+                    for serial, state in devices:
+                        if state == 'device':
+                            self.start(serial)
+            except adbclient.ADBError as e:
+                log('lost adb server: %s' % str(e))
+            time.sleep(RETRY_INTERVAL)
+
+if __name__ == '__main__': # not module
+
+    from optparse import OptionParser
+
+    parser = OptionParser(usage='%prog [options] LIBDIR')
+    parser.add_option('-j', dest='jobs', type='int', default=5,
+                      help='files pulled at the same time (default 5)')
+    parser.add_option('-s', dest='store',
+                      help='library cache directory (default LIBDIR/.store)')
+    parser.add_option('--once', dest='once', action='store_true',
+                      help='sync attached devices and exit')
+    (args, extras) = parser.parse_args()
+
+    if len(extras) != 1:
+        parser.error('missing LIBDIR, the lib directory next to the '
+                     'gdb data directory')
+    libroot = os.path.abspath(os.path.expanduser(extras[0]))
+    libcache.default.root = os.path.abspath(os.path.expanduser(
+            args.store or os.path.join(libroot, '.store')))
+
+    daemon = SyncDaemon(libroot, max(1, args.jobs))
+    try:
+        if args.once:
+            daemon.syncAttached()
+        else:
+            daemon.run()
+    except KeyboardInterrupt:
+        pass
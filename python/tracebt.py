@@ -3,7 +3,8 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-import gdb, re, logging, os
+import gdb, re, logging, os, struct, bisect, collections
+import armdecode, buildid, unwindtab
 
 class LogLimiter:
     def __init__(self):
@@ -28,15 +29,330 @@ log = logging.getLogger(__name__)
 logLimiter = LogLimiter()
 _initLogger(log)
 
+class CodeRange(tuple):
+    '''Instructions (pc, mnemonic, args) disassembled from start to end'''
+    def __new__(cls, start, end, is_thumb, insts):
+        return tuple.__new__(cls, (start, end, is_thumb, insts))
+
+class InstructionCache:
+    '''Disassembled instructions kept across frames and tracebt runs.
+       Ranges are stored by library and offset from the library's code,
+       so they stay valid when the library is loaded at another address;
+       code outside of libraries is only kept for one tracebt run'''
+
+    MAX_INSTRUCTIONS = 20000
+    RE_SOLIB = re.compile(
+            r'^(0x[\da-f]+)\s+(0x[\da-f]+)\s+\S+(?:\s+\(\*\))?\s+(.+)$')
+
+    def __init__(self):
+        # (library key, is_thumb) to sorted offsets of range starts,
+        # and to the ranges themselves, with offsets for addresses
+        self._starts = {}
+        self._ranges = {}
+        # (library key, is_thumb, start) in least recently used order
+        self._lru = collections.OrderedDict()
+        # (library key, is_thumb, start) to (base, range relocated to
+        # base), so find() relocates each range once per load address
+        self._relocated = {}
+        self.count = 0
+        self._solibs = None
+        self._keys = {}
+
+    def clearSolibs(self, event=None):
+        '''Forgets library addresses, after libraries are loaded or
+           unloaded; cached instructions are kept'''
+        self._solibs = None
+        self.clear(None)
+
+    def solib(self, pc):
+        '''Returns (start, end, path) of the code of the library with
+           code at pc, or None'''
+        if self._solibs is None:
+            self._solibs = []
+            for line in gdb.execute('info sharedlibrary',
+                                    False, True).splitlines():
+                match = self.RE_SOLIB.match(line.strip())
+                if match:
+                    self._solibs.append((int(match.group(1), 16),
+                            int(match.group(2), 16), match.group(3).strip()))
+            self._solibs.sort()
+        i = bisect.bisect_right(self._solibs, (pc, float('inf'))) - 1
+        if i < 0 or pc >= self._solibs[i][1]:
+            return None
+        return self._solibs[i]
+
+    def _library(self, pc):
+        # returns (key, base) of the library with code at pc, where key
+        # is the build-id of the library file, or its path
+        solib = self.solib(pc)
+        if not solib:
+            return None, 0
+        start, end, path = solib
+        if path not in self._keys:
+            self._keys[path] = buildid.readBuildId(path) or path
+        return self._keys[path], start
+
+    def find(self, pc, is_thumb):
+        '''Returns the CodeRange containing pc, or None'''
+        key, base = self._library(pc)
+        starts = self._starts.get((key, is_thumb))
+        if not starts:
+            return None
+        ranges = self._ranges[(key, is_thumb)]
+        i = bisect.bisect_right(starts, pc - base) - 1
+        # ranges can overlap by an instruction
+        for r in (ranges[j] for j in (i, i - 1) if j >= 0):
+            if r[0] <= pc - base < r[1]:
+                lru = (key, is_thumb, r[0])
+                self._lru[lru] = self._lru.pop(lru)
+                if not base:
+                    return r
+                cached = self._relocated.get(lru)
+                if not cached or cached[0] != base:
+                    cached = self._relocated[lru] = (base, CodeRange(
+                            r[0] + base, r[1] + base, is_thumb,
+                            armdecode.relocate(r[3], base)))
+                return cached[1]
+        return None
+
+    def nextStart(self, pc, is_thumb):
+        '''Returns the start of the first range after pc, or None'''
+        key, base = self._library(pc)
+        starts = self._starts.get((key, is_thumb))
+        i = bisect.bisect_right(starts, pc - base) if starts else 0
+        return starts[i] + base if starts and i < len(starts) else None
+
+    def add(self, r):
+        '''Adds the CodeRange r, evicting ranges least recently used'''
+        key, base = self._library(r[0])
+        starts = self._starts.setdefault((key, r[2]), [])
+        ranges = self._ranges.setdefault((key, r[2]), [])
+        start = r[0] - base
+        i = bisect.bisect_left(starts, start)
+        if i < len(starts) and starts[i] == start:
+            return
+        starts.insert(i, start)
+        ranges.insert(i, CodeRange(start, r[1] - base, r[2],
+                      armdecode.relocate(r[3], -base) if base else r[3]))
+        self._lru[(key, r[2], start)] = None
+        self.count += len(r[3])
+        while self.count > self.MAX_INSTRUCTIONS and len(self._lru) > 1:
+            self._remove(*self._lru.popitem(last=False)[0])
+
+    def _remove(self, key, is_thumb, start):
+        starts = self._starts[(key, is_thumb)]
+        i = bisect.bisect_left(starts, start)
+        self.count -= len(self._ranges[(key, is_thumb)][i][3])
+        self._relocated.pop((key, is_thumb, start), None)
+        del starts[i]
+        del self._ranges[(key, is_thumb)][i]
+
+    def clear(self, key):
+        '''Removes ranges of library key, or of code outside of
+           libraries if key is None'''
+        for lru in [l for l in self._lru if l[0] == key]:
+            del self._lru[lru]
+            self._remove(*lru)
+
+instructionCache = InstructionCache()
+if hasattr(gdb.events, 'new_objfile'):
+    gdb.events.new_objfile.connect(instructionCache.clearSolibs)
+if hasattr(gdb.events, 'clear_objfiles'):
+    gdb.events.clear_objfiles.connect(instructionCache.clearSolibs)
+
+# functions called with the pc of each frame before it is printed,
+# e.g. to load symbols of its library on demand
+frameHooks = []
+
+class StackReader:
+    '''Reads stack words from windows of memory fetched in one request,
+       instead of one request per word'''
+
+    MIN_WINDOW = 0x400
+    MAX_WINDOW = 0x4000
+    PAGE_SIZE = 0x1000
+
+    def __init__(self):
+        self._start = 0
+        self._data = ''
+        self._size = self.MIN_WINDOW
+
+    def _fill(self, addr):
+        # unwinding walks up the stack, so fetch the memory above addr,
+        # in larger windows each time the previous one runs out
+        if self._data and addr >= self._start:
+            self._size = min(self._size * 2, self.MAX_WINDOW)
+        size = self._size
+        while True:
+            try:
+                self._data = str(
+                        gdb.selected_inferior().read_memory(addr, size))
+                break
+            except gdb.MemoryError:
+                # window runs past the end of the stack mapping; try up
+                # to the end of the page, then smaller windows
+                if size <= 4:
+                    raise
+                page = ((addr + self.PAGE_SIZE) & ~(self.PAGE_SIZE - 1)) - addr
+                size = page if page < size else size / 2
+        self._start = addr
+
+    def read(self, addr):
+        '''Returns the 32-bit word at addr'''
+        if addr < self._start or addr + 4 > self._start + len(self._data):
+            self._fill(addr)
+        return struct.unpack_from('<I', self._data, addr - self._start)[0]
+
+class UnwindPlan:
+    '''How to find the caller of a frame, from tracing the code once: the
+       caller's pc and sp, and the registers the code changes. Values are
+       linear expressions (offset, ((atom, factor), ...)) of the frame's
+       state, where an atom is a register name, or ('load', value) for
+       the stack word at the address given by value'''
+
+    # mnemonics of instructions _unwind interprets
+    EFFECTS = ('b', 'cb', 'push', 'pop', 'vpush', 'vpop', 'stmd', 'ldmi',
+               'add', 'sub', 'mov')
+
+    def __init__(self):
+        self.regs = {}
+        self.sp = self.reg('sp')
+        self.pc = None
+        # registers the code uses that were unknown when tracing
+        self.missing = set()
+
+    @staticmethod
+    def constant(value):
+        return (value, ())
+
+    @staticmethod
+    def offset(value, delta):
+        return (value[0] + delta, value[1])
+
+    @staticmethod
+    def combine(x, y, sign=1):
+        '''Returns the value x + y, or x - y if sign is -1'''
+        factors = dict(x[1])
+        for atom, factor in y[1]:
+            factors[atom] = factors.get(atom, 0) + sign * factor
+        return (x[0] + sign * y[0],
+                tuple(sorted(f for f in factors.iteritems() if f[1])))
+
+    @staticmethod
+    def load(address):
+        return (0, ((('load', address), 1),))
+
+    def reg(self, name):
+        '''Returns the current value of register name'''
+        return self.regs[name] if name in self.regs else (0, ((name, 1),))
+
+    def isKnown(self, name, regs):
+        '''Returns True if register name is tracked, given the registers
+           regs of the frame being traced'''
+        if name in self.regs or name in regs:
+            return True
+        self.missing.add(name)
+        return False
+
+    def evaluate(self, value, frame):
+        result, factors = value
+        for atom, factor in factors:
+            result += factor * (frame.regs[atom] if type(atom) is not tuple
+                    else frame.stack.read(self.evaluate(atom[1], frame)))
+        return result
+
+    def apply(self, frame):
+        '''Returns the caller of frame, or None if the plan does not fit
+           the registers of frame'''
+        if any(name in frame.regs for name in self.missing):
+            return None
+        try:
+            regs = dict((name, self.evaluate(value, frame))
+                        for name, value in self.regs.iteritems())
+            pc = self.evaluate(self.pc, frame)
+            sp = self.evaluate(self.sp, frame)
+        except KeyError:
+            return None
+        frame.regs.update(regs)
+        return Frame(pc, sp, (pc & 1) != 0, frame.regs, frame.stack)
+
+class UnwindPlans:
+    '''UnwindPlans for ranges of code, kept across frames and tracebt runs;
+       stored by library and offset, like InstructionCache'''
+
+    MAX_PLANS = 5000
+
+    def __init__(self):
+        # (library key, is_thumb) to sorted offsets of range starts
+        self._starts = {}
+        # (library key, is_thumb, start) to (end, plan), in least
+        # recently used order
+        self._plans = collections.OrderedDict()
+
+    def clearSolibs(self, event=None):
+        self.clear(None)
+
+    def find(self, pc, is_thumb):
+        '''Returns the UnwindPlan for a frame at pc, or None'''
+        pc &= ~1
+        key, base = instructionCache._library(pc)
+        starts = self._starts.get((key, is_thumb))
+        i = bisect.bisect_right(starts, pc - base) - 1 if starts else -1
+        if i < 0:
+            return None
+        lru = (key, is_thumb, starts[i])
+        end, plan = self._plans[lru] = self._plans.pop(lru)
+        return plan if pc - base <= end else None
+
+    def add(self, start, end, is_thumb, plan):
+        '''Adds plan for frames at pc from start to end, inclusive'''
+        start &= ~1
+        key, base = instructionCache._library(start)
+        lru = (key, is_thumb, start - base)
+        if lru in self._plans:
+            del self._plans[lru]
+        else:
+            bisect.insort(self._starts.setdefault((key, is_thumb), []),
+                          start - base)
+        self._plans[lru] = (max(start, end) - base, plan)
+        while len(self._plans) > self.MAX_PLANS:
+            self._remove(self._plans.popitem(last=False)[0])
+
+    def _remove(self, lru):
+        starts = self._starts[lru[0: 2]]
+        del starts[bisect.bisect_left(starts, lru[2])]
+
+    def clear(self, key):
+        '''Removes plans of library key, or of code outside of
+           libraries if key is None'''
+        for lru in [l for l in self._plans if l[0] == key]:
+            del self._plans[lru]
+            self._remove(lru)
+
+unwindPlans = UnwindPlans()
+if hasattr(gdb.events, 'new_objfile'):
+    gdb.events.new_objfile.connect(unwindPlans.clearSolibs)
+if hasattr(gdb.events, 'clear_objfiles'):
+    gdb.events.clear_objfiles.connect(unwindPlans.clearSolibs)
+
+# names of registers by DWARF number, as in "info registers"
+TABLE_REGISTERS = ['r0', 'r1', 'r2', 'r3', 'r4', 'r5', 'r6', 'r7', 'r8',
+                   'r9', 'r10', 'r11', 'r12', 'sp', 'lr', 'pc']
+REGISTER_ALIASES = {10: 'sl', 11: 'fp', 12: 'ip'}
+
 class Frame:
 
-    def __init__(self, pc, sp, is_thumb, regs = {}):
+    def __init__(self, pc, sp, is_thumb, regs = {}, stack = None):
         self.pc = pc
         self.sp = sp
         self.is_thumb = is_thumb
         regs['pc'] = pc
         regs['sp'] = sp
         self.regs = regs
+        # stack memory shared by frames of the same backtrace
+        self.stack = stack or StackReader()
+        # whether pc is a return address, i.e. the frame is in a call
+        self.is_caller = False
 
     def printToGDB(self):
         gdb.execute('frame ' + hex(self.sp) + ' ' + hex(self.pc), False, False)
@@ -98,12 +414,7 @@ class Frame:
             RE_INSTRUCTION = re.compile(
                 r'.+(0x[\da-f]+).*:\s+([\d\w_\.]+)\s+([^;]*);?')
             BLOCK_SIZE = 0x80
-            MAX_RANGES = 10
-            class Range(tuple):
-                def __new__(cls, start, end, is_thumb, insts):
-                    return tuple.__new__(cls, (start, end, is_thumb, insts))
             def __init__(self, pc, is_thumb):
-                self._ranges = []
                 self.jump(pc, is_thumb)
             def __iter__(self):
                 return self
@@ -111,15 +422,34 @@ class Frame:
                 inst = self._curRange[3][self._curIndex]
                 return hex(inst[0]) + ': ' + inst[1] + ' ' + inst[2]
             def _findRange(self, addr, is_thumb):
-                return next((r for r in self._ranges if addr >= r[0]
-                                and addr < r[1] and is_thumb == r[2]), None)
+                return instructionCache.find(addr, is_thumb)
+            def _decodeRange(self, pc, end, is_thumb):
+                # decode code bytes directly; the range ends before the
+                # first instruction the decoder does not understand
+                pc = pc & ~1 if is_thumb else pc & ~3
+                try:
+                    data = str(gdb.selected_inferior().read_memory(
+                                pc, end - pc))
+                except gdb.MemoryError:
+                    return None
+                insts, end = armdecode.decode(data, pc, is_thumb)
+                if not insts:
+                    return None
+                return CodeRange(pc, end, is_thumb, insts)
             def _loadRange(self, pc, is_thumb):
                 # load instructions up until any cached range
                 end = pc + self.BLOCK_SIZE
-                cached = next((r for r in self._ranges if pc < r[0]
-                                and end >= r[1] and is_thumb == r[2]), None)
-                if cached:
-                    end = cached[0] + 8 # account for last instruction
+                cached = instructionCache.nextStart(pc, is_thumb)
+                if cached is not None and cached < end:
+                    end = cached
+                r = self._decodeRange(pc, end, is_thumb)
+                if not r:
+                    r = self._disassembleRange(pc, end + 8 # last instruction
+                            if end == cached else end, is_thumb)
+                if r:
+                    instructionCache.add(r)
+                return r
+            def _disassembleRange(self, pc, end, is_thumb):
                 # adjust pc according to ARM/THUMB mode
                 pc = pc | 1 if is_thumb else pc & (~3)
                 # disassemble a block of instructions at pc
@@ -147,12 +477,7 @@ class Frame:
                     insts.append((ipc, mnemonic, args))
                 if not insts:
                     return None
-                r = AssemblyCache.Range(insts[0][0], insts[-1][0],
-                                        is_thumb, insts)
-                self._ranges.append(r)
-                if len(self._ranges) > self.MAX_RANGES:
-                    del self._ranges[0]
-                return r
+                return CodeRange(insts[0][0], insts[-1][0], is_thumb, insts)
             def next(self):
                 is_thumb = self._curRange[2]
                 self._curIndex += 1
@@ -168,21 +493,31 @@ class Frame:
                     self._curRange = self._loadRange(pc, is_thumb)
                 assert self._curRange, "cannot load instructions!"
                 self._curIndex = next((i for i in range(len(self._curRange[3]))
-                                    if self._curRange[3][i][0] > pc), -1) - 2
+                                    if self._curRange[3][i][0] > pc),
+                                    len(self._curRange[3])) - 2
                 assert self._curIndex >= -1, "instruction at " + \
                                                 hex(pc) + " not in range!"
 
         branchHistory = []
         assemblyCache = AssemblyCache(self.pc, self.is_thumb)
-        sp = self.sp
-        regs = self.regs;
-        regs['sp'] = savedSp = sp
+        regs = self.regs
+        plan = UnwindPlan()
+        savedSp = plan.sp
+        # the plan also fits frames starting at any pc up to the first
+        # instruction that has an effect, since they trace the same way
+        planEnd = None
+
+        def finish(pc):
+            plan.pc = plan.reg(pc)
+            unwindPlans.add(self.pc, planEnd, self.is_thumb, plan)
+            return plan.apply(self)
 
         for pc, mnemonic, args, is_thumb in assemblyCache:
 
             # trace branch instructions
             def traceBranch(is_cond):
-                log.info('branch (%s) to %s @ %x : %x', mnemonic, args, pc, sp)
+                log.info('branch (%s) to %s @ %x : %x', mnemonic, args, pc,
+                         plan.evaluate(plan.sp, self))
                 new_pc = int(args, 0)
                 new_is_thumb = not is_thumb if mnemonic.startswith('bx') \
                                 else is_thumb
@@ -202,23 +537,26 @@ class Frame:
                 return (branchHistory[branchHistory.index(pc)].take,
                         new_pc, new_is_thumb)
 
-            if savedSp == sp: # sp hasn't changed, regs['sp'] might have
-                savedSp = sp = regs['sp']
+            if planEnd is None and mnemonic.startswith(UnwindPlan.EFFECTS):
+                planEnd = pc
+
+            if savedSp == plan.sp: # sp hasn't changed, regs['sp'] might have
+                savedSp = plan.sp = plan.reg('sp')
             else: # sp has changed, update regs['sp']
-                savedSp = regs['sp'] = sp
+                savedSp = plan.regs['sp'] = plan.sp
 
             # handle individual instructions
             if mnemonic == 'b' or mnemonic == 'bx' or \
                 mnemonic == 'bal' or mnemonic == 'bxal':
                 if args == 'lr':
                     # FIXME lr might not be valid
-                    log.warning('frame (bx lr) @ %x : %x', pc, sp)
-                    pc = regs['lr']
-                    return Frame(pc, sp, (pc & 1) != 0, regs)
+                    log.warning('frame (bx lr) @ %x : %x', pc,
+                                plan.evaluate(plan.sp, self))
+                    return finish('lr')
                 elif args.startswith('r'):
                     log.warning(
                             'skipped unconditional branch (%s %s) @ %x : %x',
-                            mnemonic, args, pc, sp)
+                            mnemonic, args, pc, plan.evaluate(plan.sp, self))
                     continue
                 (new_block, pc, is_thumb) = traceBranch(False)
                 # always take unconditional branches
@@ -231,87 +569,80 @@ class Frame:
                 if mnemonic.startswith('cb'):
                     args = args[args.find(',') + 1 :].lstrip()
                 if args == 'lr':
-                    log.warning('skipped conditional bx lr @ %x : %x', pc, sp)
+                    log.warning('skipped conditional bx lr @ %x : %x', pc,
+                                plan.evaluate(plan.sp, self))
                     continue
                 (new_block, pc, is_thumb) = traceBranch(True)
                 if new_block:
                     assemblyCache.jump(pc, is_thumb)
 
             elif mnemonic == 'vpush':
-                sp -= 8 * len(args[args.find('{') :].split(','))
+                plan.sp = plan.offset(plan.sp,
+                        -8 * len(args[args.find('{') :].split(',')))
 
             elif mnemonic == 'push' or \
                 (mnemonic.startswith('stmd') and args.startswith('sp!')):
-                sp -= 4 * len(args[args.find('{') :].split(','))
+                plan.sp = plan.offset(plan.sp,
+                        -4 * len(args[args.find('{') :].split(',')))
 
             elif mnemonic == 'vpop':
-                sp += 8 * len(args[args.find('{') :].split(','))
+                plan.sp = plan.offset(plan.sp,
+                        8 * len(args[args.find('{') :].split(',')))
 
             elif mnemonic == 'pop' or \
                 (mnemonic.startswith('ldmi') and args.startswith('sp!')) or \
                 (mnemonic.startswith('pop') and args.find('pc') >= 0):
                 for r in args.translate(None, '{ }').split(','):
-                    regs[r] = int(gdb.parse_and_eval('*(unsigned*)' + hex(sp)))
-                    sp += 4
+                    plan.regs[r] = plan.load(plan.sp)
+                    plan.sp = plan.offset(plan.sp, 4)
                 if args.find('pc') > 0:
-                    log.info('frame (pop pc) @ %x : %x', pc, sp)
-                    pc = regs['pc']
-                    return Frame(pc, sp, (pc & 1) != 0, regs)
+                    log.info('frame (pop pc) @ %x : %x', pc,
+                             plan.evaluate(plan.sp, self))
+                    return finish('pc')
 
-            elif mnemonic == 'add' or mnemonic.startswith('add.'):
+            elif mnemonic == 'add' or mnemonic.startswith('add.') or \
+                mnemonic == 'sub' or mnemonic.startswith('sub.'):
+                sign = 1 if mnemonic.startswith('add') else -1
                 r = args.translate(None, ' ').split(',')
-                if r[0] in regs:
-                    if r[1] in regs:
+                if plan.isKnown(r[0], regs):
+                    if plan.isKnown(r[1], regs):
                         if len(r) == 2:
-                            regs[r[0]] += regs[r[1]]
-                        elif r[2] in regs:
-                            regs[r[0]] = regs[r[1]] + regs[r[2]]
+                            plan.regs[r[0]] = plan.combine(
+                                    plan.reg(r[0]), plan.reg(r[1]), sign)
+                        elif plan.isKnown(r[2], regs):
+                            plan.regs[r[0]] = plan.combine(
+                                    plan.reg(r[1]), plan.reg(r[2]), sign)
                         elif r[2].startswith('#'):
-                            regs[r[0]] = regs[r[1]] + int(r[2][1:], 0)
+                            plan.regs[r[0]] = plan.offset(plan.reg(r[1]),
+                                    sign * int(r[2][1:], 0))
                         else:
-                            log.warning('unhandled add: %s (pc = %s)',
-                                        args, hex(pc))
+                            log.warning('unhandled %s: %s (pc = %s)',
+                                        mnemonic[0: 3], args, hex(pc))
                     elif r[1].startswith('#'):
-                        regs[r[0]] += int(r[1][1:], 0)
+                        plan.regs[r[0]] = plan.offset(plan.reg(r[0]),
+                                sign * int(r[1][1:], 0))
                     else:
-                        log.warning('unhandled add: %s (pc = %s)',
-                                    args, hex(pc))
+                        log.warning('unhandled %s: %s (pc = %s)',
+                                    mnemonic[0: 3], args, hex(pc))
                 else:
-                    log.warning('unhandled add: %s (pc = %s)',
-                                args, hex(pc))
-
-            elif mnemonic == 'sub' or mnemonic.startswith('sub.'):
-                r = args.translate(None, ' ').split(',')
-                if r[0] in regs:
-                    if r[1] in regs:
-                        if len(r) == 2:
-                            regs[r[0]] -= regs[r[1]]
-                        elif r[2] in regs:
-                            regs[r[0]] = regs[r[1]] - regs[r[2]]
-                        elif r[2].startswith('#'):
-                            regs[r[0]] = regs[r[1]] - int(r[2][1:], 0)
-                        else:
-                            log.warning('unhandled sub: %s (pc = %s)',
-                                        args, hex(pc))
-                    elif r[1].startswith('#'):
-                        regs[r[0]] -= int(r[1][1:], 0)
-                    else:
-                        log.warning('unhandled sub: %s (pc = %s)',
-                                    args, hex(pc))
-                else:
-                    log.warning('unhandled sub: %s (pc = %s)',
-                                args, hex(pc))
+                    log.warning('unhandled %s: %s (pc = %s)',
+                                mnemonic[0: 3], args, hex(pc))
 
             elif mnemonic == 'mov' or mnemonic.startswith('mov.'):
                 r = args.translate(None, ' ').split(',')
-                if r[0] in regs and r[1] in regs:
-                    regs[r[0]] = regs[r[1]]
-                elif r[0] in regs and r[1].startswith('#'):
-                    regs[r[0]] = int(r[1][1:], 0)
+                if plan.isKnown(r[0], regs) and plan.isKnown(r[1], regs):
+                    plan.regs[r[0]] = plan.reg(r[1])
+                elif plan.isKnown(r[0], regs) and r[1].startswith('#'):
+                    plan.regs[r[0]] = plan.constant(int(r[1][1:], 0))
                 else:
                     log.warning('unhandled mov: %s (pc = %s)',
                                 args, hex(pc))
 
+            elif mnemonic == 'adr':
+                r = args.translate(None, ' ').split(',')
+                if plan.isKnown(r[0], regs):
+                    plan.regs[r[0]] = plan.constant(int(r[1], 0))
+
             elif args.startswith('pc') or ((args.find('pc') > args.find('{'))
                                     and (args.find('pc') < args.find('}'))):
                 log.warning('unknown instruction at %s (%s %s) affected pc',
@@ -326,14 +657,59 @@ class Frame:
                 log.warning('conditional instruction at %s (%s %s) affected sp',
                         hex(pc), mnemonic, args)
 
-    def unwind(self):
-        # don't let value of cpsr affect our results
-        saved_cpsr = int(gdb.parse_and_eval('$cpsr'))
-        gdb.execute('set $cpsr=' + hex(saved_cpsr & 0x00f003df))
+    def _unwindTable(self):
+        # unwind using the tables of the library file, if any
+        solib = instructionCache.solib(self.pc)
+        table = solib and unwindtab.getTable(solib[2])
+        if not table or table.textAddress is None:
+            return None
+        # a return address can be past the end of the calling function
+        pc = (self.pc & ~1) - (1 if self.is_caller else 0)
+        # traced code updates registers under the names the
+        # disassembler uses for them, so those are the current values
+        regs = {}
+        for i, name in enumerate(TABLE_REGISTERS):
+            name = REGISTER_ALIASES[i] if REGISTER_ALIASES.get(i) \
+                    in self.regs else name
+            if name in self.regs:
+                regs[i] = self.regs[name]
         try:
-            return self._unwind()
-        finally:
-            gdb.execute('set $cpsr=' + hex(saved_cpsr))
+            regs = table.unwind(pc - solib[0] + table.textAddress, regs,
+                                self.stack.read, self.is_caller)
+        except gdb.MemoryError:
+            return None
+        if not regs or unwindtab.PC not in regs:
+            return None
+        for i, value in regs.iteritems():
+            if i >= len(TABLE_REGISTERS):
+                continue
+            self.regs[TABLE_REGISTERS[i]] = value
+            # and under the name the disassembler uses, if any
+            if i in REGISTER_ALIASES:
+                self.regs[REGISTER_ALIASES[i]] = value
+        pc = regs[unwindtab.PC]
+        log.info('frame (table) @ %x : %x', pc, regs[unwindtab.SP])
+        return Frame(pc, regs[unwindtab.SP], (pc & 1) != 0,
+                     self.regs, self.stack)
+
+    def unwind(self):
+        # libraries with unwind tables need no tracing, and code traced
+        # before unwinds the same way again
+        frame = self._unwindTable()
+        if not frame:
+            plan = unwindPlans.find(self.pc, self.is_thumb)
+            frame = plan and plan.apply(self)
+        if not frame:
+            # don't let value of cpsr affect our results
+            saved_cpsr = int(gdb.parse_and_eval('$cpsr'))
+            gdb.execute('set $cpsr=' + hex(saved_cpsr & 0x00f003df))
+            try:
+                frame = self._unwind()
+            finally:
+                gdb.execute('set $cpsr=' + hex(saved_cpsr))
+        if frame:
+            frame.is_caller = True
+        return frame
 
 class TraceBT(gdb.Command):
     '''Unwind stack by tracing instructions'''
@@ -380,11 +756,16 @@ class TraceBT(gdb.Command):
         except (ValueError, gdb.error) as e:
             raise gdb.GdbError('cannot parse argument: ' + str(e))
 
+        # code outside of libraries may have changed since the last run
+        instructionCache.clear(None)
+        unwindPlans.clear(None)
         try:
             fid = 0
             f = Frame(0, 0, False)
             newf = Frame(pc, sp, is_thumb, regs)
             while newf != f:
+                for hook in frameHooks:
+                    hook(newf.pc)
                 print '#{0}: {1}'.format(fid, str(newf))
                 f = newf
                 newf = f.unwind()
@@ -0,0 +1,526 @@
+# vi: set tabstop=4 shiftwidth=4 expandtab:
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Reader of the unwind tables of ELF files: ARM exception handling tables
+# (.ARM.exidx and .ARM.extab) and DWARF call frame information (.eh_frame).
+# Files are mapped into memory and searched in place; only the entries
+# covering the frames being unwound are parsed. Registers are given by
+# DWARF number, which for ARM is 0 to 15 for r0 to pc.
+# This module does not depend on gdb, so it can be used outside of gdb.
+
+import os, mmap, struct, bisect, collections
+
+SP = 13
+LR = 14
+PC = 15
+
+EXIDX_CANTUNWIND = 1
+
+# call frame information common to the FDEs of a CIE
+_Cie = collections.namedtuple('_Cie', ['code_align', 'data_align', 'ra',
+                              'fde_enc', 'augmented', 'start', 'end'])
+
+def _prel31(word, place):
+    offset = word & 0x7fffffff
+    if offset & 0x40000000:
+        offset -= 0x80000000
+    return (place + offset) & 0xffffffff
+
+def _uleb128(data, offset):
+    result = shift = 0
+    while True:
+        byte = ord(data[offset])
+        offset += 1
+        result |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return result, offset
+
+def _sleb128(data, offset):
+    result = shift = 0
+    while True:
+        byte = ord(data[offset])
+        offset += 1
+        result |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            if byte & 0x40:
+                result -= 1 << shift
+            return result, offset
+
+def executeEhabi(ops, regs, read):
+    '''Runs ARM exception handling unwind opcodes ops, a list of bytes,
+       for a frame with registers regs, reading stack words through
+       read(address); returns the caller's registers, or None if the
+       opcodes refuse to unwind or are not supported'''
+    caller = dict(regs)
+    vsp = regs[SP]
+    popped = set()
+    def pop(reg):
+        caller[reg] = read(vsp)
+        popped.add(reg)
+        return vsp + 4
+    i = 0
+    while i < len(ops):
+        op = ops[i]
+        i += 1
+        if op & 0xc0 == 0x00:
+            vsp += ((op & 0x3f) << 2) + 4
+        elif op & 0xc0 == 0x40:
+            vsp -= ((op & 0x3f) << 2) + 4
+        elif op & 0xf0 == 0x80:
+            mask = (op & 0xf) << 8 | ops[i]
+            i += 1
+            if not mask:
+                return None
+            for reg in range(4, 16):
+                if mask & (1 << (reg - 4)):
+                    vsp = pop(reg)
+            if mask & (1 << (SP - 4)):
+                vsp = caller[SP]
+        elif op & 0xf0 == 0x90:
+            if op & 0xf in (SP, PC):
+                return None
+            vsp = caller[op & 0xf]
+        elif op & 0xf0 == 0xa0:
+            for reg in range(4, 5 + (op & 7)):
+                vsp = pop(reg)
+            if op & 8:
+                vsp = pop(LR)
+        elif op == 0xb0:
+            break
+        elif op == 0xb1:
+            mask = ops[i]
+            i += 1
+            if not mask or mask & 0xf0:
+                return None
+            for reg in range(4):
+                if mask & (1 << reg):
+                    vsp = pop(reg)
+        elif op == 0xb2:
+            value = shift = 0
+            while True:
+                value |= (ops[i] & 0x7f) << shift
+                shift += 7
+                i += 1
+                if not ops[i - 1] & 0x80:
+                    break
+            vsp += 0x204 + (value << 2)
+        elif op == 0xb3:
+            # VFP registers saved by FSTMFDX
+            vsp += 8 * ((ops[i] & 0xf) + 1) + 4
+            i += 1
+        elif op & 0xf8 == 0xb8:
+            vsp += 8 * ((op & 7) + 1) + 4
+        elif op & 0xf8 == 0xc0 and op not in (0xc6, 0xc7):
+            # iWMMXt registers
+            vsp += 8 * ((op & 7) + 1)
+        elif op in (0xc6, 0xc8, 0xc9):
+            vsp += 8 * ((ops[i] & 0xf) + 1)
+            i += 1
+        elif op == 0xc7:
+            mask = ops[i]
+            i += 1
+            if not mask or mask & 0xf0:
+                return None
+            vsp += 4 * bin(mask).count('1')
+        elif op & 0xf8 == 0xd0:
+            # VFP registers saved by VPUSH
+            vsp += 8 * ((op & 7) + 1)
+        else:
+            return None
+    caller[SP] = vsp & 0xffffffff
+    if PC not in popped:
+        caller[PC] = caller[LR]
+    return caller
+
+class UnwindTable(object):
+    '''Unwind tables of the ELF file at path, mapped into memory'''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        data = self._data
+        if len(data) < 52 or data[0: 4] != '\x7fELF':
+            raise ValueError('not an ELF file')
+        self.is64 = data[4] == '\x02'
+        self.endian = '<' if data[5] == '\x01' else '>'
+        # section name to (address, file offset, size)
+        self.sections = self._readSections()
+        text = self.sections.get('.text')
+        # address of the code, for finding the load address
+        self.textAddress = text[0] if text else None
+        self._exidx = self.sections.get('.ARM.exidx')
+        self._ehframe = self.sections.get('.eh_frame')
+        self._ehframeHdr = self.sections.get('.eh_frame_hdr')
+        # starts and offsets of FDEs, when there is no usable header
+        self._fdeStarts = None
+        self._fdeOffsets = None
+        # file offset to _Cie
+        self._cies = {}
+
+    def close(self):
+        self._data.close()
+
+    def hasTables(self):
+        return bool(self._exidx or self._ehframe)
+
+    def _unpack(self, fmt, offset):
+        return struct.unpack_from(self.endian + fmt, self._data, offset)
+
+    def _readSections(self):
+        if self.is64:
+            shoff, = self._unpack('Q', 40)
+            shentsize, shnum, shstrndx = self._unpack('HHH', 58)
+        else:
+            shoff, = self._unpack('I', 32)
+            shentsize, shnum, shstrndx = self._unpack('HHH', 46)
+        headers = []
+        for i in range(shnum):
+            sh = shoff + i * shentsize
+            if self.is64:
+                name, kind, flags, addr, offset, size = self._unpack(
+                        'IIQQQQ', sh)
+            else:
+                name, kind, flags, addr, offset, size = self._unpack(
+                        'IIIIII', sh)
+            headers.append((name, addr, offset, size))
+        if not headers or shstrndx >= len(headers):
+            return {}
+        strtab = headers[shstrndx][2]
+        sections = {}
+        for name, addr, offset, size in headers:
+            start = strtab + name
+            end = self._data.find('\0', start)
+            sections[self._data[start: end]] = (addr, offset, size)
+        return sections
+
+    def _offset(self, address):
+        # file offset of address, or None
+        for addr, offset, size in self.sections.itervalues():
+            if addr and addr <= address < addr + size:
+                return offset + address - addr
+        return None
+
+    def _pointer(self, offset, encoding, section, datarel=0):
+        # reads a pointer with DW_EH_PE encoding at offset in section;
+        # returns (value, end), with None for unsupported encodings
+        form = encoding & 0x0f
+        if form == 0x01:
+            value, end = _uleb128(self._data, offset)
+        elif form == 0x09:
+            value, end = _sleb128(self._data, offset)
+        else:
+            code = {0x00: 'Q' if self.is64 else 'I', 0x02: 'H', 0x03: 'I',
+                    0x04: 'Q', 0x0a: 'h', 0x0b: 'i', 0x0c: 'q'}.get(form)
+            if not code:
+                return None, offset
+            value, = self._unpack(code, offset)
+            end = offset + struct.calcsize(code)
+        application = encoding & 0x70
+        if application == 0x10:
+            value += section[0] + offset - section[1]
+        elif application == 0x30:
+            value += datarel
+        elif application or encoding & 0x80:
+            return None, end
+        return value & (0xffffffffffffffff if self.is64 else 0xffffffff), end
+
+    def _exidxOps(self, pc):
+        # returns unwind opcodes of the function containing pc, [] for
+        # functions that cannot be unwound, or None if none covers pc
+        addr, offset, size = self._exidx
+        def start(i):
+            return _prel31(self._unpack('I', offset + i * 8)[0],
+                           addr + i * 8) & ~1
+        low, high = 0, size / 8
+        while low < high:
+            middle = (low + high) / 2
+            if start(middle) <= pc:
+                low = middle + 1
+            else:
+                high = middle
+        if not low:
+            return None
+        entry = low - 1
+        value, = self._unpack('I', offset + entry * 8 + 4)
+        if value == EXIDX_CANTUNWIND:
+            return []
+        if value & 0x80000000:
+            # compact model 0 in the table itself
+            if (value >> 24) & 0xf:
+                return []
+            return [(value >> 16) & 0xff, (value >> 8) & 0xff, value & 0xff]
+        extab = self._offset(_prel31(value, addr + entry * 8 + 4))
+        if extab is None:
+            return []
+        word, = self._unpack('I', extab)
+        if not word & 0x80000000:
+            # generic personality routine, followed by data in the
+            # format __gxx_personality_v0 uses
+            extab += 4
+            word, = self._unpack('I', extab)
+            count = word >> 24
+            ops = [(word >> 16) & 0xff, (word >> 8) & 0xff, word & 0xff]
+        elif (word >> 24) & 0xf == 0:
+            count = 0
+            ops = [(word >> 16) & 0xff, (word >> 8) & 0xff, word & 0xff]
+        elif (word >> 24) & 0xf in (1, 2):
+            count = (word >> 16) & 0xff
+            ops = [(word >> 8) & 0xff, word & 0xff]
+        else:
+            return []
+        for word in self._unpack('I' * count, extab + 4):
+            ops += [word >> 24, (word >> 16) & 0xff, (word >> 8) & 0xff,
+                    word & 0xff]
+        return ops
+
+    def _cie(self, offset):
+        if offset in self._cies:
+            return self._cies[offset]
+        data = self._data
+        length, = self._unpack('I', offset)
+        end = offset + 4 + length
+        p = offset + 8
+        version = ord(data[p])
+        augmentation = data[p + 1: data.find('\0', p + 1)]
+        p += len(augmentation) + 2
+        if 'eh' in augmentation:
+            p += 8 if self.is64 else 4
+        code_align, p = _uleb128(data, p)
+        data_align, p = _sleb128(data, p)
+        if version == 1:
+            ra = ord(data[p])
+            p += 1
+        else:
+            ra, p = _uleb128(data, p)
+        fde_enc = 0
+        if augmentation.startswith('z'):
+            length, p = _uleb128(data, p)
+            instructions = p + length
+            for c in augmentation[1:]:
+                if c == 'R':
+                    fde_enc = ord(data[p])
+                    p += 1
+                elif c == 'L':
+                    p += 1
+                elif c == 'P':
+                    p = self._pointer(p + 1, ord(data[p]), self._ehframe)[1]
+                elif c not in 'SB':
+                    break
+            p = instructions
+        cie = _Cie(code_align, data_align, ra, fde_enc,
+                   augmentation.startswith('z'), p, end)
+        self._cies[offset] = cie
+        return cie
+
+    def _fdeRange(self, offset):
+        # returns (cie, start, end, instructions, instructions end) of
+        # the FDE at offset, or None for CIEs and terminators
+        length, = self._unpack('I', offset)
+        if not length or length == 0xffffffff:
+            return None
+        pointer, = self._unpack('I', offset + 4)
+        if not pointer:
+            return None
+        cie = self._cie(offset + 4 - pointer)
+        start, p = self._pointer(offset + 8, cie.fde_enc, self._ehframe)
+        size, p = self._pointer(p, cie.fde_enc & 0x0f, self._ehframe)
+        if start is None or size is None:
+            return None
+        if cie.augmented:
+            skip, p = _uleb128(self._data, p)
+            p += skip
+        return cie, start, start + size, p, offset + 4 + length
+
+    def _findFde(self, pc):
+        # returns the file offset of the FDE that may cover pc, or None
+        addr, offset, size = self._ehframe
+        if self._ehframeHdr and self._fdeStarts is None:
+            hdr = self._ehframeHdr
+            version, ptr_enc, count_enc, table_enc = self._unpack(
+                    'BBBB', hdr[1])
+            width = {0x02: 2, 0x03: 4, 0x04: 8, 0x0a: 2, 0x0b: 4,
+                     0x0c: 8}.get(table_enc & 0x0f)
+            p = self._pointer(hdr[1] + 4, ptr_enc, hdr)[1]
+            count, p = self._pointer(p, count_enc, hdr)
+            if version == 1 and width and count is not None and \
+                    table_enc & 0x70 in (0x00, 0x30):
+                low, high = 0, count
+                while low < high:
+                    middle = (low + high) / 2
+                    if self._pointer(p + middle * 2 * width, table_enc, hdr,
+                                     hdr[0])[0] <= pc:
+                        low = middle + 1
+                    else:
+                        high = middle
+                if not low:
+                    return None
+                fde = self._pointer(p + (low * 2 - 1) * width, table_enc,
+                                    hdr, hdr[0])[0]
+                return offset + fde - addr
+        if self._fdeStarts is None:
+            # no usable header; index FDEs by reading their headers once
+            fdes = []
+            p = offset
+            while p + 4 <= offset + size:
+                length, = self._unpack('I', p)
+                if not length or length == 0xffffffff:
+                    break
+                fde = self._fdeRange(p)
+                if fde:
+                    fdes.append((fde[1], p))
+                p += 4 + length
+            fdes.sort()
+            self._fdeStarts = [s for s, o in fdes]
+            self._fdeOffsets = [o for s, o in fdes]
+        i = bisect.bisect_right(self._fdeStarts, pc) - 1
+        return self._fdeOffsets[i] if i >= 0 else None
+
+    def _executeCfa(self, cie, p, end, row, pc=None, loc=0, initial=None):
+        # runs call frame instructions from p to end on row, a list of
+        # [CFA register, CFA offset, rules], for code from loc up to pc
+        data = self._data
+        rules = row[2]
+        stack = []
+        while p < end:
+            op = ord(data[p])
+            p += 1
+            if op & 0xc0 == 0x40:
+                loc += (op & 0x3f) * cie.code_align
+            elif op & 0xc0 == 0x80:
+                value, p = _uleb128(data, p)
+                rules[op & 0x3f] = ('offset', value * cie.data_align)
+            elif op & 0xc0 == 0xc0 or op == 0x06:
+                if op == 0x06:
+                    reg, p = _uleb128(data, p)
+                else:
+                    reg = op & 0x3f
+                if initial and reg in initial:
+                    rules[reg] = initial[reg]
+                else:
+                    rules.pop(reg, None)
+            elif op == 0x00:
+                pass
+            elif op == 0x01:
+                loc, p = self._pointer(p, cie.fde_enc, self._ehframe)
+            elif op in (0x02, 0x03, 0x04):
+                code = {0x02: 'B', 0x03: 'H', 0x04: 'I'}[op]
+                loc += self._unpack(code, p)[0] * cie.code_align
+                p += struct.calcsize(code)
+            elif op in (0x05, 0x11, 0x14, 0x15, 0x2f):
+                reg, p = _uleb128(data, p)
+                if op in (0x11, 0x15):
+                    value, p = _sleb128(data, p)
+                else:
+                    value, p = _uleb128(data, p)
+                value *= -cie.data_align if op == 0x2f else cie.data_align
+                rules[reg] = ('val_offset' if op in (0x14, 0x15)
+                              else 'offset', value)
+            elif op in (0x07, 0x08):
+                reg, p = _uleb128(data, p)
+                rules[reg] = ('undefined' if op == 0x07 else 'same', 0)
+            elif op == 0x09:
+                reg, p = _uleb128(data, p)
+                value, p = _uleb128(data, p)
+                rules[reg] = ('register', value)
+            elif op == 0x0a:
+                stack.append((row[0], row[1], dict(rules)))
+            elif op == 0x0b:
+                row[0], row[1], saved = stack.pop()
+                rules.clear()
+                rules.update(saved)
+            elif op in (0x0c, 0x12):
+                row[0], p = _uleb128(data, p)
+                if op == 0x0c:
+                    row[1], p = _uleb128(data, p)
+                else:
+                    value, p = _sleb128(data, p)
+                    row[1] = value * cie.data_align
+            elif op == 0x0d:
+                row[0], p = _uleb128(data, p)
+            elif op == 0x0e:
+                row[1], p = _uleb128(data, p)
+            elif op == 0x13:
+                value, p = _sleb128(data, p)
+                row[1] = value * cie.data_align
+            elif op == 0x2e:
+                value, p = _uleb128(data, p)
+            else:
+                # DWARF expressions are not supported
+                raise ValueError('unsupported CFA instruction %#x' % op)
+            if pc is not None and (loc is None or loc > pc):
+                break
+        return row
+
+    def _unwindCfi(self, pc, regs, read):
+        offset = self._findFde(pc)
+        fde = self._fdeRange(offset) if offset is not None else None
+        if not fde or not fde[1] <= pc < fde[2]:
+            return None
+        cie, start, end, p, p_end = fde
+        row = self._executeCfa(cie, cie.start, cie.end, [None, 0, {}])
+        self._executeCfa(cie, p, p_end, row, pc, start, dict(row[2]))
+        reg, offset, rules = row
+        if reg not in regs:
+            return None
+        cfa = (regs[reg] + offset) & 0xffffffff
+        caller = dict(regs)
+        caller[SP] = cfa
+        for reg, (kind, value) in rules.iteritems():
+            if kind == 'offset':
+                caller[reg] = read(cfa + value)
+            elif kind == 'val_offset':
+                caller[reg] = (cfa + value) & 0xffffffff
+            elif kind == 'register':
+                caller[reg] = regs[value]
+            elif kind == 'undefined':
+                caller.pop(reg, None)
+        if cie.ra not in caller:
+            return None
+        caller[PC] = caller[cie.ra]
+        return caller
+
+    def unwind(self, pc, regs, read, is_caller=True):
+        '''Unwinds a frame at address pc of the file, with registers regs
+           and stack words read through read(address); returns the
+           caller's registers, with its pc in PC, or None if no table
+           covers pc. ARM exception handling tables are only used when
+           is_caller, i.e. when the frame is stopped at a call, since
+           they do not describe function prologues and epilogues'''
+        try:
+            if is_caller and self._exidx:
+                ops = self._exidxOps(pc)
+                if ops is not None:
+                    return executeEhabi(ops, regs, read) if ops else None
+            if self._ehframe:
+                return self._unwindCfi(pc, regs, read)
+        except (IndexError, KeyError, ValueError, struct.error):
+            pass
+        return None
+
+# (path, mtime, size) to UnwindTable, or None for files without tables
+_tables = {}
+
+def getTable(path):
+    '''Returns the UnwindTable of the ELF file at path, or None if it has
+       no unwind tables; tables stay mapped for later frames'''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    key = (path, st.st_mtime, st.st_size)
+    if key not in _tables:
+        for old in [k for k in _tables if k[0] == path]:
+            table = _tables.pop(old)
+            if table:
+                table.close()
+        try:
+            table = UnwindTable(path)
+        except (IOError, OSError, ValueError, mmap.error, struct.error):
+            table = None
+        _tables[key] = table if table and table.hasTables() else None
+    return _tables[key]